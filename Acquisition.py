@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 08:05:12 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Acquisition loops of PVcamMeasure.run: they drain a PVcamDevice into a FrameRing
+(and, for sequences, into the recording). They do not depend on ScopeFoundry, so that
+Benchmark_pipeline runs the same code against the simulated camera.
+"""
+
+import time
+from FrameRing import BlockWorker
+from FramePool import stack_frames
+
+
+class AcquisitionLoop(object):
+    """
+    Polling loops of the acquisition thread for device (PVcamDevice) and ring (FrameRing).
+    probes: ProbeSet of the run (poll and ring_push are measured here)
+    stop: function returning True to interrupt the acquisition (None: never)
+    progress: function called with the index of each polled frame (None: not called)
+    """
+
+    def __init__(self, device, ring, probes, stop=None, progress=None):
+        self.device = device
+        self.ring = ring
+        self.probes = probes
+        self.stop = stop or (lambda: False)
+        self.progress = progress
+        self.frames = 0 # frames polled by the last run
+        self.poll_time = 0.0 # seconds from the start of the last run to its last polled frame
+        self.drain_time = 0.0 # seconds waiting for the recording of the sequences after their last frame
+
+    def push_frame(self):
+        # the ring slot is the only copy of the frame when zero_copy is enabled in the device
+        t0 = time.perf_counter()
+        with self.device.lease_frame() as lease:
+            t1 = time.perf_counter()
+            self.probes['poll'].add(t1 - t0, lease.data.nbytes) # includes the wait for the camera
+            self.ring.push(lease.data, lease.meta)
+            self.probes['ring_push'].add(time.perf_counter() - t1)
+
+    def run_live(self, number_frames=None):
+        """
+        Acquisition in the live circular buffer: number_frames frames (MultiFrame),
+        or until stop() (Continuous, number_frames None). Every frame goes to the ring.
+        """
+        device = self.device
+        self.frames = 0
+        self.drain_time = 0.0
+        if number_frames is not None:
+            device.set_framenum(number_frames)
+        t_start = time.perf_counter()
+        device.acq_start() #exposure time already changed in the hardware
+        try:
+            while (number_frames is None or self.frames < number_frames) and not self.stop():
+                self.push_frame()
+                if self.progress is not None:
+                    self.progress(self.frames)
+                self.frames += 1
+        finally:
+            self.poll_time = time.perf_counter() - t_start
+            device.acq_stop()
+
+    def run_sequence(self, number_frames, record=None, block_frames=16, budget_MB=1024.0,
+                     every_frame=False, refresh_period=0.05, log=None):
+        """
+        MultiFrame with non-circular buffers: each sequence is filled by the camera at
+        full speed, so no frame can be overwritten while it is drained into the recording.
+        This thread only polls the frames, without copying them out of the sequence buffer:
+        contiguous 3D blocks of block_frames frames (views of the buffer, see stack_frames)
+        are passed to record(frames, meta) by a BlockWorker thread, which has finished before
+        the buffer is freed by acq_stop (record None: nothing is saved). The ring only receives
+        a frame every refresh_period seconds, or every frame with every_frame.
+        Recordings larger than budget_MB are split into consecutive sequences.
+        """
+        device = self.device
+        chunk = int(max(1, min(number_frames, budget_MB * 1e6 // self.ring.frame_nbytes)))
+        if chunk < number_frames and log is not None:
+            log.info(f'{number_frames} frames exceed the sequence budget: '
+                     f'acquiring {-(-number_frames // chunk)} sequences of up to {chunk} frames')
+        last_push = 0.0
+        # the sequence buffer is not reused until acq_stop: zero copy is safe, except for multiple
+        # ROIs, which are packed into a tiled frame that zero-copy leases reuse
+        zero_copy = device.roi_layout is None
+        save = record is not None
+        saver = BlockWorker(lambda frames, meta: record(stack_frames(frames), meta), 'sequence_save') if save else None
+        device.reset_frame_counters()
+        self.frames = 0
+        self.poll_time = self.drain_time = 0.0
+        t_start = time.perf_counter()
+        try:
+            while self.frames < number_frames and not self.stop():
+                count = min(chunk, number_frames - self.frames)
+                device.set_framenum(count)
+                device.acq_start_seq(count, reset_counters=False)
+                frames, metas = [], []
+                try:
+                    for _ in range(count):
+                        t0 = time.perf_counter()
+                        with device.lease_frame(zero_copy=zero_copy) as lease:
+                            data, meta = lease.data, lease.meta
+                        self.probes['poll'].add(time.perf_counter() - t0, data.nbytes)
+                        if save:
+                            frames.append(data)
+                            metas.append(meta)
+                            if len(frames) == block_frames:
+                                saver.put(frames, metas)
+                                frames, metas = [], []
+                        now = time.perf_counter()
+                        self.poll_time = now - t_start
+                        if every_frame or now - last_push > refresh_period:
+                            self.ring.push(data, meta)
+                            last_push = now
+                        if self.progress is not None:
+                            self.progress(self.frames)
+                        self.frames += 1
+                        if self.stop():
+                            break
+                finally:
+                    if save and frames:
+                        saver.put(frames, metas)
+                    try:
+                        if save:
+                            t0 = time.perf_counter()
+                            saver.wait() # the frames are views of the sequence buffer, freed by acq_stop
+                            self.drain_time += time.perf_counter() - t0
+                    finally:
+                        device.acq_stop()
+        finally:
+            if saver is not None:
+                saver.stop()
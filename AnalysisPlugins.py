@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 04:05:52 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Real-time analysis of the acquired frames: each AnalysisPlugin computes a few scalar
+metrics of a frame at a target rate, on a thread or process pool. A plugin that is
+still busy, or whose frame waited longer than its deadline, skips frames instead of
+queueing them, so the analysis never slows down the acquisition.
+"""
+
+import threading
+import time
+import numpy as np
+
+
+class AnalysisPlugin(object):
+    """
+    Base class of the analyses run by AnalysisRunner. Subclasses define:
+    name: unique identifier, used for the settings and the saved results
+    fields: names of the scalar values returned by analyze()
+    rate: target number of analysed frames per second
+    analyze(frame): dict {field: value} for a frame (rows, columns); it must not keep the frame.
+    With the process executor the plugin is pickled with each frame, so it must be
+    defined at module level and keep no large state.
+    """
+    name = 'plugin'
+    fields = ()
+    rate = 10.0
+
+    def analyze(self, frame):
+        raise NotImplementedError
+
+
+class FocusPlugin(AnalysisPlugin):
+    """
+    Brenner sharpness: mean squared difference between pixels `step` columns apart,
+    computed on every `decimate`-th row to keep it cheap on large frames.
+    """
+    name = 'focus'
+    fields = ('sharpness',)
+    rate = 5.0
+
+    def __init__(self, step=2, decimate=2):
+        self.step = step
+        self.decimate = decimate
+
+    def analyze(self, frame):
+        rows = frame[::self.decimate].astype(np.float32)
+        diff = rows[:, self.step:] - rows[:, :-self.step]
+        return {'sharpness': float(np.mean(diff * diff))}
+
+
+class RoiIntensityPlugin(AnalysisPlugin):
+    """
+    Mean and maximum intensity in the ROI (h0, v0, width, height) in frame pixels,
+    the whole frame if roi is None.
+    """
+    name = 'roi_intensity'
+    fields = ('mean', 'max')
+    rate = 20.0
+
+    def __init__(self, roi=None):
+        self.roi = roi
+
+    def analyze(self, frame):
+        if self.roi is not None:
+            h0, v0, width, height = self.roi
+            frame = frame[v0:v0 + height, h0:h0 + width]
+        return {'mean': float(frame.mean(dtype=np.float64)), 'max': float(frame.max())}
+
+
+class SaturationPlugin(AnalysisPlugin):
+    """
+    Number and fraction of pixels at or above threshold (default: the maximum of a 12 bit camera).
+    """
+    name = 'saturation'
+    fields = ('saturated_pixels', 'saturated_fraction')
+    rate = 5.0
+
+    def __init__(self, threshold=4095):
+        self.threshold = threshold
+
+    def analyze(self, frame):
+        count = int(np.count_nonzero(frame >= self.threshold))
+        return {'saturated_pixels': count, 'saturated_fraction': count / frame.size}
+
+
+def run_plugin(plugin, frame, t_frame, deadline):
+    # executed in the pool: (values, seconds spent in analyze), or None if the frame is past its deadline
+    if time.time() - t_frame > deadline:
+        return None
+    t0 = time.perf_counter()
+    values = plugin.analyze(frame)
+    return values, time.perf_counter() - t0
+
+
+class PluginState(object):
+    # results and counters of a plugin during a run
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.next_time = 0.0 # time.time() of the next frame to analyse
+        self.busy = False
+        self.latest = None # last values
+        self.series = [] # (seq, host_time, values)
+        self.analysed = 0
+        self.skipped = 0 # frames not analysed because the plugin was busy or late
+        self.errors = 0
+        self.error = None
+
+
+class AnalysisRunner(object):
+    """
+    Dispatches the frames of the acquisition to the plugins on a pool of `workers` threads
+    (executor='thread') or processes (executor='process'). Each plugin has at most one
+    frame in the pool: frames arriving while it is busy are skipped, and so are frames that
+    waited in the pool longer than deadline periods (1/rate) of the plugin.
+    The frame passed to submit() is copied once and shared by the plugins due at that time.
+    Results: latest(name), series(name), stats(); timing in probes['plugin_<name>'] if given.
+    """
+
+    def __init__(self, workers=2, executor='thread', deadline=2.0, probes=None):
+        self.plugins = []
+        self.workers = workers
+        self.executor = executor
+        self.deadline = deadline
+        self.probes = probes
+        self._states = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def add_plugin(self, plugin):
+        if any(p.name == plugin.name for p in self.plugins):
+            raise ValueError(f'An analysis plugin named {plugin.name} is already registered.')
+        self.plugins.append(plugin)
+
+    def active_plugins(self):
+        return [plugin for plugin in self.plugins if plugin.rate > 0]
+
+    def period(self):
+        # interval between the frames needed by the fastest plugin
+        rates = [plugin.rate for plugin in self.active_plugins()]
+        return 1.0 / max(rates) if rates else None
+
+    def start(self):
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        pool = ProcessPoolExecutor if self.executor == 'process' else ThreadPoolExecutor
+        self._states = {plugin.name: PluginState(plugin) for plugin in self.active_plugins()}
+        self._pool = pool(max_workers=self.workers)
+
+    def stop(self):
+        # waits for the frames being analysed
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def submit(self, seq, frame):
+        # called by the acquisition stream with the newest frame; never blocks
+        now = time.time()
+        due = []
+        rate_of = {} # rate of each due plugin when it was scheduled (it can change from another thread)
+        with self._lock:
+            for state in self._states.values():
+                rate = state.plugin.rate
+                if rate <= 0 or now < state.next_time:
+                    continue # rate 0: the plugin was switched off during the run
+                # one frame per period of the plugin is analysed, or skipped if the last one is not done
+                state.next_time = max(state.next_time + 1.0 / rate, now)
+                if state.busy:
+                    state.skipped += 1
+                    continue
+                state.busy = True
+                due.append(state)
+                rate_of[state] = rate
+        if not due:
+            return
+        frame = np.array(frame) # the stream reuses its buffers
+        for state in due:
+            future = self._pool.submit(run_plugin, state.plugin, frame, now, self.deadline / rate_of[state])
+            future.add_done_callback(lambda f, state=state: self._done(f, state, seq, now))
+
+    def _done(self, future, state, seq, t_frame):
+        with self._lock:
+            state.busy = False
+            if future.exception() is not None:
+                state.errors += 1
+                state.error = future.exception()
+                return
+            result = future.result()
+            if result is None:
+                state.skipped += 1
+                return
+            values, seconds = result
+            state.latest = values
+            state.series.append((seq, t_frame, values))
+            state.analysed += 1
+        if self.probes is not None:
+            self.probes['plugin_' + state.plugin.name].add(seconds)
+
+    def latest(self, name):
+        state = self._states.get(name)
+        return None if state is None else state.latest
+
+    def series(self, name):
+        """
+        Results of plugin name in the run as a structured array with the fields
+        seq, host_time and those of the plugin.
+        """
+        state = self._states[name]
+        dtype = [('seq', np.int64), ('host_time', np.float64)] + [(field, np.float64) for field in state.plugin.fields]
+        with self._lock:
+            rows = [(seq, t, *(values.get(field, np.nan) for field in state.plugin.fields))
+                    for seq, t, values in state.series]
+        return np.array(rows, dtype=dtype)
+
+    def stats(self):
+        with self._lock:
+            return {name: {'analysed': state.analysed, 'skipped': state.skipped, 'errors': state.errors,
+                           'error': state.error}
+                    for name, state in self._states.items()}
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:10:47 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Sustained-throughput benchmark of the acquisition pipeline, run on the simulated
+camera (CameraSim) so that it does not need PVCAM or a Retiga attached.
+It runs the acquisition loops of PVcamMeasure.run (Acquisition.AcquisitionLoop):
+PVcamDevice.lease_frame -> FrameRing -> display consumer (+ H5FrameWriter for MultiFrame)
+and reports sustained fps, dropped frames, end-to-end latency and memory use.
+
+Examples:
+    python Benchmark_pipeline.py
+    python Benchmark_pipeline.py --mode multiframe --frames 1000 --fps 100 --compression lzf
+    python Benchmark_pipeline.py --width 1600 --height 1100 --json bench.json
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+from CameraDevice import PVcamDevice
+from FrameRing import FrameRing, FrameConsumer
+from H5Writer import H5FrameWriter
+from TimingProbes import ProbeSet
+from Acquisition import AcquisitionLoop
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+class LatencyProbe(object):
+    # latency from the poll of each frame (host_time of its metadata) to its use by a consumer
+
+    def __init__(self):
+        self.samples = []
+
+    def done(self, host_times):
+        self.samples.extend(time.time() - np.asarray(host_times, np.float64))
+
+    def summary(self):
+        if not self.samples:
+            return {'mean_ms': float('nan'), 'p99_ms': float('nan'), 'max_ms': float('nan')}
+        samples = np.array(self.samples) * 1e3
+        return {'mean_ms': float(samples.mean()), 'p99_ms': float(np.percentile(samples, 99)),
+                'max_ms': float(samples.max())}
+
+
+def run_pipeline(device, args, mode):
+    shape = device.get_frame_shape()
+    number_frames = args.frames if mode == 'MultiFrame' else None
+    ring = FrameRing(shape, depth=args.ring_depth)
+    probes = ProbeSet()
+    display_latency = LatencyProbe()
+    save_latency = LatencyProbe()
+
+    consumers = [FrameConsumer(ring, lambda seq, frames: display_latency.done(ring.metadata(seq, len(frames))['host_time']),
+                               'display', lossless=False, period=args.refresh_period)]
+    writer = h5file = None
+    # sequence: blocks of frames go from the sequence buffer to the writer, as in PVcamMeasure.run_sequence
+    sequence = mode == 'MultiFrame' and args.sequence
+    if mode == 'MultiFrame':
+        import h5py
+        fname = os.path.join(args.tmpdir, f'benchmark_{os.getpid()}.h5')
+        h5file = h5py.File(fname, 'w')
+        writer = H5FrameWriter(h5file, 't0/c0/image', number_frames, shape,
+                               chunk_frames=args.chunk_frames, batch_frames=args.batch_frames,
+                               compression=args.compression)
+
+        def record(frames, meta):
+            writer.append(frames, meta)
+            save_latency.done([item[4] for item in meta])
+        if not sequence:
+            consumers.append(FrameConsumer(ring, lambda seq, frames: record(frames, ring.metadata(seq, len(frames))),
+                                           'save', lossless=True, max_count=args.batch_frames))
+
+    tracemalloc.start()
+    for consumer in consumers:
+        consumer.start()
+    t_start = time.perf_counter()
+    # the acquisition loops of PVcamMeasure.run
+    stop = (lambda: time.perf_counter() - t_start > args.duration) if mode == 'Continuous' else None
+    loop = AcquisitionLoop(device, ring, probes, stop=stop)
+    try:
+        if sequence:
+            loop.run_sequence(number_frames, record, block_frames=args.batch_frames,
+                              budget_MB=args.sequence_budget, refresh_period=args.refresh_period)
+        else:
+            loop.run_live(number_frames)
+        elapsed = time.perf_counter() - t_start
+    finally:
+        lost = device.dropped_frames # gaps in the frame counter, as for the real camera
+        device.acq_stop()
+        ring.close()
+        for consumer in consumers:
+            consumer.stop()
+    writer_stats = {}
+    if writer is not None:
+        writer_stats = writer.close()
+        h5file.close()
+        os.remove(fname)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for consumer in consumers:
+        if consumer.error is not None:
+            raise consumer.error
+    result = {'mode': mode,
+              'frame_shape': list(shape),
+              'frames_polled': loop.frames,
+              # rate at which the frames are polled from the camera buffer, without the final writer drain
+              'sustained_fps': loop.frames / loop.poll_time if loop.poll_time else 0.0,
+              'poll_s': loop.poll_time,
+              'drain_s': loop.drain_time, # sequence: wait for the writer after the last frame of each sequence
+              'total_s': elapsed,
+              'camera_lost_frames': lost,
+              'ring_overruns': ring.overruns,
+              'dropped_frames': lost + ring.overruns,
+              'overwritten_frames': device.overwritten_frames, # zero-copy leases held too long
+              'ring_high_water': ring.high_water,
+              'display_latency': display_latency.summary(),
+              'timing': probes.summary(),
+              'peak_traced_MB': peak / 1e6}
+    if writer is not None:
+        result['save_latency'] = save_latency.summary()
+        result['writer'] = writer_stats
+    return result
+
+
+def print_result(result):
+    print(f"--- {result['mode']} {result['frame_shape'][1]}x{result['frame_shape'][0]} ---")
+    print(f"  sustained fps:    {result['sustained_fps']:.1f} ({result['frames_polled']} frames polled in {result['poll_s']:.2f} s)")
+    if result['drain_s']:
+        print(f"  writer drain:     {result['drain_s']:.2f} s after the last frame (total {result['total_s']:.2f} s)")
+    print(f"  dropped frames:   {result['dropped_frames']} (camera buffer {result['camera_lost_frames']},"
+          f" ring {result['ring_overruns']}, ring high water {result['ring_high_water']})")
+    if result['overwritten_frames']:
+        print(f"  overwritten:      {result['overwritten_frames']} zero-copy frames held past the buffer wrap-around")
+    for key in ('display_latency', 'save_latency'):
+        if key in result:
+            lat = result[key]
+            print(f"  {key + ':':17} mean {lat['mean_ms']:.2f} ms, p99 {lat['p99_ms']:.2f} ms, max {lat['max_ms']:.2f} ms")
+    if 'writer' in result:
+        w = result['writer']
+        print(f"  writer:           {w['MBps']:.1f} MB/s, compression ratio {w['compression_ratio']:.2f}")
+    print(f"  peak traced mem:  {result['peak_traced_MB']:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['continuous', 'multiframe', 'both'], default='both')
+    parser.add_argument('--width', type=int, default=3200)
+    parser.add_argument('--height', type=int, default=2200)
+    parser.add_argument('--bit-depth', type=int, default=12)
+    parser.add_argument('--fps', type=float, default=30.0, help='simulated camera frame rate')
+    parser.add_argument('--frames', type=int, default=300, help='frames recorded in MultiFrame')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of Continuous acquisition')
+    parser.add_argument('--ring-depth', type=int, default=32)
+    parser.add_argument('--refresh-period', type=float, default=0.05)
+    parser.add_argument('--chunk-frames', type=int, default=1)
+    parser.add_argument('--batch-frames', type=int, default=16)
+    parser.add_argument('--compression', default='none')
+    parser.add_argument('--zero-copy', action='store_true')
+    parser.add_argument('--sequence', action='store_true', help='MultiFrame with a non-circular sequence buffer')
+    parser.add_argument('--sequence-budget', type=float, default=2048.0, help='MB of a sequence buffer')
+    parser.add_argument('--tmpdir', default=tempfile.gettempdir())
+    parser.add_argument('--json', help='also write the results to this json file')
+    args = parser.parse_args()
+
+    device = PVcamDevice(backend='simulated', sensor_size=(args.width, args.height),
+                         bit_depth=args.bit_depth, frame_rate=args.fps)
+    device.zero_copy = args.zero_copy
+    results = []
+    try:
+        modes = {'continuous': ['Continuous'], 'multiframe': ['MultiFrame'],
+                 'both': ['Continuous', 'MultiFrame']}[args.mode]
+        for mode in modes:
+            result = run_pipeline(device, args, mode)
+            print_result(result)
+            results.append(result)
+    finally:
+        device.close()
+    if resource is not None:
+        # ru_maxrss is in kB on Linux
+        print(f'max resident set size: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3:.1f} MB')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:52:40 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Dark-frame and flat-field correction: calibration maps stored on disk for each
+camera configuration (readout port, gain, binning, ROI, exposure) and applied to
+the frames with in-place operations on preallocated buffers.
+"""
+
+import os
+import time
+import numpy as np
+
+
+def default_calibration_dir():
+    # per-user data directory of the maps, outside the source tree (as SpeedTable.default_table_dir)
+    try:
+        import platformdirs
+        return platformdirs.user_data_dir('pvcam_calibration', appauthor=False)
+    except ImportError:
+        return os.path.join(os.path.expanduser('~'), '.local', 'share', 'pvcam_calibration')
+
+
+def calibration_key(readout, gain, binning, roi, exposure):
+    # file name of the calibration maps of a camera configuration; roi is (h0, v0, width, height)
+    h0, v0, width, height = roi
+    return f'port{readout}_gain{gain}_bin{binning}_roi{h0}-{v0}-{width}x{height}_exp{exposure:g}ms'
+
+
+class CalibrationStore(object):
+    """
+    Dark and flat maps saved as <directory>/<key>.npz, one file per configuration.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        # {'dark': map or None, 'flat': map or None}, or None if the configuration was never calibrated
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            return {name: data[name] if name in data.files else None for name in ('dark', 'flat')}
+
+    def save(self, key, **maps):
+        # stores the given maps (dark=..., flat=...), keeping the others already saved for key
+        stored = self.load(key) or {}
+        stored.update(maps)
+        os.makedirs(self.directory, exist_ok=True)
+        np.savez(self.path(key), **{name: data for name, data in stored.items() if data is not None})
+
+
+def average_frames(device, count):
+    # mean of count frames acquired as a sequence by a PVcamDevice, as a float32 map
+    device.acq_start_seq(count)
+    try:
+        total = None
+        for _ in range(count):
+            with device.lease_frame(zero_copy=True) as lease:
+                if total is None:
+                    total = np.zeros(lease.data.shape, np.float64)
+                total += lease.data
+    finally:
+        device.acq_stop()
+    return (total / count).astype(np.float32)
+
+
+class FrameCorrector(object):
+    """
+    corrected = (frame - dark) * flat_gain, where flat_gain = mean(flat - dark) / (flat - dark)
+    (pixels without flat signal are left uncorrected).
+    Either map can be None. dtype is float32, or uint16 (rounded and clipped to [0, 65535]).
+    correct() is not thread safe: use one corrector per thread.
+    """
+
+    def __init__(self, dark=None, flat=None, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.dtype(np.float32), np.dtype(np.uint16)):
+            raise ValueError(f'Corrected frames can be float32 or uint16, not {self.dtype}.')
+        self.offset = None if dark is None else np.asarray(dark, np.float32)
+        self.gain = None
+        if flat is not None:
+            signal = np.asarray(flat, np.float32) - (0 if self.offset is None else self.offset)
+            valid = signal > 0
+            self.gain = np.ones(signal.shape, np.float32)
+            self.gain[valid] = signal[valid].mean() / signal[valid]
+        maps = [m for m in (self.offset, self.gain) if m is not None]
+        self.shape = maps[0].shape if maps else None
+        self._buffer = np.empty((0,) + (self.shape or ()), np.float32)
+        self._out = np.empty((0,) + (self.shape or ()), self.dtype)
+        self.frames = 0
+        self.time = 0.0 # seconds spent in correct()
+
+    @property
+    def enabled(self):
+        return self.shape is not None
+
+    def correct(self, frames):
+        """
+        Returns the corrected frames (shape (n, rows, columns)) in a preallocated block
+        that is valid until the next call.
+        """
+        t0 = time.perf_counter()
+        count = len(frames)
+        if len(self._buffer) < count:
+            self._buffer = np.empty((count,) + self.shape, np.float32)
+            if self.dtype != np.float32:
+                self._out = np.empty((count,) + self.shape, self.dtype)
+        corrected = self._buffer[:count]
+        if self.offset is not None:
+            np.subtract(frames, self.offset, out=corrected)
+        else:
+            np.copyto(corrected, frames)
+        if self.gain is not None:
+            np.multiply(corrected, self.gain, out=corrected)
+        if self.dtype != np.float32:
+            np.clip(corrected, 0, np.iinfo(self.dtype).max, out=corrected)
+            np.rint(corrected, out=corrected)
+            out = self._out[:count]
+            np.copyto(out, corrected, casting='unsafe')
+            corrected = out
+        self.time += time.perf_counter() - t0
+        self.frames += count
+        return corrected
+
+    def ms_per_frame(self):
+        return self.time * 1e3 / self.frames if self.frames else 0.0
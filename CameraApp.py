@@ -11,6 +11,9 @@ To launch the program:
 """
 
 
+import time
+t_launch = time.perf_counter()
+
 from ScopeFoundry import BaseMicroscopeApp
  
 class PyVCAMapp(BaseMicroscopeApp):
@@ -20,13 +23,23 @@ class PyVCAMapp(BaseMicroscopeApp):
       
     
     def setup(self):
+        # startup_times: seconds spent in each step, printed when the GUI is ready
+        self.startup_times = {'import ScopeFoundry': time.perf_counter() - t_launch}
+        t0 = time.perf_counter()
         from CameraHW import PVcamHW
+        self.startup_times['import CameraHW'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
         self.add_hardware(PVcamHW(self))
+        self.startup_times['add hardware'] = time.perf_counter() - t0
         
         print("Adding Hardware Components")
         
+        t0 = time.perf_counter()
         from CameraMeasurement import PVcamMeasure
+        self.startup_times['import CameraMeasurement'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
         self.add_measurement(PVcamMeasure(self))
+        self.startup_times['add measurement'] = time.perf_counter() - t0
         print("Adding measurement components")
 
 
@@ -34,5 +47,9 @@ if __name__ == '__main__':
             
     import sys
     app = PyVCAMapp(sys.argv)
+    print('GUI ready in {:.2f} s: '.format(time.perf_counter() - t_launch)
+          + ', '.join('{} {:.0f} ms'.format(step, seconds * 1e3) for step, seconds in app.startup_times.items()))
+    # the camera initializes in the background (see PVcamHW.background_init) while the GUI is usable
+    app.hardware['PVcamHW'].settings['connected'] = True
     sys.exit(app.exec_())
         
@@ -5,46 +5,241 @@ Created on fri Mar 07 09:40:36 2025
 @authors: Martina Riva. Politecnico di Milano
 """
 
+import os
+import time
+import threading
 import numpy as np
-import matplotlib.pyplot as plt 
-from pyvcam import pvc
-from pyvcam.camera import Camera
-from pyvcam import constants as const
+from FramePool import FrameLease, FramePool
+from SpeedTable import load_or_discover, default_table_dir
+from FrameStream import FrameStream
+from MultiRoi import RoiLayout, check_overlaps
+# pyvcam (and matplotlib for the demo below) are imported when needed, to keep the start of the app fast
+
+# Write-through cache of the camera parameters: writing the key parameter changes
+# the value of the listed ones on the camera, so their cached values are dropped.
+CACHE_INVALIDATES = {
+    'readout_port': ('speed', 'gain', 'bit_depth', 'readout_time'), # speed table entries depend on the port
+    'speed': ('gain', 'bit_depth', 'readout_time'),
+    'gain': ('bit_depth',),
+    'binning': ('readout_time',), # frame shape is computed from the cached binning and roi
+    'roi': ('readout_time',),
+}
+
+# parameters the driver may coerce to a supported value (e.g. exposure time rounded to the
+# resolution): they are read back once after each write, so the cache holds the applied value.
+# The ROI is not cached after a write either, set_geometry and set_rois invalidate it.
+READ_BACK_PARAMS = ('exp_time', 'binning')
+
+# parameters applied by configure(), in this order: after changing `readout_port` re-apply
+# the value of `speed`, after changing `speed` re-apply the `gain` value
+CONFIG_ORDER = ['metadata_enabled', 'readout_port', 'speed_table_index', 'speed', 'gain',
+                'binning', 'exp_time', 'exp_mode']
+
+# configuration written when the camera is opened
+DEFAULT_CONFIG = {
+    'metadata_enabled': True,
+    'binning': (1, 1), #a tuple for the binning (x, y)
+    'exp_time': 20, #exposure time in ms
+    'readout_port': 0, # 0- Speed; 1- Long Exposure; 2- Long Exposure EDR (Extended Dynamic Range)
+    'speed_table_index': 0,
+    'speed': 0, #always 0 for different readout ports
+    'gain': 1, # 1-Full Well; 2-Sensitivity (for readout 1 and 2); only 1-Dynamic Range (for readout 0)
+    'exp_mode': 'Internal Trigger', #trigger mode: 'Internal Trigger', 'Edge Trigger', 'Trigger First', 'Software Trigger Edge', 'Software Trigger First'
+}
+DEFAULT_BINNINGS = [1, 2, 4] # used when the camera does not enumerate its binnings
 
 class PVcamDevice(object):
     """
     Scopefoundry compatible class to run PVCAM cameras
     """
     #camera initialization 
-    def __init__(self):
-
+    def __init__(self, backend='pvcam', progress=None, table_dir=None, **sim_options):
+        # backend: 'pvcam' for the real camera, 'simulated' for CameraSim.SimCamera,
+        # configured with sim_options (sensor_size, bit_depth, frame_rate, ...), 'playback' for
+        # CameraPlayback.PlaybackCamera (sim_options: path, playback_speed, loop, memmap)
+        # progress: optional function called with (message, fraction) during the initialization;
+        # the duration of each step is stored in self.startup_times (seconds)
+        # table_dir: directory of the cached port/speed/gain tables (default: the per-user cache
+        # directory of SpeedTable.default_table_dir); the tables of the simulated and playback
+        # cameras are only saved if table_dir is given
+        self.table_dir = table_dir or (default_table_dir() if backend == 'pvcam' else None)
+        self.speed_table = None # SpeedTable of the camera, see load_speed_table
+        self.speed_table_source = None # 'cache' or 'camera'
+        self._cache = {} # camera parameters read or written through _read_param/_write_param
+        self.exp_unit_ms = 1.0 # unit of the camera exp_time in ms, see set_exposure_resolution
+        self._cache_lock = threading.RLock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.driver_calls = 0
+        self.driver_time = 0.0 # seconds spent in PVCAM get/set calls made by the cache
+
+        self.zero_copy = False # if True, lease_frame returns views of the PVCAM buffer instead of copies
+        self._lease = None # last frame handed out by lease_frame
+        self.frame_pool = None # preallocated frames for leased frames that must be kept, see keep_frame
+        self.frame_pool_size = 8
+        self.reconfig_time = 0.0 # duration of the last set_geometry, in seconds
+        self.roi_layout = None # RoiLayout of the tiled frames when several ROIs are acquired, see set_rois
+        self._tile = None # tiled frame reused by zero-copy leases of multi-ROI frames
+        self._max_rois = None
+        self._binnings = None
+        self.number_frames = 1 # frames of a sequence, see set_framenum
+        # depth of the live circular buffer: fixed buffer_frames, or (buffer_auto) enough frames
+        # for buffer_slack_ms of acquisition, limited to buffer_max_MB
+        self.buffer_frames = 16
+        self.buffer_auto = True
+        self.buffer_slack_ms = 500.0
+        self.buffer_max_MB = 1024.0
+        self.overrun_callbacks = [] # functions called with (lost_frames, frame_number) when frames are lost
+        self.acquiring = False
+        self._live_depth = None # depth of the live circular buffer, None in sequence mode
+        self._live_period = None # shortest frame period of the live acquisition (s)
+        self.reset_frame_counters()
+        self.startup_times = {}
+        self._open(backend, progress, sim_options)
+
+    def _open(self, backend, progress, sim_options):
         #better to avoid:  __init__ The Camera's constructor. Note that this method 
         # should not be used in the construction of a Camera. Instead, use the detect_camera 
         # class method to generate Camera classes of the currently available cameras connected.
+        steps = ['import', 'init_pvcam', 'detect', 'open', 'speed_table', 'configure']
+
+        def step(name, t0):
+            self.startup_times[name] = time.perf_counter() - t0
+            if progress is not None:
+                progress(name, (steps.index(name) + 1) / len(steps))
+            return time.perf_counter()
+
+        t0 = time.perf_counter()
+        if backend == 'simulated':
+            import CameraSim
+            self.pvc = self.const = CameraSim
+            camera_class = CameraSim.SimCamera
+        elif backend == 'playback':
+            import CameraSim
+            import CameraPlayback
+            self.pvc = self.const = CameraSim
+            camera_class = CameraPlayback.PlaybackCamera
+        elif backend == 'pvcam':
+            try:
+                from pyvcam import pvc
+                from pyvcam import constants
+                from pyvcam.camera import Camera
+            except ImportError:
+                raise ImportError('pyvcam is not installed: only the simulated backend is available.')
+            self.pvc = pvc
+            self.const = constants
+            camera_class = Camera
+            sim_options = {}
+        else:
+            raise ValueError(f"Unknown backend {backend}, choose 'pvcam', 'simulated' or 'playback'.")
+        self.backend = backend
+        t0 = step('import', t0)
 
         #library initialization
-        pvc.init_pvcam() 
-        self.cam= next(Camera.detect_camera()) # Use generator to find first camera.  
+        self.pvc.init_pvcam() 
+        t0 = step('init_pvcam', t0)
+        self.cam= next(camera_class.detect_camera(**sim_options)) # Use generator to find first camera.  
         #alternative: self.cam=Camera.detect_camera()[0]
+        t0 = step('detect', t0)
         self.cam.open() 
-        self.cam.metadata_enabled = True
-        self.cam.binning = (1,1) #a tuple for the binning (x, y)
-        self.cam.exp_time = 20 #exposure time in ms 
-        self.cam.readout_port = 0 # 0- Speed; 1- Long Exposure; 2- Long Exposure EDR (Extended Dynamic Range)
-        self.cam.speed_table_index = 0
-        self.cam.speed = 0 #always 0 for different readout ports
-        self.cam.gain =  1 # 1-Full Well; 2-Sensitivity (for readout 1 and 2); only 1-Dynamic Range (for readout 0) 
-        self.cam.exp_mode = 'Internal Trigger' #trigger mode: 'Internal Trigger', 'Edge Trigger', 'Trigger First', 'Software Trigger Edge', 'Software Trigger First'
+        self.set_exposure_resolution()
+        t0 = step('open', t0)
+        self.load_speed_table()
+        t0 = step('speed_table', t0)
+        config = dict(DEFAULT_CONFIG)
+        config.update(self.speed_table.readout_config(config['readout_port'], gain=config['gain']))
+        self.configure(**config)
         #readoutSpeed
-        self.cam.roi = [0,0,3200,2200]
+        self.cam.roi = [0, 0, self.cam.sensor_size[0], self.cam.sensor_size[1]] # full sensor, [0,0,3200,2200] for Retiga E7
+        step('configure', t0)
+
+    def configure(self, **params):
+        '''
+        Applies several camera parameters (Camera property names) in one step, in the order
+        of CONFIG_ORDER, skipping those whose cached value is already the requested one.
+        The written values stay in the cache (those of READ_BACK_PARAMS as applied by the camera),
+        so reading them back costs no PVCAM call.
+        Returns the number of parameters written. exp_time is given in ms, as to set_exposure.
+        '''
+        unknown = set(params) - set(CONFIG_ORDER)
+        if unknown:
+            raise ValueError(f'Unknown parameters {sorted(unknown)}, choose among {CONFIG_ORDER}.')
+        if 'exp_time' in params:
+            params['exp_time'] = self.exposure_units(params['exp_time'])
+        written = 0
+        with self._cache_lock:
+            for name in CONFIG_ORDER:
+                if name not in params:
+                    continue
+                if name in self._cache and self._cache[name] == params[name]:
+                    continue
+                self._write_param(name, params[name])
+                written += 1
+        return written
+
+    def _read_param(self, name):
+        # cached read of the Camera property name: only a miss turns into a PVCAM get_param call
+        with self._cache_lock:
+            if name in self._cache:
+                self.cache_hits += 1
+                return self._cache[name]
+            self.cache_misses += 1
+            t0 = time.perf_counter()
+            value = getattr(self.cam, name)
+            self.driver_calls += 1
+            self.driver_time += time.perf_counter() - t0
+            self._cache[name] = value
+            return value
+
+    def _write_param(self, name, value):
+        # writes the Camera property name and keeps the written value (the applied one for
+        # READ_BACK_PARAMS) in the cache
+        with self._cache_lock:
+            t0 = time.perf_counter()
+            setattr(self.cam, name, value)
+            self.driver_calls += 1
+            if name in READ_BACK_PARAMS:
+                value = getattr(self.cam, name)
+                self.driver_calls += 1
+            self.driver_time += time.perf_counter() - t0
+            self.invalidate_cache(name)
+            self._cache[name] = value
+
+    def invalidate_cache(self, name=None):
+        # drops the parameters depending on name (all the cached values if name is None)
+        with self._cache_lock:
+            if name is None:
+                self._cache.clear()
+                return
+            for dependent in CACHE_INVALIDATES.get(name, ()):
+                if self._cache.pop(dependent, None) is not None:
+                    self.invalidate_cache(dependent)
+
+    def cache_stats(self):
+        with self._cache_lock:
+            calls = self.driver_calls
+            return {'hits': self.cache_hits,
+                    'misses': self.cache_misses,
+                    'driver_calls': calls,
+                    'driver_ms': self.driver_time * 1e3,
+                    'driver_ms_per_call': self.driver_time * 1e3 / calls if calls else 0.0}
+
+    def get_cache_hits(self):
+        return self.cache_hits
+
+    def get_cache_misses(self):
+        return self.cache_misses
+
+    def get_driver_ms_per_call(self):
+        return self.cache_stats()['driver_ms_per_call']
 
     def get_trigger_mode(self):
-        mode = self.cam.exp_mode
+        mode = self._read_param('exp_mode')
         return(mode)
 
 
     def set_trigger_mode(self, mode):
-        self.cam.exp_mode = mode
+        self._write_param('exp_mode', mode)
         '''
         _acquisition_mode is a private attribute and there is no built-in function to get it. Its values are 'Live' or 'Sequence'.
         what I am doing here is setting the exposure mode/trigger mode. Its values are 'Internal Trigger', 'Edge Trigger', 'Trigger First', 
@@ -61,7 +256,7 @@ class PVcamDevice(object):
         '''
     
     def set_framenum(self, Nframes): #do I have to introduce another setting?
-        pass
+        self.number_frames = Nframes # default length of acq_start_seq
                     
     def get_temperature(self):
         return self.cam.temp
@@ -71,68 +266,167 @@ class PVcamDevice(object):
     #if we need we can also set the setpoint temperature
 
     def get_width(self): # sensor size, not ROI size
-        return self.cam.sensor_size[0]
+        return self._read_param('sensor_size')[0]
     
     def get_height(self): #sensor size, not ROI size 
-        return self.cam.sensor_size[1]
+        return self._read_param('sensor_size')[1]
     
     def get_binning(self):
-        return self.cam.binning[0] #returns the x binning value (we assume not to use different binning values for x and y)
+        return self._read_param('binning')[0] #returns the x binning value (we assume not to use different binning values for x and y)
     
     def set_binning(self, desired_binning):
-        # desired_binning is a tuple (x, y) or a single value for square binning
-        if isinstance(desired_binning, tuple):
-            if len(desired_binning) != 2:
+        # desired_binning is a tuple (x, y) or a single value for square binning; multiple ROIs are kept
+        if self.roi_layout is not None:
+            return self.set_rois(self.roi_layout.rois, desired_binning)
+        roi = self.cam.roi
+        return self.set_geometry(roi[0], roi[1], roi[2], roi[3], desired_binning)
+
+    def validate_geometry(self, h0, v0, width, height, binning):
+        # raises ValueError if the ROI does not fit in the sensor or is not aligned to the binning
+        if isinstance(binning, tuple):
+            if len(binning) != 2:
                 raise ValueError('Shape must be a tuple of (binning_x, binning_y).')
-            binning_x, binning_y = desired_binning
+            binning_x, binning_y = binning
         else:
-            binning_x = binning_y = desired_binning
+            binning_x = binning_y = binning
+        sensor_width, sensor_height = self._read_param('sensor_size')
+        if width <= 0 or height <= 0 or h0 < 0 or v0 < 0:
+            raise ValueError(f'Invalid ROI ({h0}, {v0}, {width}, {height}).')
+        if h0 + width > sensor_width or v0 + height > sensor_height:
+            raise ValueError(f'ROI ({h0}, {v0}, {width}, {height}) exceeds the sensor size ({sensor_width}, {sensor_height}).')
+        if width % binning_x or h0 % binning_x or height % binning_y or v0 % binning_y:
+            raise ValueError(f'ROI ({h0}, {v0}, {width}, {height}) is not aligned to the binning ({binning_x}, {binning_y}).')
+        return (binning_x, binning_y)
+
+    def set_geometry(self, h0, v0, width, height, binning=None):
+        '''
+        Validates ROI and binning together and applies them to the camera in a single step,
+        so that no invalid intermediate geometry is ever sent to PVCAM.
+        binning: tuple (x, y) or single value; None keeps the current binning.
+        Returns the new frame shape (rows, columns); the time taken is stored in self.reconfig_time.
+        '''
+        t0 = time.perf_counter()
+        if binning is None:
+            binning = self._read_param('binning')
+        binning = self.validate_geometry(h0, v0, width, height, binning)
+        self.cam.metadata_enabled = True
+        if binning != self._read_param('binning'):
+            self._write_param('binning', binning)
+        self.cam.reset_rois() #reset ROI to full sensor size before setting a new one
+        self.cam.set_roi(h0, v0, width, height)
+        self.cam.roi = [h0, v0, width, height]
+        self.roi_layout = None
+        self.invalidate_cache('roi')
+        self.reconfig_time = time.perf_counter() - t0
+        return self.get_frame_shape()
+
+    def get_max_rois(self):
+        # ROIs the camera can acquire in one exposure (PARAM_ROI_COUNT), 1 if it does not report it
+        if self._max_rois is None:
+            try:
+                self._max_rois = int(self.cam.get_param(self.const.PARAM_ROI_COUNT, self.const.ATTR_MAX))
+            except Exception:
+                self._max_rois = 1
+        return self._max_rois
+
+    def get_binnings(self):
+        # square binnings supported by the camera (PARAM_BINNING_SER and PARAM_BINNING_PAR)
+        if self._binnings is None:
+            try:
+                serial = set(self.cam.read_enum(self.const.PARAM_BINNING_SER).values())
+                parallel = set(self.cam.read_enum(self.const.PARAM_BINNING_PAR).values())
+                self._binnings = sorted(int(value) for value in serial & parallel) or DEFAULT_BINNINGS
+            except Exception:
+                self._binnings = DEFAULT_BINNINGS
+        return self._binnings
+
+    def set_rois(self, rois, binning=None):
+        '''
+        Acquires several ROIs [(h0, v0, width, height)] in one exposure, on the cameras that
+        support it (get_max_rois); only the rows and columns of the ROIs are read out.
+        The ROIs of each frame are packed in one tiled frame described by self.roi_layout
+        (see MultiRoi.RoiLayout). A single ROI is the same as set_geometry.
+        binning: tuple (x, y) or single value, common to all the ROIs; None keeps the current binning.
+        Returns the shape of the tiled frames.
+        '''
+        rois = [tuple(int(value) for value in roi) for roi in rois]
+        if not rois:
+            raise ValueError('At least one ROI is required.')
+        if len(rois) == 1:
+            return self.set_geometry(*rois[0], binning)
+        if len(rois) > self.get_max_rois():
+            raise ValueError(f'{len(rois)} ROIs requested, the camera acquires at most {self.get_max_rois()} ROIs.')
+        t0 = time.perf_counter()
+        if binning is None:
+            binning = self._read_param('binning')
+        for roi in rois:
+            binning = self.validate_geometry(*roi, binning)
+        check_overlaps(rois)
+        self.cam.metadata_enabled = True # PVCAM returns the ROIs of a frame separately only with metadata
+        if binning != self._read_param('binning'):
+            self._write_param('binning', binning)
+        self.cam.reset_rois()
+        for roi in rois:
+            self.cam.set_roi(*roi)
+        self.roi_layout = RoiLayout(rois, binning)
+        self.cam.roi = list(self.roi_layout.bounding_box())
+        self._tile = None
+        self.invalidate_cache('roi')
+        self.reconfig_time = time.perf_counter() - t0
+        return self.get_frame_shape()
+
+    def get_rois(self):
+        if self.roi_layout is not None:
+            return list(self.roi_layout.rois)
+        return [tuple(self.cam.roi)]
+
+    def tile_frame(self, pixel_data, reuse=False):
+        # packs the ROIs of a multi-ROI frame into one tiled frame (a single copy out of the PVCAM buffer);
+        # with reuse the same tiled frame is returned at each call
+        if not reuse:
+            return self.roi_layout.pack(pixel_data)
+        if self._tile is None:
+            self._tile = self.roi_layout.empty()
+        return self.roi_layout.pack(pixel_data, self._tile)
 
-        self.cam.binning = (binning_x, binning_y)
-            
     def set_roi(self, h0, v0, width, height):
         #h0, v0 are the coordinates of the top/bottom left corner of the ROI
         #width, height are the dimensions of the ROI
-        self.cam.metadata_enabled = True
-        self.cam.reset_rois() #reset ROI to full sensor size before setting a new one
-        self.cam.set_roi(h0, v0, width, height)  
-        self.cam.roi = (h0, v0, width, height)
+        self.set_geometry(h0, v0, width, height)
     
     def setSubarrayH(self, width):
-        self.cam.metadata_enabled = True
-        h0=self.cam.roi[0]
-        v0=self.cam.roi[1]
-        self.cam.roi[2]=width
-        height=self.cam.roi[3]
-        self.cam.set_roi(h0, v0, width, height)  
+        h0, v0, _, height = self.cam.roi
+        self.set_geometry(h0, v0, width, height)
 
     def setSubarrayHpos(self, h0):
-        self.cam.metadata_enabled = True
-        self.cam.roi[0]= h0
-        v0=self.cam.roi[1]
-        width=self.cam.roi[2]
-        height=self.cam.roi[3]
-        self.cam.set_roi(h0, v0, width, height)  
+        _, v0, width, height = self.cam.roi
+        self.set_geometry(h0, v0, width, height)
 
     def setSubarrayV(self, height):
-        self.cam.metadata_enabled = True
-        h0=self.cam.roi[0]
-        v0=self.cam.roi[1]
-        width=self.cam.roi[2]
-        self.cam.roi[3]= height
-        self.cam.set_roi(h0, v0, width, height)  
+        h0, v0, width, _ = self.cam.roi
+        self.set_geometry(h0, v0, width, height)
 
     def setSubarrayVpos(self, v0):
-        self.cam.metadata_enabled = True
-        h0=self.cam.roi[0]
-        self.cam.roi[1]= v0
-        width=self.cam.roi[2]
-        height=self.cam.roi[3]
-        self.cam.set_roi(h0, v0, width, height)  
+        h0, _, width, height = self.cam.roi
+        self.set_geometry(h0, v0, width, height)
 
 
     def get_roi(self):
         return(self.cam.roi)
+
+    def get_frame_shape(self):
+        # (rows, columns) of the frames returned by get_nparray for the current ROI and binning
+        if self.roi_layout is not None:
+            return self.roi_layout.shape
+        bin_x, bin_y = self._read_param('binning')
+        return (self.cam.roi[3] // bin_y, self.cam.roi[2] // bin_x)
+
+    def get_frame_pixels(self):
+        # pixels read out for each frame: with multiple ROIs those of the ROIs, not of the tiled frame
+        if self.roi_layout is not None:
+            return self.roi_layout.pixels()
+        height, width = self.get_frame_shape()
+        return height * width
     
     def getSubarrayH(self):
         return self.cam.roi[2]  #width of the ROI
@@ -149,50 +443,214 @@ class PVcamDevice(object):
     def getParam(self, param_ID):
         return self.cam.get_param(param_ID)
 
+    def set_exposure_resolution(self):
+        # exposure times are written in microseconds if the camera supports it, so that the frame
+        # rate is not limited to 1000/n Hz; get_exposure and set_exposure stay in ms
+        self.exp_unit_ms = 1.0
+        try:
+            resolutions = self.cam.exp_resolutions
+        except (AttributeError, RuntimeError):
+            return # the camera has a single resolution, ms
+        if self.const.EXP_RES_ONE_MICROSEC in resolutions.values():
+            self.cam.exp_res = self.const.EXP_RES_ONE_MICROSEC
+            self.exp_unit_ms = 1e-3
+            self.invalidate_cache()
+
+    def exposure_units(self, time_ms):
+        # exposure time in ms -> integer exp_time in the resolution of the camera
+        return int(round(time_ms / self.exp_unit_ms))
+
     def get_exposure(self):
-        return self.cam.exp_time 
+        return self._read_param('exp_time') * self.exp_unit_ms # ms
 
     def set_exposure(self, desired_time): 
-        self.cam.exp_time = desired_time
+        self._write_param('exp_time', self.exposure_units(desired_time))
 
 
     def get_rate(self):
-        pass
+        # frame rate (Hz) of the free running camera with the current exposure, ROI, binning and readout port
+        return 1e3 / self.get_frame_period_ms()
+
+    def get_max_rate(self):
+        # highest frame rate with the current ROI, binning and readout port: exposure not longer than the readout
+        # (and not shorter than the exposure resolution)
+        exposure_range = self.get_exposure_range()
+        min_exposure = exposure_range[0] if exposure_range else 0
+        return 1e3 / max(self.get_readout_time() * 1e-3, min_exposure, self.exp_unit_ms)
 
     def set_rate(self, desired_framerate):
-        pass
+        '''
+        PVCAM has no frame rate parameter: with Internal Trigger and overlapped readout the
+        frame period is the longest of exposure and readout time, so the rate is set through
+        the exposure time, rounded to the exposure resolution of the camera (us or ms).
+        Returns the rate actually set. Raises ValueError above get_max_rate.
+        '''
+        if self.get_trigger_mode() != 'Internal Trigger':
+            raise ValueError('The frame rate can only be set in Internal Trigger mode.')
+        max_rate = self.get_max_rate()
+        if desired_framerate <= 0 or desired_framerate > max_rate * 1.001:
+            raise ValueError(f'Frame rate {desired_framerate} Hz is not achievable, the maximum is {max_rate:.2f} Hz '
+                             f'with the current ROI, binning and readout port.')
+        exposure = 1e3 / desired_framerate
+        exposure_range = self.get_exposure_range()
+        if exposure_range is not None:
+            exposure = min(max(exposure, exposure_range[0]), exposure_range[1])
+        self.set_exposure(exposure)
+        return self.get_rate()
+
+    def get_data_rate(self):
+        # MB/s produced by the camera at get_rate
+        return self.get_frame_pixels() * 2 * self.get_rate() / 1e6
 
     def get_gain(self):
-        return self.cam.gain
+        return self._read_param('gain')
 
     def set_gain(self, desired_gain):
-        self.cam.gain = desired_gain
+        valid = [value for _, value in self.get_gains()]
+        if desired_gain not in valid:
+            raise ValueError(f'Gain {desired_gain} is not available for readout port '
+                             f'{self.get_readout()}, choose among {valid}.')
+        self._write_param('gain', desired_gain)
 
     def get_readout(self):
-        return self.cam.readout_port
+        return self._read_param('readout_port')
 
     def set_readout(self, desired_readout):
-         # When changing anything in speed table it is strongly recommended to set
+        # When changing anything in speed table it is strongly recommended to set
         # all 3 properties (readout_port, speed, gain) in predefined order.
-        # After changing `readout_port` re-apply the value of `speed`.
-        # After changing `speed` re-apply the `gain` value.
-        self.cam.readout_port = desired_readout
-        self.cam.speed = 0
-        self.cam.gain = 1 #reset to default gain (exists for all readout modes)
+        # The speed table gives the fastest speed of the port and whether the current gain
+        # exists there (otherwise the first gain of the port is used); writing the port drops
+        # speed and gain from the cache, so configure() re-applies both.
+        self.configure(**self.speed_table.readout_config(desired_readout, gain=self._read_param('gain')))
+
+    def load_speed_table(self, refresh=False):
+        '''
+        Loads the port/speed/gain table of the camera from the cache in self.table_dir,
+        or enumerates it from the camera (refresh=True forces it) and caches it.
+        Enumerating switches through the readout ports, so the parameter cache is dropped.
+        '''
+        def exposure_range(cam):
+            # in ms, the limits are given in the exposure resolution
+            return (cam.get_param(self.const.PARAM_EXPOSURE_TIME, self.const.ATTR_MIN) * self.exp_unit_ms,
+                    cam.get_param(self.const.PARAM_EXPOSURE_TIME, self.const.ATTR_MAX) * self.exp_unit_ms)
+        self.speed_table, self.speed_table_source = load_or_discover(self.cam, self.table_dir,
+                                                                     exposure_range, refresh)
+        if self.speed_table_source == 'camera':
+            self.invalidate_cache()
+        return self.speed_table
+
+    def get_gains(self):
+        # [(name, value)] of the gains of the current readout port and speed
+        return self.speed_table.gains(self._read_param('readout_port'), self._read_param('speed'))
+
+    def get_exposure_range(self):
+        # (min, max) exposure in ms of the current readout port, None if unknown
+        return self.speed_table.exposure_range(self._read_param('readout_port'))
 
         
     def get_idname(self):
         return self.cam.name
 
     
-    def acq_start(self):
-        self.cam.start_live()       
-        #circular buffer with 16 frames by default
+    def get_zero_copy(self):
+        return self.zero_copy
+
+    def set_zero_copy(self, zero_copy):
+        self.zero_copy = zero_copy
+
+    def get_readout_time(self):
+        return self._read_param('readout_time') # us
+
+    def live_buffer_frames(self, slack_ms=None, max_MB=None, min_frames=2):
+        '''
+        Number of frames of a live buffer that holds slack_ms of acquisition at the current
+        frame rate, limited to max_MB of memory. The frame period is estimated as the longest of
+        exposure and readout time (overlapped readout), which errs towards a deeper buffer.
+        '''
+        slack_ms = self.buffer_slack_ms if slack_ms is None else slack_ms
+        max_MB = self.buffer_max_MB if max_MB is None else max_MB
+        cap = int(max_MB * 1e6 // (self.get_frame_pixels() * 2))
+        return max(min_frames, min(int(np.ceil(slack_ms / self.get_frame_period_ms())), cap))
+
+    def get_frame_period_ms(self):
+        # shortest frame period: the longest of exposure and readout time (overlapped readout)
+        return max(self.get_exposure(), self.get_readout_time() * 1e-3, 1e-3)
+
+    def get_buffer_frames(self):
+        if self.buffer_auto:
+            return self.live_buffer_frames()
+        return self.buffer_frames
+
+    def set_buffer_frames(self, frames):
+        self.buffer_frames = frames
+
+    def get_buffer_MB(self):
+        return self.get_buffer_frames() * self.get_frame_pixels() * 2 / 1e6
+
+    def acq_start(self, buffer_frame_count=None):
+        # live acquisition in a circular buffer of buffer_frame_count frames (None: get_buffer_frames)
+        if buffer_frame_count is None:
+            buffer_frame_count = self.get_buffer_frames()
+        self.reset_frame_counters()
+        self._live_depth = buffer_frame_count
+        self._live_period = self.get_frame_period_ms() * 1e-3
+        self.cam.start_live(buffer_frame_count=buffer_frame_count)
+        self.acquiring = True
         #not necessary to specify the exposure time since it has been set
 
 
-    def acq_start_seq(self, number_frames):
+    def acq_start_seq(self, number_frames=None, reset_counters=True):
+        # reset_counters=False keeps counting dropped frames across consecutive sequences
+        if number_frames is None:
+            number_frames = self.number_frames
+        if reset_counters:
+            self.reset_frame_counters()
+        else:
+            self.last_frame_number = 0 # frame numbers restart from 1 with each sequence
+        self._live_depth = None # the sequence buffer is not reused: zero-copy frames are never overwritten
         self.cam.start_seq(num_frames=number_frames) #non-circular buffer acquisition.
+        self.acquiring = True
+
+    def reset_frame_counters(self):
+        self.last_frame_number = 0 # PVCAM frame numbers start from 1
+        self.dropped_frames = 0 # gaps in the PVCAM frame counter since the acquisition started
+        self.overrun_events = 0 # number of gaps
+        self.overwritten_frames = 0 # zero-copy leases held until the live buffer could reuse their slot
+
+    def get_dropped_frames(self):
+        return self.dropped_frames
+
+    def get_overwritten_frames(self):
+        return self.overwritten_frames
+
+    def get_overrun_events(self):
+        return self.overrun_events
+
+    def frame_metadata(self, frame, frame_count):
+        '''
+        Returns the metadata of a polled frame as a tuple in the order of FrameRing.META_DTYPE:
+        (frame_number, timestamp_bof, timestamp_eof, exposure_time, host_time).
+        Timestamps and exposure are in ns and are 0 if metadata_enabled is False.
+        Gaps in the frame number are counted in self.dropped_frames.
+        '''
+        header = (frame.get('meta_data') or {}).get('frame_header')
+        if header:
+            frame_number = header.get('frameNr', frame_count)
+            ts_res = header.get('timestampResNs', 1)
+            exp_res = header.get('exposureTimeResNs', 1)
+            meta = (frame_number, header.get('timestampBOF', 0) * ts_res, header.get('timestampEOF', 0) * ts_res,
+                    header.get('exposureTime', 0) * exp_res, time.time())
+        else:
+            frame_number = frame_count
+            meta = (frame_number, 0, 0, 0, time.time())
+        if self.last_frame_number is not None and frame_number > self.last_frame_number + 1:
+            lost = frame_number - self.last_frame_number - 1
+            self.dropped_frames += lost
+            self.overrun_events += 1
+            for callback in self.overrun_callbacks:
+                callback(lost, frame_number)
+        self.last_frame_number = frame_number
+        return meta
            
            
     def get_nparray(self):
@@ -207,16 +665,83 @@ class PVcamDevice(object):
         #Note: To improve performance nd decrease memory usage, the argument copyData (bool) can be set to False (default
         #us True): returned numpy frames will contain a copy of image data. Without this copy, the numpy 
         #frame image data will point directly to the underlying frame buffer used by PVCAM.Be casreful when 
+        if self.roi_layout is not None:
+            return self.tile_frame(frame['pixel_data'])
         return frame['pixel_data']
+
+    def lease_frame(self, zero_copy=None, timeout_ms=-1):
+        '''
+        Returns the oldest frame in the camera buffer as a FrameLease.
+        With zero_copy the frame is not copied out of the PVCAM buffer: lease.data
+        is valid until lease.release(), which must be called before the next lease_frame.
+        Use keep_frame(lease) to keep a copy of the frame after the release.
+        Zero copy is always safe in sequence mode. In live mode PVCAM reuses the slot of the
+        frame once the circular buffer wraps around, whether or not the lease is released: a
+        lease held past the estimate of that time (see overwrite_deadline) is flagged as lease.overwritten on
+        release and counted in self.overwritten_frames.
+        zero_copy=None uses self.zero_copy.
+        timeout_ms: maximum wait for the frame (-1: forever), then PVCAM raises RuntimeError.
+        '''
+        if zero_copy is None:
+            zero_copy = self.zero_copy
+        if self._lease is not None and not self._lease.released:
+            raise RuntimeError(f'Frame {self._lease.frame_count} must be released before leasing a new frame.')
+        # multiple ROIs are copied once, from the PVCAM buffer into the tiled frame
+        multi_roi = self.roi_layout is not None
+        frame, fps, frame_count = self.cam.poll_frame(timeout_ms=timeout_ms, copyData=not (zero_copy or multi_roi))
+        poll_time = time.perf_counter()
+        data = self.tile_frame(frame['pixel_data'], reuse=zero_copy) if multi_roi else frame['pixel_data']
+        meta = self.frame_metadata(frame, frame_count)
+        deadline = None
+        if zero_copy and not multi_roi and self._live_depth is not None:
+            deadline = self.overwrite_deadline(poll_time)
+        self._lease = FrameLease(data, frame_count, zero_copy, meta=meta, fps=fps,
+                                 deadline=deadline, on_overwritten=self._lease_overwritten)
+        return self._lease
+
+    def overwrite_deadline(self, poll_time):
+        '''
+        Estimate (time.perf_counter()) of when the live circular buffer may reuse the slot of a
+        frame polled without copy at poll_time: the camera writes frame F + depth into the slot
+        of frame F after depth - 1 more frame periods (exposure/readout, get_frame_period_ms).
+        Host time only, since the camera timestamps have an unknown offset from the host clock.
+        The estimate is late when the poll lags behind the camera (frames already queued
+        in the buffer), so a lease released before it can still have been overwritten.
+        '''
+        return poll_time + (self._live_depth - 1) * self._live_period
+
+    def _lease_overwritten(self, lease):
+        self.overwritten_frames += 1
+
+    def stream(self, frames=None, mode=None, batch=None, timeout=None, on_timeout='raise', reuse_buffer=False):
+        '''
+        FrameStream over a new acquisition, started by `with` (or `async with`) and stopped at its end:
+            with camera.stream(frames=100, batch=8, timeout=1.0) as stream:
+                for frames, meta in stream:
+                    ...
+        See FrameStream for the options.
+        '''
+        return FrameStream(self, frames, mode, batch, timeout, on_timeout, reuse_buffer)
+
+    def keep_frame(self, lease):
+        # copies a leased frame (once) into the frame pool; the returned PooledFrame must be released
+        data = lease.data
+        if self.frame_pool is None or self.frame_pool.shape != data.shape or self.frame_pool.dtype != data.dtype:
+            self.frame_pool = FramePool(data.shape, data.dtype, self.frame_pool_size)
+        return lease.keep(self.frame_pool)
     
     def acq_stop(self):
         # Ends a previously started live or sequence acquisition.
-        self.cam.finish()
+        if self._lease is not None:
+            self._lease.release() # the PVCAM buffer is freed by finish()
+        if self.acquiring:
+            self.cam.finish()
+            self.acquiring = False
 
 
     def close(self):
         self.cam.close() #Closes the camera.
-        pvc.uninit_pvcam() #uninitialize the PVCAM library
+        self.pvc.uninit_pvcam() #uninitialize the PVCAM library
 
 #USE ONLY START_SEQ AND POLL_FRAME FOR SEQUENTIAL ACQUISITION
 
@@ -244,6 +769,7 @@ class PVcamDevice(object):
 
        
 if __name__ == '__main__':  
+    import matplotlib.pyplot as plt 
     
     try:
         camera=PVcamDevice()
@@ -254,7 +780,8 @@ if __name__ == '__main__':
         plt.figure()
         plt.imshow(image, cmap='gray')
         plt.show()
-        # print('Readout time [us] is:',camera.cam.get_param(const.PARAM_READOUT_TIME))
+        print('Readout time [us] is:', camera.get_readout_time())
+        print('Frame rate [Hz] is:', camera.get_rate(), 'maximum:', camera.get_max_rate())
         print('Acquisition mode is:', camera.get_trigger_mode())
         print('Exposure time [ms] is:',camera.get_exposure())
         print('Temperature [°C] is:',camera.get_temperature())
@@ -298,7 +825,7 @@ if __name__ == '__main__':
         plt.figure()    
         plt.imshow(image, cmap='gray')
         plt.show()
-        # print('Readout time [us] is:',camera.cam.get_param(const.PARAM_READOUT_TIME))
+        print('Readout time [us] is:', camera.get_readout_time())
 
         # #Reading parameters
         # print('Camera info:',camera.getParam(const.PARAM_PRODUCT_NAME)
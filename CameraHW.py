@@ -6,14 +6,42 @@ Created on Tue Mar 11 08:40:36 2025
 """
 
 from ScopeFoundry import HardwareComponent
+from qtpy import QtCore
+from contextlib import contextmanager
+import threading
+import time
 # from PVCAM_ScopeFoundry.CameraDevice import PVcamDevice
-from CameraDevice import PVcamDevice
+from CameraDevice import PVcamDevice, DEFAULT_BINNINGS
+from MultiRoi import parse_rois, format_rois, snap_roi
 
 class PVcamHW(HardwareComponent):
     name = 'PVcamHW'
+    # emitted by the init thread with the new device: the settings are connected in the GUI thread
+    camera_created = QtCore.Signal(object, float)
     
     def setup(self):
         # create Settings (aka logged quantities)    
+        self.backend = self.settings.New(name='backend', dtype=str, initial='pvcam',
+                                         choices=['pvcam', 'simulated', 'playback'],
+                                         description='simulated: offline camera (CameraSim); playback: frames of '
+                                                     'playback_file (CameraPlayback). Set before connecting')
+        # playback backend: a recording replayed through the whole pipeline
+        self.playback_file = self.settings.New(name='playback_file', dtype='file', initial='',
+                                               description='HDF5 (t0/c0/image) or multipage TIFF recording')
+        self.playback_speed = self.settings.New(name='playback_speed', dtype=float, initial=1.0, vmin=0,
+                                                description='1: recorded frame rate, N: N times faster, '
+                                                            '0: as fast as the frames are polled')
+        self.playback_loop = self.settings.New(name='playback_loop', dtype=bool, initial=True)
+        self.playback_memmap = self.settings.New(name='playback_memmap', dtype=bool, initial=True,
+                                                 description='Read the frames through a memory map of the file')
+        self.background_init = self.settings.New(name='background_init', dtype=bool, initial=True,
+                                                 description='Initialize the camera in a background thread on connect')
+        self.init_progress = self.settings.New(name='init_progress', dtype=float, ro=True, initial=0, unit='%')
+        self.init_status = self.settings.New(name='init_status', dtype=str, ro=True, initial='')
+        self._ready = threading.Event() # set when the initialization started by connect() is over
+        self._init_thread = None
+        self._init_error = None
+        self.camera_created.connect(self.finish_init, QtCore.Qt.QueuedConnection)
         self.infos = self.settings.New(name='name', dtype=str)
         self.temperature = self.settings.New(name='temperature', dtype=float, ro=True, unit='°C')
         self.temperature_setpoint = self.settings.New(name='temperature_setpoint', dtype=float, 
@@ -28,7 +56,8 @@ class PVcamHW(HardwareComponent):
         #                                  initial = 1, reread_from_hardware_after_write = True)
 
         #NOTE: the binning is set with the same value for x and y. Code should be modified if needed.
-        self.binning=self.settings.New(name='binning', dtype=int, ro=False,choices = [1, 2, 4],
+        # the choices are replaced by the binnings of the camera on connect
+        self.binning=self.settings.New(name='binning', dtype=int, ro=False,choices = list(DEFAULT_BINNINGS),
                                     initial = 1, reread_from_hardware_after_write = True)
 
         self.subarrayh = self.settings.New("subarray_hsize", dtype=int, si = False, ro= 0,
@@ -48,6 +77,12 @@ class PVcamHW(HardwareComponent):
                                                       spinbox_step = 4, spinbox_decimals = 0, initial = 0, 
                                                       vmin = 0, vmax = 2196, reread_from_hardware_after_write = True,
                                                       description = "The default value 0 corresponds to the first pixel starting from the top/bottom")
+        # several ROIs read out in one exposure (on the cameras that support it), saved as separate datasets
+        self.rois = self.settings.New(name='rois', dtype=str, initial='', ro=False,
+                                      description="Multiple ROIs 'h0,v0,width,height; h0,v0,width,height' in sensor "
+                                                  "pixels, shown side by side in the live view. Empty: the subarray ROI")
+        self.max_rois = self.settings.New(name='max_rois', dtype=int, ro=True, initial=1,
+                                          description='ROIs the camera can acquire in one exposure')
         self.readout = self.settings.New(name='readout', dtype=int, ro=False, 
                                         choices = [0, 1, 2], initial = 0, 
                                         reread_from_hardware_after_write = True)
@@ -55,19 +90,137 @@ class PVcamHW(HardwareComponent):
                                       choices = [1, 2],
                                       ro=False, reread_from_hardware_after_write=True)
         #NOTE: maximum gain value 2 for readout modes 1 and 2. For readout mode 0 only gain value 1 is available.
-        self.exposure_time = self.settings.New(name='exposure_time', initial=20, vmax =3600000,
-                                               vmin = 0, spinbox_step = 0.01,dtype=int, ro=False, unit='ms',
+        # readout and gain choices, exposure and ROI limits are replaced on connect by those of the speed table
+        # float: the exposure is set with the resolution of the camera (us if available)
+        self.exposure_time = self.settings.New(name='exposure_time', initial=20.0, vmax =3600000,
+                                               vmin = 0, spinbox_step = 0.01, spinbox_decimals=3, dtype=float, ro=False, unit='ms',
                                                reread_from_hardware_after_write=True)
         #NOTE: maximum exposure time of 3600000 ms is available only in long exposure mode (see readout port 1 or 2)
+        # timing of the current ROI, binning, readout port and exposure; frame_rate is set through the exposure time
+        self.readout_time = self.settings.New(name='readout_time', dtype=float, ro=True, initial=0, unit='us')
+        self.frame_rate = self.settings.New(name='frame_rate', dtype=float, ro=False, initial=0, unit='Hz',
+                                            spinbox_decimals=2, reread_from_hardware_after_write=True,
+                                            description='Free-running frame rate; writing it sets the exposure time '
+                                                        '(Internal Trigger only)')
+        self.max_frame_rate = self.settings.New(name='max_frame_rate', dtype=float, ro=True, initial=0, unit='Hz',
+                                                spinbox_decimals=2,
+                                                description='Frame rate with the exposure as short as the readout')
+        self.data_rate = self.settings.New(name='data_rate', dtype=float, ro=True, initial=0, unit='MB/s',
+                                           description='Data produced by the camera at frame_rate')
         self.acquisition_mode = self.settings.New(name='acquisition_mode', dtype=str,
                                                   choices=['Continuous', 'MultiFrame'], initial = 'Continuous', ro=False, reread_from_hardware_after_write = True)  #Uncomment to choose acquisition mode
         self.trmode = self.add_logged_quantity('trigger_mode', dtype=str, si=False, ro=0, 
                                        choices = ['Internal Trigger', 'Edge Trigger', 'Trigger First', 'Software Trigger Edge', 'Software Trigger First'], initial = 'Internal Trigger', reread_from_hardware_after_write = True)
+        self.zero_copy = self.settings.New(name='zero_copy', dtype=bool, initial=False, ro=False,
+                                           description='Poll frames without copying them out of the PVCAM buffer')
+        # live circular buffer: fixed depth or sized from frame rate, slack and memory cap
+        self.buffer_auto = self.settings.New(name='buffer_auto', dtype=bool, initial=True, ro=False,
+                                             description='Size the live buffer from buffer_slack and buffer_max_size')
+        self.buffer_frames = self.settings.New(name='buffer_frames', dtype=int, initial=16, vmin=2, ro=True,
+                                               description='Frames in the live circular buffer')
+        self.buffer_slack = self.settings.New(name='buffer_slack', dtype=float, initial=500.0, vmin=1,
+                                              unit='ms', description='Acquisition time held by the automatic buffer')
+        self.buffer_max_size = self.settings.New(name='buffer_max_size', dtype=float, initial=1024.0, vmin=1,
+                                                 unit='MB', description='Memory cap of the automatic buffer')
+        self.buffer_size = self.settings.New(name='buffer_size', dtype=float, ro=True, initial=0, unit='MB')
+        self.overrun_events = self.settings.New(name='overrun_events', dtype=int, ro=True, initial=0,
+                                                description='Camera buffer overruns in the last acquisition')
+        self._last_overrun_log = 0.0
+        self.buffer_auto.add_listener(lambda: self.buffer_frames.change_readonly(self.buffer_auto.val))
+        self.exposure_time.add_listener(self.read_buffer_depth)
+        self.readout.add_listener(self.read_buffer_depth)
+        self.readout.add_listener(self.apply_port_limits)
+        self.exposure_time.add_listener(self.read_timing)
+        self.readout.add_listener(self.read_timing)
+        # readout, gain, exposure and ROI limits come from the speed table of the camera (cached on disk)
+        self.speed_table_source = self.settings.New(name='speed_table_source', dtype=str, ro=True, initial='',
+                                                    description='cache: table read from disk; camera: enumerated at connect')
+        self.add_operation('refresh speed table', self.refresh_speed_table)
+        # counters of the camera parameter cache in PVcamDevice (updated by read_from_hardware)
+        self.roi_reconfig_time = self.settings.New(name='roi_reconfig_time', dtype=float, ro=True, initial=0,
+                                                   unit='ms', spinbox_decimals=3,
+                                                   description='Duration of the last ROI/binning reconfiguration')
+        self.geometry_callbacks = [] # functions called with the new frame shape after each ROI/binning change
+        self._geometry_pending = None # changes collected inside geometry_transaction
+        self.cache_hits = self.settings.New(name='cache_hits', dtype=int, ro=True, initial=0)
+        self.cache_misses = self.settings.New(name='cache_misses', dtype=int, ro=True, initial=0)
+        self.driver_latency = self.settings.New(name='driver_latency', dtype=float, ro=True, initial=0,
+                                                unit='ms', spinbox_decimals=3,
+                                                description='Average duration of a PVCAM get/set parameter call')
 
     def connect(self):
-        # create an instance of the Device
-        self.cam = PVcamDevice() 
-        
+        # the camera is opened in a background thread (background_init), so that the GUI stays responsive;
+        # its settings are then connected in the GUI thread. Use wait_ready() before accessing self.cam
+        self._ready.clear()
+        self._init_error = None
+        self.backend.change_readonly(True)
+        self.playback_file.change_readonly(True)
+        self.init_progress.update_value(0)
+        if self.background_init.val:
+            self._init_thread = threading.Thread(target=self.init_camera, args=(True,),
+                                                 name='camera_init', daemon=True)
+            self._init_thread.start()
+        else:
+            self.init_camera()
+            if self._init_error is not None:
+                raise self._init_error
+
+    def on_init_progress(self, step, fraction):
+        self.init_status.update_value(step)
+        self.init_progress.update_value(fraction * 100)
+
+    def wait_ready(self, timeout=None):
+        # blocks until the camera is initialized; raises if the initialization failed
+        if not self._ready.wait(timeout):
+            raise TimeoutError('The camera initialization is still running.')
+        if self._init_error is not None:
+            raise RuntimeError(f'Camera initialization failed: {self._init_error}')
+
+    def init_camera(self, queued=False):
+        # creates the Device; with queued (init thread) finish_init runs later in the GUI thread,
+        # since connecting the settings reads the hardware into the widgets
+        t0 = time.perf_counter()
+        try:
+            options = {}
+            if self.backend.val == 'playback':
+                options = dict(path=self.playback_file.val, playback_speed=self.playback_speed.val,
+                               loop=self.playback_loop.val, memmap=self.playback_memmap.val)
+            cam = PVcamDevice(backend=self.backend.val, progress=self.on_init_progress, **options)
+        except Exception as err:
+            self.init_failed(err)
+            return
+        if queued:
+            self.camera_created.emit(cam, t0)
+        else:
+            self.finish_init(cam, t0)
+
+    def finish_init(self, cam, t0):
+        # GUI thread: connects the settings of the Device created by init_camera
+        if not self.settings['connected']:
+            cam.close()
+            self.init_failed(RuntimeError('disconnected while the camera was initializing'))
+            return
+        try:
+            self.cam = cam
+            self.connect_settings()
+        except Exception as err:
+            self.init_failed(err)
+            return
+        total = time.perf_counter() - t0
+        self.init_status.update_value(f'ready in {total:.2f} s')
+        self.startup_times = dict(cam.startup_times, settings=total - sum(cam.startup_times.values()))
+        self.log.info('camera startup: ' + ', '.join(f'{step} {seconds * 1e3:.0f} ms'
+                                                     for step, seconds in self.startup_times.items())
+                      + f', total {total * 1e3:.0f} ms')
+        self._ready.set()
+
+    def init_failed(self, err):
+        self._init_error = err
+        self.init_status.update_value(f'failed: {err}')
+        self.log.error(f'Camera initialization failed: {err}')
+        self._ready.set()
+
+    def connect_settings(self):
 
         # connect settings to Device methods
         self.infos.hardware_read_func = self.cam.get_idname
@@ -76,7 +229,11 @@ class PVcamHW(HardwareComponent):
         self.image_width.hardware_read_func = self.cam.get_width
         self.image_height.hardware_read_func = self.cam.get_height  
         self.exposure_time.hardware_read_func = self.cam.get_exposure
-        #self.frame_rate.hardware_read_func = self.cam.get_rate
+        self.frame_rate.hardware_read_func = self.cam.get_rate
+        self.frame_rate.hardware_set_func = self.set_frame_rate
+        self.max_frame_rate.hardware_read_func = self.cam.get_max_rate
+        self.data_rate.hardware_read_func = self.cam.get_data_rate
+        self.readout_time.hardware_read_func = self.cam.get_readout_time
         self.gain.hardware_read_func = self.cam.get_gain
         self.readout.hardware_read_func = self.cam.get_readout
         self.binning.hardware_read_func = self.cam.get_binning      
@@ -88,22 +245,214 @@ class PVcamHW(HardwareComponent):
         #self.roi.hardware_read_func = self.cam.get_roi
 
         self.exposure_time.hardware_set_func=self.cam.set_exposure
-        self.binning.hardware_set_func = self.cam.set_binning
+        self.binning.hardware_set_func = self.set_binning
+        self.binning.change_choice_list(self.cam.get_binnings())
         self.gain.hardware_set_func = self.cam.set_gain
         self.readout.hardware_set_func = self.cam.set_readout
-        self.subarrayh.hardware_set_func = self.cam.setSubarrayH
-        self.subarrayv.hardware_set_func = self.cam.setSubarrayV
-        self.subarrayh_pos.hardware_set_func = self.cam.setSubarrayHpos
-        self.subarrayv_pos.hardware_set_func = self.cam.setSubarrayVpos
+        self.subarrayh.hardware_set_func = lambda width: self.set_geometry(width=width)
+        self.subarrayv.hardware_set_func = lambda height: self.set_geometry(height=height)
+        self.subarrayh_pos.hardware_set_func = lambda h0: self.set_geometry(h0=h0)
+        self.subarrayv_pos.hardware_set_func = lambda v0: self.set_geometry(v0=v0)
         #self.roi.hardware_set_func = self.cam.set_roi
+        self.max_rois.hardware_read_func = self.cam.get_max_rois
+        self.rois.hardware_set_func = self.set_rois
         self.trmode.hardware_set_func = self.cam.set_trigger_mode
+        self.zero_copy.hardware_read_func = self.cam.get_zero_copy
+        self.zero_copy.hardware_set_func = self.cam.set_zero_copy
+        self.cache_hits.hardware_read_func = self.cam.get_cache_hits
+        self.cache_misses.hardware_read_func = self.cam.get_cache_misses
+        self.driver_latency.hardware_read_func = self.cam.get_driver_ms_per_call
+        self.buffer_frames.hardware_read_func = self.cam.get_buffer_frames
+        self.buffer_frames.hardware_set_func = self.cam.set_buffer_frames
+        self.buffer_size.hardware_read_func = self.cam.get_buffer_MB
+        self.overrun_events.hardware_read_func = self.cam.get_overrun_events
+        self.buffer_auto.hardware_set_func = self.set_buffer_option('buffer_auto')
+        self.buffer_slack.hardware_set_func = self.set_buffer_option('buffer_slack_ms')
+        self.buffer_max_size.hardware_set_func = self.set_buffer_option('buffer_max_MB')
+        self.cam.overrun_callbacks.append(self.on_overrun)
+        if self.cam.backend == 'playback':
+            # the pace and the looping apply from the next acquisition
+            self.playback_speed.hardware_set_func = lambda speed: setattr(self.cam.cam, 'playback_speed', speed)
+            self.playback_loop.hardware_set_func = lambda loop: setattr(self.cam.cam, 'loop', loop)
+        # the device starts with its own defaults: apply the current buffer options
+        for lq in (self.buffer_auto, self.buffer_slack, self.buffer_max_size):
+            lq.hardware_set_func(lq.val)
+        self.apply_speed_table()
+        self.read_from_hardware()
+
+    def apply_speed_table(self):
+        # choices of readout and ROI limits from the speed table, then the limits of the current port
+        table = self.cam.speed_table
+        self.speed_table_source.update_value(self.cam.speed_table_source)
+        self.readout.change_choice_list(table.ports())
+        width, height = table.sensor_size
+        self.subarrayh.change_min_max(4, width)
+        self.subarrayv.change_min_max(4, height)
+        self.subarrayh_pos.change_min_max(0, width - 4)
+        self.subarrayv_pos.change_min_max(0, height - 4)
+        self.apply_port_limits()
+
+    def apply_port_limits(self):
+        # gains and exposure range of the current readout port
+        if not hasattr(self, 'cam') or self.cam.speed_table is None:
+            return
+        self.gain.change_choice_list(self.cam.get_gains())
+        exposure_range = self.cam.get_exposure_range()
+        if exposure_range is not None:
+            self.exposure_time.change_min_max(*exposure_range)
+        self.gain.read_from_hardware()
+
+    def refresh_speed_table(self):
+        # enumerates the speed table from the camera again, replacing the cached one
+        if not self.settings['connected']:
+            self.log.error('Connect the camera before refreshing its speed table')
+            return
+        if not self._ready.is_set():
+            # the initialization finishes in this (GUI) thread: waiting here would never return
+            self.log.error('The camera is still initializing')
+            return
+        self.wait_ready()
+        readout, gain = self.readout.val, self.gain.val
+        self.cam.load_speed_table(refresh=True)
+        self.cam.set_readout(readout)
+        if gain in [value for _, value in self.cam.get_gains()]:
+            self.cam.set_gain(gain)
+        self.apply_speed_table()
         self.read_from_hardware()
 
+
+    def set_geometry(self, h0=None, v0=None, width=None, height=None, binning=None):
+        """
+        Applies the given ROI/binning changes (None: unchanged) in a single validated
+        camera reconfiguration, then updates the settings without writing them again.
+        Inside geometry_transaction() the changes are only collected and applied on exit.
+        """
+        changes = {key: value for key, value in dict(h0=h0, v0=v0, width=width, height=height,
+                                                     binning=binning).items() if value is not None}
+        if self._geometry_pending is not None:
+            self._geometry_pending.update(changes)
+            return
+        if self.cam.roi_layout is not None:
+            if set(changes) == {'binning'}:
+                # the new binning applies to all the ROIs
+                shape = self.cam.set_rois(self.cam.get_rois(), changes['binning'])
+                self.geometry_changed(shape)
+                return
+            self.rois.update_value('', update_hardware=False) # a subarray change replaces the multiple ROIs
+        geometry_settings = {'h0': self.subarrayh_pos, 'v0': self.subarrayv_pos, 'width': self.subarrayh,
+                             'height': self.subarrayv, 'binning': self.binning}
+        geometry = {key: lq.val for key, lq in geometry_settings.items()}
+        geometry.update(changes)
+        shape = self.cam.set_geometry(**geometry)
+        for key, lq in geometry_settings.items():
+            if lq.val != geometry[key]:
+                lq.update_value(geometry[key], update_hardware=False)
+        self.geometry_changed(shape)
+
+    def set_binning(self, binning):
+        """
+        Set func of binning: the ROI (or each of the multiple ROIs) is snapped to the new binning
+        (start and size multiples of it, see snap_roi) in the same reconfiguration.
+        """
+        if self.cam.roi_layout is not None:
+            rois = [snap_roi(roi, binning) for roi in self.cam.get_rois()]
+            self.geometry_changed(self.cam.set_rois(rois, binning))
+            self.rois.update_value(format_rois(rois), update_hardware=False)
+            return
+        roi = snap_roi((self.subarrayh_pos.val, self.subarrayv_pos.val, self.subarrayh.val, self.subarrayv.val),
+                       binning)
+        with self.geometry_transaction():
+            self.set_geometry(binning=binning)
+            for lq, value in zip((self.subarrayh_pos, self.subarrayv_pos, self.subarrayh, self.subarrayv), roi):
+                if lq.val != value:
+                    lq.update_value(value)
+
+    def set_rois(self, text):
+        """
+        Set func of the rois setting: acquires the listed ROIs in one exposure, with the current binning.
+        An empty text (or a single ROI) goes back to a single subarray ROI.
+        """
+        rois = parse_rois(text)
+        if len(rois) > 1:
+            self.geometry_changed(self.cam.set_rois(rois, self.binning.val))
+            self.rois.update_value(format_rois(rois), update_hardware=False)
+        elif rois:
+            h0, v0, width, height = rois[0]
+            self.set_geometry(h0=h0, v0=v0, width=width, height=height)
+        else:
+            self.cam.roi_layout = None # the subarray settings are applied again
+            self.set_geometry()
+
+    def geometry_changed(self, shape):
+        # after each ROI/binning reconfiguration
+        self.roi_reconfig_time.update_value(self.cam.reconfig_time * 1e3)
+        self.read_buffer_depth()
+        self.read_timing()
+        for callback in self.geometry_callbacks:
+            callback(shape)
+
+    def set_buffer_option(self, attribute):
+        # set func of an option of the automatic live buffer: the new depth is read back at once
+        def set_option(value):
+            setattr(self.cam, attribute, value)
+            self.read_buffer_depth()
+        return set_option
+
+    def set_frame_rate(self, rate):
+        # the camera reaches the rate through its exposure time, which is read back with the rate actually set
+        actual = self.cam.set_rate(rate)
+        if abs(actual - rate) > 1e-3 * rate:
+            self.log.info(f'frame rate {rate} Hz requested, {actual:.3f} Hz set (exposure resolution and readout time)')
+        self.exposure_time.read_from_hardware()
+
+    def read_timing(self):
+        # readout time, frame rates and data rate depend on exposure, readout port, ROI and binning
+        if not hasattr(self, 'cam'):
+            return
+        for lq in (self.readout_time, self.frame_rate, self.max_frame_rate, self.data_rate):
+            lq.read_from_hardware()
+
+    def read_buffer_depth(self):
+        # the automatic depth depends on exposure, readout port, ROI and binning
+        self.buffer_frames.read_from_hardware()
+        self.buffer_size.read_from_hardware()
+
+    def on_overrun(self, lost, frame_number):
+        # called in the acquisition thread for each gap in the frame counter; warnings are rate limited
+        self.overrun_events.update_value(self.cam.overrun_events)
+        now = time.monotonic()
+        if now - self._last_overrun_log > 1.0:
+            self._last_overrun_log = now
+            self.log.warning(f'Camera buffer overrun: {lost} frames lost before frame {frame_number} '
+                             f'({self.cam.dropped_frames} in this acquisition). '
+                             f'Increase buffer_slack or buffer_frames.')
+
+    @contextmanager
+    def geometry_transaction(self):
+        """
+        Groups several ROI/binning changes in one reconfiguration, e.g.:
+            with hw.geometry_transaction():
+                hw.settings['subarray_hsize'] = 1000
+                hw.settings['subarrayh_pos'] = 1200
+        """
+        self._geometry_pending = {}
+        try:
+            yield
+            pending = self._geometry_pending
+        finally:
+            self._geometry_pending = None
+        if pending:
+            self.set_geometry(**pending)
         
     def disconnect(self):
+        if self._init_thread is not None:
+            self._init_thread.join()
+            self._init_thread = None
         if hasattr(self, 'cam'):
             self.cam.close() 
             del self.cam
+        self.backend.change_readonly(False)
+        self.playback_file.change_readonly(False)
             
         for lq in self.settings.as_list():
             lq.hardware_read_func = None
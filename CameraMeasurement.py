@@ -9,7 +9,24 @@ from ScopeFoundry.helper_funcs import sibling_path, load_qt_ui_file
 from ScopeFoundry import h5_io
 import pyqtgraph as pg
 import numpy as np
+import h5py
 import os, time
+from FrameRing import FrameRing, FrameConsumer, META_DTYPE
+from Acquisition import AcquisitionLoop
+from Preview import PreviewStage
+from H5Writer import H5FrameWriter, available_compressions, MAX_CHUNK_BYTES
+from TiffWriter import TiffFrameWriter
+from ZarrWriter import ZarrFrameWriter, ZARR_COMPRESSIONS
+from FrameProcessing import FrameReducer, REDUCTION_MODES
+from Calibration import CalibrationStore, FrameCorrector, average_frames, calibration_key, default_calibration_dir
+from TimingProbes import ProbeSet
+from SharedFrameRing import SharedFrameRing, POLICIES
+from AnalysisPlugins import AnalysisRunner, FocusPlugin, RoiIntensityPlugin, SaturationPlugin
+from RollingRecord import RollingRecorder
+from MultiRoi import MultiRoiWriter
+from Throughput import measure_disk_rate, available_memory_MB, preflight
+from pyqtgraph.Qt import QtWidgets, QtGui
+import threading
 
 class PVcamMeasure(Measurement):
     
@@ -26,6 +43,18 @@ class PVcamMeasure(Measurement):
         self.ui = load_qt_ui_file(self.ui_filename) 
         
         self.settings.New('save_h5', dtype=bool, initial=False)         
+        self.settings.New('file_format', dtype=str, initial='h5', choices=['h5', 'ome.tif', 'ome.zarr'],
+                          description='Output of save_h5: HDF5 file, streamed BigTIFF/OME-TIFF or OME-Zarr store')
+        self.settings.New('tiff_max_file_size', dtype=float, unit='GB', initial=0, vmin=0,
+                          description='OME-TIFF rollover size (0: a single file)')
+        # OME-Zarr: chunks compressed in parallel by a thread or process pool
+        self.settings.New('zarr_chunk_frames', dtype=int, initial=8, vmin=1)
+        self.settings.New('zarr_compression', dtype=str, initial='lz4', choices=ZARR_COMPRESSIONS)
+        self.settings.New('zarr_workers', dtype=int, initial=max(1, (os.cpu_count() or 2) - 1), vmin=1,
+                          description='Threads or processes compressing the chunks')
+        self.settings.New('zarr_executor', dtype=str, initial='thread', choices=['thread', 'process'])
+        self.settings.New('zarr_pyramid_levels', dtype=int, initial=0, vmin=0,
+                          description='2x2 downsampled levels written with the full resolution data')
         self.settings.New('refresh_period',dtype = float, unit ='s', spinbox_decimals = 3, initial = 0.05, vmin = 0)        
         
         self.settings.New('xsampling', dtype=float, unit='um', initial=1.0) 
@@ -36,8 +65,131 @@ class PVcamMeasure(Measurement):
         self.settings.New('auto_levels', dtype=bool, initial=True)
         self.settings.New('level_min', dtype=int, initial=60)
         self.settings.New('level_max', dtype=int, initial=4000)
+        self.settings.New('preview_method', dtype=str, initial='stride', choices=['stride', 'mean'],
+                          description='Decimation of the live view to the widget size')
+        self.settings.New('gui_time', dtype=float, unit='ms', ro=True, initial=0, spinbox_decimals=3,
+                          description='GUI thread CPU time per display refresh (running average)')
+        self.settings.New('show_stats', dtype=bool, initial=False,
+                          description='Show the live timing statistics of the acquisition pipeline')
+        self.probes = ProbeSet() # timing of each stage of run and update_display, reported at the end of each run
+        self._stats_time = 0.0
+        self.preview = PreviewStage()
+        self._shown_seq = None # sequence number of the frame shown in the live view
+
+        # ring buffer between the acquisition thread and the saving/display/analysis threads
+        self.settings.New('ring_depth', dtype=int, initial=32, vmin=2,
+                          description='Number of frames preallocated in the ring buffer')
+        self.settings.New('ring_occupancy', dtype=int, ro=True, initial=0,
+                          description='Frames stored in the ring and not yet consumed')
+        self.settings.New('ring_high_water', dtype=int, ro=True, initial=0,
+                          description='Maximum ring occupancy reached during the run')
+        self.settings.New('ring_overruns', dtype=int, ro=True, initial=0,
+                          description='Frames discarded because the ring was full')
+        self.settings.New('dropped_frames', dtype=int, ro=True, initial=0,
+                          description='Frames lost by the camera (gaps in the PVCAM frame counter)')
+
+        # h5 writer: chunk layout, batching, flush budget and compression
+        self.settings.New('h5_chunk_frames', dtype=int, initial=1, vmin=1,
+                          description='Frames per HDF5 chunk (1: one chunk per frame)')
+        self.settings.New('h5_batch_frames', dtype=int, initial=16, vmin=1,
+                          description='Frames written to the file in each block')
+        self.settings.New('h5_compression', dtype=str, initial='none', choices=available_compressions())
+        self.settings.New('h5_flush_interval', dtype=float, unit='s', initial=2.0, vmin=0,
+                          description='Maximum time between two checkpoints (flushes) of the h5 file')
+        self.settings.New('h5_flush_size', dtype=float, unit='MB', initial=512.0, vmin=0,
+                          description='Maximum data written between two checkpoints of the h5 file')
+        self.settings.New('h5_swmr', dtype=bool, initial=False,
+                          description='Let other processes read the h5 file while it is written (HDF5 SWMR mode)')
+        self.settings.New('writer_rate', dtype=float, unit='MB/s', ro=True, initial=0,
+                          description='Throughput of the h5 writer in the last run')
+        self.settings.New('compression_ratio', dtype=float, ro=True, initial=1.0, spinbox_decimals=2)
+
+        # MultiFrame acquisition: circular buffer polled frame by frame, or non-circular sequences
+        self.settings.New('multiframe_buffer', dtype=str, initial='sequence', choices=['circular', 'sequence'],
+                          description='sequence: the camera fills a buffer of number_frames at full speed')
+        self.settings.New('sequence_budget', dtype=float, unit='MB', initial=2048.0, vmin=1,
+                          description='Maximum size of a sequence buffer; longer recordings use several sequences')
+        # preflight of MultiFrame recordings: data rate against the disk speed and the free memory
+        self.settings.New('preflight', dtype=bool, initial=True,
+                          description='Warn before saving if the data rate exceeds the disk speed or the free memory')
+        self.settings.New('disk_rate', dtype=float, unit='MB/s', ro=True, initial=0,
+                          description='Measured write speed of save_dir')
+        self.settings.New('preflight_status', dtype=str, ro=True, initial='')
+        self.add_operation('measure disk speed', self.start_disk_probe)
+        self.disk_rates = {} # write speed of each saving directory, measured once
+        # the probe writes 128 MB: it runs in the background when save_dir changes, never in run()
+        self.app.settings.get_lq('save_dir').add_listener(self.on_save_dir_changed)
+
+        # reduction of the saved stream: software binning and accumulation of consecutive frames
+        self.settings.New('reduction', dtype=str, initial='none', choices=REDUCTION_MODES,
+                          description='sum/average: one saved frame every reduction_frames frames; '
+                                      'rolling_mean/rolling_max: projection of the last reduction_frames frames')
+        self.settings.New('reduction_frames', dtype=int, initial=1, vmin=1)
+        self.settings.New('reduction_stride', dtype=int, initial=1, vmin=1,
+                          description='Frames between two saved rolling projections')
+        self.settings.New('software_binning_x', dtype=int, initial=1, vmin=1)
+        self.settings.New('software_binning_y', dtype=int, initial=1, vmin=1)
+        self.reducer = None
+        self.saved_layout = None # RoiLayout of the saved frames when the camera acquires several ROIs
+
+        # dark-frame and flat-field correction of the saved and displayed frames
+        self.settings.New('calibration', dtype=bool, initial=False,
+                          description='Apply the dark/flat maps stored for the current camera configuration')
+        self.settings.New('calibration_dir', dtype='file', is_dir=True, initial=default_calibration_dir())
+        self.settings.New('calibration_frames', dtype=int, initial=32, vmin=1,
+                          description='Frames averaged to acquire a dark or flat map')
+        # float32 keeps the fractional values but doubles the saved data and the write bandwidth
+        self.settings.New('calibration_dtype', dtype=str, initial='uint16', choices=['uint16', 'float32'])
+        self.settings.New('calibration_status', dtype=str, ro=True, initial='')
+        self.settings.New('correction_time', dtype=float, unit='ms', ro=True, initial=0, spinbox_decimals=3,
+                          description='Correction time per saved frame')
+        self.add_operation('acquire dark', lambda: self.acquire_calibration('dark'))
+        self.add_operation('acquire flat', lambda: self.acquire_calibration('flat'))
+        self.corrector = None # applied to the saved frames
+        self.display_corrector = None # applied to the displayed frames, in the display consumer thread
+
+        # broadcast of the frames to other processes, read with SharedFrameRing.SharedFrameReader(shared_ring_name)
+        self.settings.New('shared_ring', dtype=bool, initial=False,
+                          description='Publish every frame in a named shared-memory ring for analysis processes')
+        self.settings.New('shared_ring_name', dtype=str, initial='pvcam_frames')
+        self.settings.New('shared_ring_depth', dtype=int, initial=32, vmin=2)
+        self.settings.New('shared_ring_policy', dtype=str, initial='drop', choices=POLICIES,
+                          description='When a reader is too slow: drop the new frames, or block (up to 1 s per frame)')
+        self.settings.New('shared_ring_readers', dtype=int, ro=True, initial=0)
+        self.settings.New('shared_ring_drops', dtype=int, ro=True, initial=0,
+                          description='Frames not published in the last run because a reader did not keep up')
+        self.shared_ring = None
+
+        # rolling record (Continuous mode): the last pre_trigger_time seconds are kept in memory and
+        # 'trigger event' saves them with the following post_trigger_time seconds, without stopping the acquisition
+        self.settings.New('rolling_record', dtype=bool, initial=False,
+                          description='Continuous mode: keep a history of the last frames to save events')
+        self.settings.New('pre_trigger_time', dtype=float, unit='s', initial=5.0, vmin=0)
+        self.settings.New('post_trigger_time', dtype=float, unit='s', initial=5.0, vmin=0)
+        self.settings.New('rolling_budget', dtype=float, unit='MB', initial=2048.0, vmin=1,
+                          description='Memory of the history; limits the pre-trigger time at high frame rates')
+        self.settings.New('rolling_frames', dtype=int, ro=True, initial=0, description='Frames in the history')
+        self.settings.New('rolling_status', dtype=str, ro=True, initial='')
+        self.add_operation('trigger event', self.trigger_event)
+        self.recorder = None
+        self.events = 0 # events triggered in the run
+
+        # real-time analysis plugins run on a worker pool, each at its own rate (<name>_rate), see add_analysis
+        self.settings.New('analysis', dtype=bool, initial=False,
+                          description='Run the analysis plugins on the acquired frames')
+        self.settings.New('analysis_workers', dtype=int, initial=2, vmin=1)
+        self.settings.New('analysis_executor', dtype=str, initial='thread', choices=['thread', 'process'])
+        self.settings.New('save_analysis', dtype=bool, initial=True,
+                          description='Save the analysis results with the image data (h5 and ome.zarr)')
+        self.analysis = AnalysisRunner(probes=self.probes)
+        for plugin in (FocusPlugin(), RoiIntensityPlugin(), SaturationPlugin()):
+            self.add_analysis(plugin)
+
+        # extra consumers started with every run, see add_frame_consumer
+        self.frame_consumers = []
         
         self.cam = self.app.hardware['PVcamHW'] 
+        self.cam.geometry_callbacks.append(self.on_geometry_changed)
         
     def setup_figure(self):
         """
@@ -69,6 +221,15 @@ class PVcamMeasure(Measurement):
                   ]
         cmap = pg.ColorMap(pos=np.linspace(0.0, 1.0, 6), color=colors)
         self.img.setColorMap(cmap)
+
+        # optional live stats panel under the image
+        self.stats_panel = QtWidgets.QPlainTextEdit()
+        self.stats_panel.setReadOnly(True)
+        self.stats_panel.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.stats_panel.setMaximumHeight(160)
+        self.ui.imageLayout.addWidget(self.stats_panel)
+        self.stats_panel.setVisible(self.settings['show_stats'])
+        self.settings.show_stats.add_listener(lambda: self.stats_panel.setVisible(self.settings['show_stats']))
         
     def update_display(self):
         """
@@ -77,91 +238,418 @@ class PVcamMeasure(Measurement):
         its update frequency is defined by self.display_update_period
         """
         self.display_update_period = self.settings['refresh_period'] 
+        t_start = time.perf_counter()
        
         length = self.cam.number_frames.val
         if hasattr(self, 'frame_index'):
             self.settings['progress'] = (self.frame_index +1) * 100/length 
 
+        if getattr(self, 'ring', None) is not None:
+            self.update_ring_settings()
+        if self.settings['analysis']:
+            self.update_analysis_settings()
+
+        t0 = time.thread_time()
+        view_size = self.img.ui.graphicsView.size()
+        self.preview.method = self.settings['preview_method']
+        self.preview.target_shape = (view_size.height(), view_size.width())
 
-        if hasattr(self, 'image'):
-            self.img.setImage(self.image.T,
-                                autoLevels = self.settings['auto_levels'],
+        # the decimated frame and its levels are computed in the display consumer thread;
+        # a frame already shown is not uploaded again
+        latest = self.preview.latest()
+        if latest is not None and latest[0] != self._shown_seq:
+            seq, preview, step, levels = latest
+            if self.settings['auto_levels']:
+                self.settings['level_min'] = levels[0]
+                self.settings['level_max'] = levels[1]
+            else:
+                levels = (self.settings['level_min'], self.settings['level_max'])
+            self.img.setImage(preview.T,
+                                autoLevels = False,
+                                levels = levels,
                                 autoRange = self.auto_range.val,
+                                scale = (step, step), # keep the axes in sensor (binned) pixels
                                 levelMode = 'mono'
                                 )
+            self._shown_seq = seq
+        elif not self.settings['auto_levels']:
+            self.img.setLevels( min= self.settings['level_min'],
+                                max= self.settings['level_max'])
+
+        # running average of the GUI cost of a refresh
+        self.settings['gui_time'] = 0.9 * self.settings['gui_time'] + 0.1 * (time.thread_time() - t0) * 1e3
+        if self.corrector is not None:
+            self.settings['correction_time'] = self.corrector.ms_per_frame()
+        if self.settings['show_stats'] and t_start - self._stats_time > 0.5:
+            self.stats_panel.setPlainText('\n'.join(self.probes.report()))
+            self._stats_time = t_start
+        self.probes['update_display'].add(time.perf_counter() - t_start)
             
-            if self.settings['auto_levels']:
-                lmin,lmax = self.img.getHistogramWidget().getLevels()
-                self.settings['level_min'] = lmin
-                self.settings['level_max'] = lmax
-            else:
-                self.img.setLevels( min= self.settings['level_min'],
-                                    max= self.settings['level_max'])
-            
 
 
+    def update_ring_settings(self):
+        stats = self.ring.stats()
+        self.settings['ring_occupancy'] = stats['occupancy']
+        self.settings['ring_high_water'] = stats['high_water']
+        self.settings['ring_overruns'] = stats['overruns']
+        if hasattr(self.cam, 'cam'):
+            self.settings['dropped_frames'] = self.cam.cam.get_dropped_frames()
+        if self.shared_ring is not None:
+            stats = self.shared_ring.stats()
+            self.settings['shared_ring_readers'] = stats['readers']
+            self.settings['shared_ring_drops'] = stats['drops']
+
+    def allocate_ring(self, frame_shape, dtype=np.uint16):
+        # the ring is reused between runs and only reallocated when the frame geometry or depth changes
+        ring = getattr(self, 'ring', None)
+        if ring is not None and ring.shape == tuple(frame_shape) and ring.dtype == dtype \
+                and ring.depth == self.settings['ring_depth']:
+            ring.reset()
+        else:
+            self.ring = None # release the old buffer before allocating the new one
+            self.ring = FrameRing(frame_shape, dtype=dtype, depth=self.settings['ring_depth'])
+        return self.ring
+
+    def on_geometry_changed(self, frame_shape):
+        # called by PVcamHW after a ROI/binning change: frees the buffers of the old geometry
+        ring = getattr(self, 'ring', None)
+        if ring is not None and not self.is_measuring() and ring.shape != tuple(frame_shape):
+            self.ring = None
+            if hasattr(self, 'image'):
+                del self.image
+        if self.shared_ring is not None and not self.is_measuring() and self.shared_ring.shape != tuple(frame_shape):
+            self.close_shared_ring() # readers see the ring closed and attach to the next one
+
+    def allocate_shared_ring(self, frame_shape, dtype=np.uint16):
+        # the shared ring is kept between runs, so that the readers stay attached;
+        # it is recreated when its name, geometry, depth or policy change
+        if not self.settings['shared_ring']:
+            self.close_shared_ring()
+            return None
+        ring = self.shared_ring
+        config = (self.settings['shared_ring_name'], tuple(frame_shape), np.dtype(dtype),
+                  self.settings['shared_ring_depth'], self.settings['shared_ring_policy'])
+        if ring is not None and (ring.name, ring.shape, ring.dtype, ring.depth, ring.policy) == config:
+            ring.published = ring.drops = 0
+            return ring
+        self.close_shared_ring()
+        self.shared_ring = SharedFrameRing(*config)
+        return self.shared_ring
+
+    def close_shared_ring(self):
+        if self.shared_ring is not None:
+            self.shared_ring.close()
+            self.shared_ring = None
+
+    def publish_frames(self, seq, frames):
+        # shared ring consumer: one copy into the shared memory, the readers use views of it
+        t0 = time.perf_counter()
+        self.shared_ring.publish(frames, self.ring.metadata(seq, len(frames)))
+        self.probes['shared_publish'].add(time.perf_counter() - t0, frames.nbytes)
+
+    def add_analysis(self, plugin):
+        """
+        Registers an AnalysisPlugin: its rate is the setting <name>_rate (0: off) and its
+        results are shown in the read-only settings <name>_<field>.
+        """
+        self.analysis.add_plugin(plugin)
+        rate = self.settings.New(f'{plugin.name}_rate', dtype=float, unit='Hz', initial=plugin.rate, vmin=0,
+                                 description=f'Frames per second analysed by {plugin.name} (0: off)')
+        rate.add_listener(lambda: setattr(plugin, 'rate', rate.val))
+        for field in plugin.fields:
+            self.settings.New(f'{plugin.name}_{field}', dtype=float, ro=True, initial=0)
+
+    def analyze_frame(self, seq, frames):
+        # analysis consumer: hands the newest frame to the plugins that are due
+        self.analysis.submit(seq, frames[0])
+
+    def update_analysis_settings(self):
+        for plugin in self.analysis.plugins:
+            values = self.analysis.latest(plugin.name)
+            if values is not None:
+                for field in plugin.fields:
+                    self.settings[f'{plugin.name}_{field}'] = values[field]
+
+    def save_analysis(self):
+        # time series of each plugin (seq, host_time, fields) next to the frames
+        if not (self.settings['analysis'] and self.settings['save_analysis']):
+            return
+        stats = self.analysis.stats()
+        for plugin in self.analysis.active_plugins():
+            series = self.analysis.series(plugin.name)
+            if self.h5file is not None:
+                dataset = self.h5_group.require_group('analysis').create_dataset(plugin.name, data=series)
+                dataset.attrs['rate'] = plugin.rate
+                dataset.attrs['skipped'] = stats[plugin.name]['skipped']
+            elif self.zarr_root() is not None:
+                array = self.zarr_root().require_group('analysis').array(plugin.name, series, overwrite=True)
+                array.attrs.update(rate=plugin.rate, skipped=stats[plugin.name]['skipped'])
+
+    def add_frame_consumer(self, name, func, lossless=False):
+        """
+        Registers func(first_seq, frames) to be run in its own thread during every run.
+        frames has shape (n, height, width) and must not be modified.
+        lossless consumers receive every frame and can make the ring overrun if they
+        are too slow; the others only receive the newest frame every refresh_period.
+        """
+        self.frame_consumers.append((name, func, lossless))
+
+    def show_frame(self, seq, frames):
+        # display consumer: frames is a private copy that stays valid until the next call
+        t0 = time.perf_counter()
+        if self.display_corrector is not None:
+            frames = self.display_corrector.correct(frames)
+        self.image = frames[0]
+        self.preview.process(seq, frames)
+        self.probes['display'].add(time.perf_counter() - t0)
+
+    def save_frames(self, seq, frames):
+        # saving consumer: frames are written and compressed in the writer thread
+        t0 = time.perf_counter()
+        self.record(frames, self.ring.metadata(seq, len(frames)))
+        self.probes['save'].add(time.perf_counter() - t0, frames.nbytes)
+
+    def create_reducer(self, frame_shape, dtype):
+        # FrameReducer for the reduction settings, None if the frames are saved unchanged
+        mode = self.settings['reduction']
+        bin_x, bin_y = self.settings['software_binning_x'], self.settings['software_binning_y']
+        if mode == 'none' and bin_x == bin_y == 1:
+            return None
+        return FrameReducer(frame_shape, dtype, mode, frames=self.settings['reduction_frames'],
+                            stride=self.settings['reduction_stride'], bin_x=bin_x, bin_y=bin_y)
+
+    def record(self, frames, meta):
+        # appends frames to the recording, corrected and reduced if enabled; each reduced frame
+        # gets the metadata of the last frame it includes
+        probes = self.probes
+        t0 = time.perf_counter()
+        if self.corrector is not None:
+            frames = self.corrector.correct(frames)
+            t1 = time.perf_counter()
+            probes['correct'].add(t1 - t0)
+            t0 = t1
+        if self.reducer is not None:
+            frames, indices = self.reducer.process(frames)
+            t1 = time.perf_counter()
+            probes['reduce'].add(t1 - t0)
+            t0 = t1
+            if not len(frames):
+                return
+            meta = [meta[index] for index in indices]
+        self.writer.append(frames, meta)
+        probes['writer_append'].add(time.perf_counter() - t0, frames.nbytes)
+
     def run(self):
         """
         Runs when measurement is started. Runs in a separate thread from GUI.
         It should not update the graphical interface directly, and should only
         focus on data acquisition.
+        This thread only drains the camera into the ring buffer:
+        saving, display and analysis run in the FrameConsumer threads.
         """
+        self.cam.wait_ready() # the camera may still be initializing in the background
         self.cam.read_from_hardware()
+        mode = self.cam.settings['acquisition_mode']
+        number_frames = self.cam.number_frames.val
+        save = self.settings['save_h5'] and mode == 'MultiFrame'
+        sequence = mode == 'MultiFrame' and self.settings['multiframe_buffer'] == 'sequence'
 
-        if self.cam.settings['acquisition_mode'] == 'Continuous':
-            """
-            If mode is Continuous, acquire frames indefinitely. No save in h5 is permormed 
-            """
+        frame_shape = self.cam.cam.get_frame_shape()
+        self.probes.reset()
+        self.allocate_ring(frame_shape, np.uint16)
+        self.preview.reset()
+        self._shown_seq = None
 
-            self.cam.cam.acq_start() 
-            while not self.interrupt_measurement_called:
+        consumers = [FrameConsumer(self.ring, self.show_frame, 'display', lossless=False,
+                                   period=self.settings['refresh_period'])]
+        if self.allocate_recorder(frame_shape, self.ring.dtype, mode) is not None:
+            consumers.append(FrameConsumer(self.ring, self.record_history, 'rolling_record', lossless=True,
+                                           max_count=self.settings['ring_depth'] // 4 or 1))
+        self.reducer = None
+        self.saved_layout = self.cam.cam.roi_layout
+        self.load_calibration(frame_shape)
+        if save:
+            dtype = self.ring.dtype if self.corrector is None else self.corrector.dtype
+            self.reducer = self.create_reducer(frame_shape, dtype)
+            if self.saved_layout is not None and self.reducer is not None:
+                self.saved_layout = self.saved_layout.reduced(self.reducer.bin_x, self.reducer.bin_y)
+            if self.reducer is None:
+                saved = (frame_shape, dtype, number_frames)
+            else:
+                saved = (self.reducer.shape, self.reducer.dtype, self.reducer.output_length(number_frames))
+            if self.settings['preflight']:
+                self.preflight_check(number_frames, sequence, *saved)
+            self.writer, self.h5file, self.h5_group = self.create_file(*saved)
+        if save and not sequence:
+            consumers.append(FrameConsumer(self.ring, self.save_frames, 'save', lossless=True,
+                                           max_count=self.settings['ring_depth'] // 4 or 1))
+        analysis_period = self.analysis.period() if self.settings['analysis'] else None
+        if analysis_period is not None:
+            self.analysis.workers = self.settings['analysis_workers']
+            self.analysis.executor = self.settings['analysis_executor']
+            self.analysis.start()
+            consumers.append(FrameConsumer(self.ring, self.analyze_frame, 'analysis', lossless=False,
+                                           period=analysis_period))
+        if self.allocate_shared_ring(frame_shape, self.ring.dtype) is not None:
+            consumers.append(FrameConsumer(self.ring, self.publish_frames, 'shared_ring', lossless=True,
+                                           max_count=self.settings['ring_depth'] // 4 or 1))
+        for name, func, lossless in self.frame_consumers:
+            consumers.append(FrameConsumer(self.ring, func, name, lossless=lossless,
+                                           period=self.settings['refresh_period']))
+        for consumer in consumers:
+            consumer.start()
 
-                self.image = self.cam.cam.get_nparray()['pixel_data'] 
-                if self.interrupt_measurement_called:
-                    break
-            
-                
-        
-        
-        elif self.cam.settings['acquisition_mode'] == 'MultiFrame':
-            """
-            If mode is Multiframe, acquire Nframes frames and eventually save them in h5 
-            """
-            self.cam.read_from_hardware()
-            number_frames  = self.cam.number_frames.val
-            first_frame_acquired = False
-            self.cam.cam.set_framenum(number_frames)
-                
-            self.cam.cam.acq_start() #exposure time already changed in the hardware
-            """Alternative:
-                self.cam.cam.acq_start_seq(num_frames = number_frames)
-                #just to set a non-circular buffer, but the frame acquisition is the same with poll_frame                   
-                #in this case, uncomment the function acq_start_seq in Device
+        # the polling loops are shared with Benchmark_pipeline
+        loop = AcquisitionLoop(self.cam.cam, self.ring, self.probes, stop=lambda: self.interrupt_measurement_called,
+                               progress=None if mode == 'Continuous' else self.set_progress)
+        try:
+            if mode == 'Continuous':
                 """
-            
-            for frame_idx in range(number_frames):
-                                
-                if self.settings['save_h5']:
-                    if not first_frame_acquired:
-                        self.create_h5_file()
-                        first_frame_acquired = True
-
-                    self.img= self.cam.cam.poll_frame()    
-                    self.image_h5[frame_idx,:,:] = self.img
-                    self.h5file.flush()
-                
-                if self.interrupt_measurement_called:
-                    break
+                If mode is Continuous, acquire frames indefinitely. No save in h5 is permormed
+                """
+                loop.run_live()
 
+            elif sequence:
+                """
+                If mode is Multiframe, acquire Nframes frames and eventually save them in h5
+                """
+                self.run_sequence(loop, number_frames, save)
 
-        self.cam.cam.acq_stop()
-        
-        if self.settings['save_h5'] and hasattr(self, 'h5file'):
-            # make sure to close the data file
-            self.h5file.close() 
-         
+            elif mode == 'MultiFrame':
+                loop.run_live(number_frames)
+        finally:
+            self.cam.cam.acq_stop()
+            # consumers drain what is left in the ring before the file is closed
+            self.ring.close()
+            for consumer in consumers:
+                consumer.stop()
+            self.update_ring_settings()
+            if self.recorder is not None:
+                self.recorder.close() # the event being saved is completed with the frames acquired
+            if analysis_period is not None:
+                self.analysis.stop()
+                self.update_analysis_settings()
+            if save:
+                try:
+                    self.report_writer_stats(self.writer.close())
+                    if getattr(self.writer, 'swmr', False):
+                        self.end_swmr()
+                    self.save_analysis()
+                    self.save_performance_report()
+                finally:
+                    # make sure to close the data file
+                    if self.h5file is not None:
+                        self.h5file.close()
+
+        for consumer in consumers:
+            if consumer.error is not None:
+                raise consumer.error
+        if self.ring.overruns:
+            self.log.warning(f'{self.ring.overruns} frames were discarded because the ring buffer was full')
+        if self.settings['dropped_frames']:
+            self.log.warning(f"{self.settings['dropped_frames']} frames were dropped by the camera")
+        if self.corrector is not None and self.corrector.frames:
+            self.settings['correction_time'] = self.corrector.ms_per_frame()
+            self.log.info(f"calibration: {self.corrector.frames} frames corrected, "
+                          f"{self.corrector.ms_per_frame():.2f} ms per frame")
+        self.log.info('pipeline timing:\n' + '\n'.join(self.probes.report()))
+        if analysis_period is not None:
+            for name, stats in self.analysis.stats().items():
+                self.log.info(f"analysis {name}: {stats['analysed']} frames analysed, {stats['skipped']} skipped")
+                if stats['error'] is not None:
+                    self.log.error(f"analysis {name} failed {stats['errors']} times: {stats['error']}")
+
+    def save_performance_report(self):
+        # timing probes of the run, stored with the data
+        if self.h5file is not None:
+            self.probes.save_attrs(self.h5_group.require_group('performance').attrs)
+        elif self.zarr_root() is not None:
+            self.zarr_root().attrs['performance'] = self.probes.summary()
+
+    def zarr_root(self):
+        # root group of the OME-Zarr recording (of the first ROI with multiple ROIs), None for the other formats
+        writer = self.writer.writers[0] if isinstance(self.writer, MultiRoiWriter) else self.writer
+        return writer.root if isinstance(writer, ZarrFrameWriter) else None
 
+    def set_progress(self, frame_index):
+        self.frame_index = frame_index
+
+    def run_sequence(self, loop, number_frames, save):
+        # MultiFrame with non-circular buffers, see AcquisitionLoop.run_sequence
+        every_frame = self.shared_ring is not None or any(lossless for name, func, lossless in self.frame_consumers)
+        refresh_period = self.settings['refresh_period']
+        if self.settings['analysis'] and self.analysis.period():
+            refresh_period = min(refresh_period, self.analysis.period()) # frames for the analysis plugins
+        loop.run_sequence(number_frames, self.record if save else None, block_frames=self.settings['h5_batch_frames'],
+                          budget_MB=self.settings['sequence_budget'], every_frame=every_frame,
+                          refresh_period=refresh_period, log=self.log)
+
+    def calibration_key(self):
+        # calibration maps are only valid for the configuration they were acquired with
+        hw = self.cam.settings
+        return calibration_key(hw['readout'], hw['gain'], hw['binning'],
+                               (hw['subarrayh_pos'], hw['subarrayv_pos'], hw['subarray_hsize'], hw['subarray_vsize']),
+                               hw['exposure_time'])
+
+    def load_calibration(self, frame_shape):
+        # sets the correctors from the maps stored for the current configuration (if calibration is on)
+        self.corrector = self.display_corrector = None
+        if not self.settings['calibration']:
+            return
+        key = self.calibration_key()
+        maps = CalibrationStore(self.settings['calibration_dir']).load(key) or {'dark': None, 'flat': None}
+        for name, data in maps.items():
+            # each map is checked on its own: a map of another shape would break the correction during the run
+            if data is not None and data.shape != tuple(frame_shape):
+                self.log.warning(f'The {name} map of {key} has shape {data.shape}, the frames {tuple(frame_shape)}: '
+                                 f'the {name} correction is not applied')
+                maps[name] = None
+        if all(data is None for data in maps.values()):
+            self.settings['calibration_status'] = f'no maps for {key}'
+            self.log.warning(f'Calibration enabled but no dark/flat maps found for {key}: frames are not corrected')
+            return
+        dtype = np.dtype(self.settings['calibration_dtype'])
+        self.corrector = FrameCorrector(maps['dark'], maps['flat'], dtype)
+        self.display_corrector = FrameCorrector(maps['dark'], maps['flat'], dtype)
+        self.settings['calibration_status'] = ' + '.join(name for name in ('dark', 'flat') if maps[name] is not None)
+
+    def acquire_calibration(self, name):
+        """
+        Acquires the dark or flat map (average of calibration_frames frames) for the current
+        camera configuration and stores it. It runs in a background thread; for the flat
+        the sample must be uniformly illuminated, for the dark the shutter closed.
+        """
+        if self.is_measuring():
+            self.log.error(f'Stop the measurement before acquiring the {name} map')
+            return
+        count = self.settings['calibration_frames']
+        store = CalibrationStore(self.settings['calibration_dir'])
 
+        def acquire():
+            self.settings['calibration_status'] = f'acquiring {name}...'
+            try:
+                self.cam.wait_ready()
+                self.cam.read_from_hardware()
+                key = self.calibration_key()
+                store.save(key, **{name: average_frames(self.cam.cam, count)})
+            except Exception as err:
+                self.settings['calibration_status'] = f'{name} failed'
+                self.log.error(f'Acquisition of the {name} map failed: {err}')
+                return
+            self.settings['calibration_status'] = f'{name} saved'
+            self.log.info(f'{name} map ({count} frames) saved for {key}')
+        threading.Thread(target=acquire, name=f'acquire_{name}', daemon=True).start()
+
+    def report_writer_stats(self, stats):
+        self.settings['writer_rate'] = stats['MBps']
+        self.settings['compression_ratio'] = stats['compression_ratio']
+        if 'files' in stats:
+            self.log.info(f"tiff writer: {stats['frames']} frames, {stats['MB']:.1f} MB at {stats['MBps']:.1f} MB/s "
+                          f"in {len(stats['files'])} file(s)")
+            return
+        compression = self.settings['zarr_compression' if self.settings['file_format'] == 'ome.zarr' else 'h5_compression']
+        self.log.info(f"{self.settings['file_format']} writer: {stats['frames']} frames, {stats['MB']:.1f} MB "
+                      f"at {stats['MBps']:.1f} MB/s, compression {compression} ratio {stats['compression_ratio']:.2f}")
 
     def create_saving_directory(self):
         
@@ -169,7 +657,183 @@ class PVcamMeasure(Measurement):
             os.makedirs(self.app.settings['save_dir'])
         
     
-    def create_h5_file(self):                   
+    def measure_disk_speed(self):
+        # write speed of the saving directory, used by the preflight check
+        self.create_saving_directory()
+        directory = self.app.settings['save_dir']
+        self.disk_rates[directory] = measure_disk_rate(directory)
+        self.settings['disk_rate'] = self.disk_rates[directory]
+        return self.disk_rates[directory]
+
+    def start_disk_probe(self):
+        # measures the disk speed in a background thread, not while a recording is running
+        if self.is_measuring():
+            self.log.error('Stop the measurement before measuring the disk speed')
+            return
+
+        def probe():
+            try:
+                rate = self.measure_disk_speed()
+            except Exception as err:
+                self.log.error(f'Measurement of the disk speed failed: {err}')
+                return
+            self.log.info(f"disk speed of {self.app.settings['save_dir']}: {rate:.0f} MB/s")
+        threading.Thread(target=probe, name='disk_probe', daemon=True).start()
+
+    def on_save_dir_changed(self):
+        if self.settings['preflight'] and self.app.settings['save_dir'] not in self.disk_rates:
+            self.start_disk_probe()
+
+    def preflight_check(self, number_frames, sequence, saved_shape, saved_dtype, saved_length):
+        """
+        Warns if a MultiFrame recording is expected to drop frames: the frames waiting to be
+        written (data rate above the disk speed) would overflow the buffers during the run,
+        or the buffers do not fit in the free memory. The run is not stopped.
+        """
+        device = self.cam.cam
+        directory = self.app.settings['save_dir']
+        disk_rate = self.disk_rates.get(directory)
+        if disk_rate is None:
+            self.log.info(f"disk speed of {directory} not measured yet ('measure disk speed'): "
+                          'the preflight only checks the memory')
+        frame_rate = device.get_rate()
+        # with multiple ROIs only the pixels of the ROIs are saved, not the padding of the tiled frames
+        saved_pixels = self.saved_layout.pixels() if self.saved_layout is not None else int(np.prod(saved_shape))
+        saved_frame_MB = saved_pixels * np.dtype(saved_dtype).itemsize / 1e6
+        saved_rate = saved_frame_MB * frame_rate * saved_length / number_frames
+        frame_MB = self.ring.frame_nbytes / 1e6
+        if sequence:
+            # the camera fills the sequence buffer whatever the disk speed: frames are only lost with the ring
+            camera_MB = min(number_frames * device.get_frame_pixels() * 2 / 1e6, self.settings['sequence_budget'])
+        else:
+            camera_MB = device.get_buffer_MB()
+        writer_MB = 3 * self.settings['h5_batch_frames'] * saved_frame_MB
+        warnings = preflight(number_frames, frame_rate, saved_rate, disk_rate,
+                             buffer_MB=camera_MB + self.ring.depth * frame_MB + writer_MB,
+                             memory_MB=camera_MB + writer_MB, available_MB=available_memory_MB())
+        if disk_rate is None:
+            ok = f'ok: {saved_rate:.0f} MB/s, disk speed unknown'
+        else:
+            ok = f'ok: {saved_rate:.0f} of {disk_rate:.0f} MB/s'
+        self.settings['preflight_status'] = '; '.join(warnings) or ok
+        for warning in warnings:
+            self.log.warning(f'preflight: {warning}')
+        return warnings
+
+    def allocate_recorder(self, frame_shape, dtype, mode):
+        # history of the rolling record, sized for pre_trigger_time within rolling_budget; None if not used
+        if mode != 'Continuous' or not self.settings['rolling_record']:
+            self.recorder = None
+            return None
+        depth = self.cam.cam.live_buffer_frames(slack_ms=self.settings['pre_trigger_time'] * 1e3,
+                                                max_MB=self.settings['rolling_budget'], min_frames=1)
+        recorder = self.recorder
+        if recorder is not None and recorder.shape == tuple(frame_shape) and recorder.dtype == dtype \
+                and recorder.depth == depth:
+            recorder.reset()
+        else:
+            self.recorder = None # release the old history before allocating the new one
+            self.recorder = RollingRecorder(frame_shape, dtype, depth)
+        self.events = 0
+        self.settings['rolling_frames'] = depth
+        self.settings['rolling_status'] = f'{depth} frames ({depth * self.cam.cam.get_frame_period_ms() * 1e-3:.1f} s) in memory'
+        return self.recorder
+
+    def record_history(self, seq, frames):
+        # rolling record consumer: one copy into the history
+        t0 = time.perf_counter()
+        self.recorder.push(frames, self.ring.metadata(seq, len(frames)))
+        self.probes['rolling_record'].add(time.perf_counter() - t0, frames.nbytes)
+
+    def trigger_event(self):
+        """
+        Saves the frames of the last pre_trigger_time seconds and of the next post_trigger_time
+        seconds to a new file (rolling record in Continuous mode). Can be called from scripts.
+        Returns True if the event is being saved.
+        """
+        recorder = self.recorder
+        if recorder is None or not self.is_measuring():
+            self.log.error('trigger event: start a Continuous acquisition with rolling_record first')
+            return False
+        event_time = time.time()
+        pre, post = self.settings['pre_trigger_time'], self.settings['post_trigger_time']
+        # upper bound of the frames of the event, the period being the shortest possible
+        max_frames = recorder.depth + int(np.ceil(post * 1e3 / self.cam.cam.get_frame_period_ms())) + 1
+        index = self.events + 1
+        event = {} # file of the event, only used by the saving thread of the recorder
+        if not recorder.trigger(pre, post, lambda length: self.open_event_writer(recorder, length, index, event),
+                                max_frames, lambda stats, error: self.on_event_saved(index, event, stats, error),
+                                event_time):
+            self.log.warning('trigger event ignored: the previous event is still being saved')
+            return False
+        self.events = index
+        self.settings['rolling_status'] = f'saving event {index}'
+        return True
+
+    def open_event_writer(self, recorder, length, index, event):
+        # runs in the saving thread of the recorder: the writer and file of the event are kept
+        # in event, not in the attributes of the measurement
+        writer, event['h5file'], _ = self.create_file(recorder.shape, recorder.dtype, length, suffix=f'_event{index}')
+        if event['h5file'] is not None and not writer.swmr:
+            writer.dataset.attrs['pre_trigger_time'] = self.settings['pre_trigger_time']
+            writer.dataset.attrs['post_trigger_time'] = self.settings['post_trigger_time']
+        return writer
+
+    def on_event_saved(self, index, event, stats, error):
+        # runs in the saving thread of the recorder, after the writer of the event is closed
+        h5file = event.pop('h5file', None)
+        if h5file is not None:
+            try:
+                h5file.close()
+            except Exception as err:
+                error = error or err
+        if error is not None:
+            self.settings['rolling_status'] = f'event {index} failed'
+            self.log.error(f'Saving event {index} failed: {error}')
+            return
+        self.settings['rolling_status'] = f"event {index} saved ({stats['frames']} frames)"
+        self.log.info(f"event {index}: {stats['frames']} frames saved, {self.recorder.dropped if self.recorder else 0} "
+                      f"frames left out of the history while saving")
+
+    def create_file(self, img_size, dtype, length, suffix=''):
+        """
+        Creates a writer for the chosen file format; suffix is added to the file name.
+        Returns (writer, h5file, h5 measurement group), the last two None for TIFF and Zarr.
+        """
+        layout = self.saved_layout
+        if layout is not None and self.settings['file_format'] != 'h5':
+            # one file per ROI, named with the suffix _roi<index>
+            create = self.create_tiff_file if self.settings['file_format'] == 'ome.tif' else self.create_zarr_file
+            writers = [create(shape, dtype, length, f'{suffix}_roi{index}') for index, shape in enumerate(layout.shapes)]
+            return MultiRoiWriter(layout, writers), None, None
+        if self.settings['file_format'] == 'ome.tif':
+            return self.create_tiff_file(img_size, dtype, length, suffix), None, None
+        if self.settings['file_format'] == 'ome.zarr':
+            return self.create_zarr_file(img_size, dtype, length, suffix), None, None
+        return self.create_h5_file(img_size, dtype, length, suffix)
+
+    def sampling_um(self):
+        # (z, y, x) sampling of the saved frames
+        bin_y, bin_x = (1, 1) if self.reducer is None else (self.reducer.bin_y, self.reducer.bin_x)
+        return [self.settings['zsampling'], self.settings['ysampling'] * bin_y, self.settings['xsampling'] * bin_x]
+
+    def create_tiff_file(self, img_size, dtype, length, suffix=''):
+        fname = self.file_name('.ome.tif', suffix)
+        max_size = self.settings['tiff_max_file_size'] * 1e9
+        return TiffFrameWriter(fname, length, img_size, dtype, sampling_um=self.sampling_um(),
+                               batch_frames=self.settings['h5_batch_frames'],
+                               max_file_size=max_size or None)
+
+    def create_zarr_file(self, img_size, dtype, length, suffix=''):
+        return ZarrFrameWriter(self.file_name('.ome.zarr', suffix), length, img_size, dtype,
+                               chunk_frames=self.settings['zarr_chunk_frames'],
+                               compression=self.settings['zarr_compression'],
+                               workers=self.settings['zarr_workers'],
+                               executor=self.settings['zarr_executor'],
+                               pyramid_levels=self.settings['zarr_pyramid_levels'],
+                               sampling_um=self.sampling_um(), meta_dtype=META_DTYPE)
+
+    def file_name(self, extension, suffix=''):
         self.create_saving_directory()
         # file name creation
         timestamp = time.strftime("%y%m%d_%H%M%S", time.localtime())
@@ -179,16 +843,72 @@ class PVcamMeasure(Measurement):
             sample_name = '_'.join([timestamp, self.name])
         else:
             sample_name = '_'.join([timestamp, self.name, sample])
-        fname = os.path.join(self.app.settings['save_dir'], sample_name + '.h5')
-        
-        self.h5file = h5_io.h5_base_file(app=self.app, measurement=self, fname = fname)
-        self.h5_group = h5_io.h5_create_measurement_group(measurement=self, h5group=self.h5file)
-        
-        img_size = self.img.shape
-        dtype=self.img.dtype
+        return os.path.join(self.app.settings['save_dir'], sample_name + suffix + extension)
+
+    def create_h5_file(self, img_size, dtype, length=None, suffix=''):
+        # returns (writer, h5file, h5 measurement group)
+        fname = self.file_name('.h5', suffix)
+        if self.settings['h5_swmr']:
+            h5file = self.create_swmr_file(fname)
+        else:
+            h5file = h5_io.h5_base_file(app=self.app, measurement=self, fname = fname)
+        h5_group = h5_io.h5_create_measurement_group(measurement=self, h5group=h5file)
         
-        length = self.cam.number_frames.val
-        self.image_h5 = self.h5_group.create_dataset(name  = 't0/c0/image', 
-                                                  shape = [length, img_size[0], img_size[1]],
-                                                  dtype = dtype)
-        self.image_h5.attrs['element_size_um'] =  [self.settings['zsampling'],self.settings['ysampling'],self.settings['xsampling']]
\ No newline at end of file
+        if length is None:
+            length = self.cam.number_frames.val
+        options = dict(chunk_frames=self.settings['h5_chunk_frames'],
+                       batch_frames=self.settings['h5_batch_frames'],
+                       compression=self.settings['h5_compression'],
+                       flush_interval=self.settings['h5_flush_interval'],
+                       flush_size=self.settings['h5_flush_size'] * 1e6, probes=self.probes)
+        layout = self.saved_layout
+        if layout is None:
+            writer = H5FrameWriter(h5_group, 't0/c0/image', length, img_size, dtype,
+                                   meta_dtype=META_DTYPE, **options)
+            datasets = [writer.dataset]
+        else:
+            # one dataset per ROI (t0/c0/roi<index>), the metadata is shared
+            writer = MultiRoiWriter(layout, [H5FrameWriter(h5_group, f't0/c0/roi{index}', length, shape,
+                                                           dtype, meta_dtype=None if index else META_DTYPE,
+                                                           **options)
+                                             for index, shape in enumerate(layout.shapes)])
+            datasets = writer.datasets
+            for dataset, roi in zip(datasets, layout.rois):
+                dataset.attrs['roi'] = roi # h0, v0, width, height in sensor pixels
+        h5_writers = writer.writers if isinstance(writer, MultiRoiWriter) else [writer]
+        if any(item.chunk_clamped for item in h5_writers):
+            self.log.info(f"h5_chunk_frames reduced from {self.settings['h5_chunk_frames']} to "
+                          f"{min(item.chunk_frames for item in h5_writers)}: chunks are kept below "
+                          f"{MAX_CHUNK_BYTES / 1e6:.0f} MB")
+        for field in ('timestamp_bof', 'timestamp_eof', 'exposure_time'):
+            writer.meta_datasets[field].attrs['unit'] = 'ns'
+        writer.meta_datasets['host_time'].attrs['unit'] = 's'
+        for dataset in datasets:
+            dataset.attrs['element_size_um'] = self.sampling_um()
+            if self.reducer is not None:
+                dataset.attrs['reduction'] = self.reducer.mode
+                dataset.attrs['reduction_frames'] = self.reducer.frames
+                dataset.attrs['reduction_stride'] = self.reducer.stride
+                dataset.attrs['software_binning'] = [self.reducer.bin_y, self.reducer.bin_x]
+        if self.settings['h5_swmr']:
+            # from here on the file only grows: readers can follow it while it is written
+            writer.start_swmr()
+            self.log.info(f'{fname} is open for SWMR readers')
+        return writer, h5file, h5_group
+
+    def create_swmr_file(self, fname):
+        # same content as h5_io.h5_base_file, in a file with the latest format (required by SWMR)
+        h5file = h5py.File(fname, 'w', libver='latest')
+        root = h5file['/']
+        root.attrs['ScopeFoundry_version'] = 100
+        root.attrs['time_id'] = time.time()
+        h5_io.h5_save_app_lq(self.app, root)
+        h5_io.h5_save_hardware_lq(self.app, root)
+        return h5file
+
+    def end_swmr(self):
+        # groups and attributes cannot be added in SWMR mode: the file is reopened in normal mode
+        fname, group = self.h5file.filename, self.h5_group.name
+        self.h5file.close()
+        self.h5file = h5py.File(fname, 'r+', libver='latest')
+        self.h5_group = self.h5file[group]
\ No newline at end of file
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 07:40:05 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Playback backend: PlaybackCamera replays the frames of a recording (the t0/c0/image
+dataset of an HDF5 file saved by CameraMeasurement, or a multipage TIFF) through the
+SimCamera interface, so that the whole pipeline (display, compression, analysis)
+runs on real data without the microscope. Frames are read through a memory map of
+the file when its layout allows it.
+"""
+
+import os
+import threading
+import numpy as np
+from CameraSim import SimCamera
+
+
+class Recording(object):
+    """
+    Frames of a recording: frame(index) returns frame index as a 2D array (a view of the
+    memory-mapped file when possible). period is the median interval between the recorded
+    frames in seconds (from the saved host_time), None if the file has no timing.
+    """
+
+    def __init__(self, path, memmap=True):
+        self.path = path
+        self.period = None
+        self.memmapped = False
+        self._lock = threading.Lock()
+        if path.lower().endswith(('.h5', '.hdf5')):
+            self._open_h5(memmap)
+        elif path.lower().endswith(('.tif', '.tiff')):
+            self._open_tiff(memmap)
+        else:
+            raise ValueError(f'{path}: only HDF5 (.h5) and TIFF (.tif) recordings can be played back.')
+        if self.length < 1:
+            raise ValueError(f'{path} holds no frames.')
+
+    def _open_h5(self, memmap):
+        import h5py
+        self._h5 = h5py.File(self.path, 'r')
+        names = []
+        self._h5.visititems(lambda name, item: names.append(name) if isinstance(item, h5py.Dataset)
+                            and name.endswith(('t0/c0/image', 't0/c0/roi0')) else None)
+        if not names:
+            raise ValueError(f'{self.path} has no t0/c0/image dataset.')
+        self._dataset = dataset = self._h5[names[0]]
+        if dataset.ndim == 2:
+            self._dataset = dataset = dataset[np.newaxis]
+        self.length = len(dataset)
+        self.shape = dataset.shape[1:]
+        self.dtype = dataset.dtype
+        host_time = dataset.parent.get('host_time')
+        if host_time is not None and len(host_time) > 1:
+            intervals = np.diff(host_time[:])
+            intervals = intervals[intervals > 0]
+            self.period = float(np.median(intervals)) if len(intervals) else None
+        self._offsets = self._chunk_offsets(dataset) if memmap and isinstance(dataset, h5py.Dataset) else None
+        if self._offsets is not None:
+            self._map = np.memmap(self.path, dtype=np.uint8, mode='r')
+            self.memmapped = True
+
+    def _chunk_offsets(self, dataset):
+        # file offset of each frame of an uncompressed dataset, None if the frames cannot be mapped
+        if dataset.id.get_create_plist().get_nfilters():
+            return None
+        frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        if dataset.chunks is None:
+            start = dataset.id.get_offset()
+            return None if start is None else [start + index * frame_nbytes for index in range(self.length)]
+        if dataset.chunks[1:] != self.shape:
+            return None # chunks split the frames
+        offsets = []
+        per_chunk = dataset.chunks[0]
+        for index in range(0, self.length, per_chunk):
+            chunk = dataset.id.get_chunk_info_by_coord((index, 0, 0))
+            if chunk.byte_offset is None:
+                return None
+            offsets.extend(chunk.byte_offset + within * frame_nbytes
+                           for within in range(min(per_chunk, self.length - index)))
+        return offsets
+
+    def _open_tiff(self, memmap):
+        from TiffWriter import import_tifffile
+        tifffile = import_tifffile()
+        self._tif = tifffile.TiffFile(self.path)
+        self._stack = None
+        if memmap:
+            try:
+                self._stack = tifffile.memmap(self.path, mode='r')
+                self.memmapped = True
+            except ValueError:
+                pass # compressed or non-contiguous pages are read one by one
+        if self._stack is not None:
+            if self._stack.ndim == 2:
+                self._stack = self._stack[np.newaxis]
+            self._stack = self._stack.reshape((-1,) + self._stack.shape[-2:])
+            self.length = len(self._stack)
+            self.shape = self._stack.shape[1:]
+            self.dtype = self._stack.dtype
+        else:
+            page = self._tif.pages[0]
+            self.length = len(self._tif.pages)
+            self.shape = page.shape[-2:]
+            self.dtype = page.dtype
+
+    def frame(self, index):
+        if getattr(self, '_offsets', None) is not None:
+            start = self._offsets[index]
+            return self._map[start:start + int(np.prod(self.shape)) * self.dtype.itemsize].view(self.dtype).reshape(self.shape)
+        if getattr(self, '_stack', None) is not None:
+            return self._stack[index]
+        with self._lock:
+            if hasattr(self, '_dataset'):
+                return self._dataset[index]
+            return self._tif.pages[index].asarray()
+
+    def close(self):
+        self._offsets = self._stack = self._map = None
+        if hasattr(self, '_h5'):
+            self._h5.close()
+        if hasattr(self, '_tif'):
+            self._tif.close()
+
+
+class PlaybackCamera(SimCamera):
+    """
+    SimCamera whose frames come from the recording at path (see Recording); the sensor has
+    the size of the recorded frames, ROI and binning crop and bin them.
+    playback_speed: 1 replays at the recorded frame rate (or at the rate of exposure and
+        readout time if the file has no timing), N at N times that rate, 0 as fast as possible:
+        then no frame is overwritten, the playback waits for the frames to be polled.
+    loop: start again from the first frame at the end of the recording; otherwise the camera
+        stops producing frames (poll_frame times out).
+    memmap: read the frames through a memory map of the file when its layout allows it.
+    """
+
+    def __init__(self, path, playback_speed=1.0, loop=True, memmap=True, name=None, **options):
+        if not path or not os.path.isfile(path):
+            raise ValueError(f'Playback file {path} not found.')
+        self.recording = Recording(path, memmap)
+        rows, cols = self.recording.shape
+        bit_depth = 8 * self.recording.dtype.itemsize if self.recording.dtype.kind == 'u' else 16
+        options.setdefault('serial_no', 'PLAYBACK')
+        super().__init__(name=name or f'Playback {os.path.basename(path)}', sensor_size=(cols, rows),
+                         bit_depth=min(bit_depth, 16), **options)
+        self.playback_speed = playback_speed
+        self.loop = loop
+
+    def frame_period(self):
+        if self.playback_speed <= 0:
+            return 0.0
+        period = self.recording.period or super().frame_period()
+        return period / self.playback_speed
+
+    def _make_banks(self):
+        return None # the frames come from the recording
+
+    def _store_frame(self, t_begin, t_end):
+        # called with self._cond held
+        if not self.loop and self._written >= self.recording.length:
+            self._cond.wait_for(lambda: not self._running) # end of the recording: no more frames
+            return
+        if self.playback_speed <= 0:
+            self._cond.wait_for(lambda: self._written - self._read < len(self._buffer) or not self._running)
+            if not self._running:
+                return
+        super()._store_frame(t_begin, t_end)
+
+    def _fill_slot(self, slot, index):
+        frame = self.recording.frame(index % self.recording.length)
+        bin_x, bin_y = self._binning
+        offset = 0
+        for (s1, p1, _, _), (rows, cols) in zip(self._roi_list(), self._shapes):
+            pixels = frame[p1:p1 + rows * bin_y, s1:s1 + cols * bin_x]
+            if bin_x * bin_y > 1:
+                pixels = np.minimum(pixels.reshape(rows, bin_y, cols, bin_x).sum(axis=(1, 3)), 65535)
+            np.copyto(slot[offset:offset + rows * cols].reshape(rows, cols), pixels, casting='unsafe')
+            offset += rows * cols
+
+    def close(self):
+        super().close()
+        self.recording.close()
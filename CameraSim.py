@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:40:22 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Simulated PVCAM backend: SimCamera has the subset of the pyvcam Camera interface
+used by PVcamDevice, and this module plays the role of pyvcam.pvc
+(init_pvcam/uninit_pvcam). Frames are produced by a thread at the rate given by
+exposure and readout time and stored in a finite buffer, which overruns
+(the oldest frames are lost) when they are not polled fast enough.
+"""
+
+import threading
+import time
+import numpy as np
+
+EXP_MODES = ['Internal Trigger', 'Edge Trigger', 'Trigger First', 'Software Trigger Edge', 'Software Trigger First']
+WAIT_FOREVER = -1
+# parameter ids and attributes used with get_param, as in pyvcam.constants
+PARAM_EXPOSURE_TIME = 134414337
+PARAM_ROI_COUNT = 100796096
+PARAM_BINNING_SER = 151126181
+PARAM_BINNING_PAR = 151126182
+ATTR_MIN = 3
+ATTR_MAX = 4
+# exposure resolutions (units of exp_time), as in pyvcam.constants
+EXP_RES_ONE_MILLISEC = 0
+EXP_RES_ONE_MICROSEC = 1
+EXP_RES_UNIT_MS = {EXP_RES_ONE_MILLISEC: 1.0, EXP_RES_ONE_MICROSEC: 1e-3}
+SIM_BINNINGS = (1, 2, 4, 8)
+# readout ports of the Retiga E7: name, pixel times (ns) of the speeds, gains (index, name, bit depth), max exposure (ms)
+SIM_PORTS = [('Speed', [10], [(1, 'Dynamic Range', 12)], 1000),
+             ('Long Exposure', [40, 80], [(1, 'Full Well', 12), (2, 'Sensitivity', 12)], 3600000),
+             ('Long Exposure EDR', [40], [(1, 'Full Well', 16), (2, 'Sensitivity', 16)], 3600000)]
+
+_initialized = False
+
+
+def init_pvcam():
+    global _initialized
+    _initialized = True
+
+
+def uninit_pvcam():
+    global _initialized
+    _initialized = False
+
+
+class SimCamera(object):
+    """
+    sensor_size: (width, height) in pixels
+    bit_depth: pixel values are in [0, 2**bit_depth - 1], stored as uint16
+    line_time_us: readout time of one (binned) row for readout port 0, the other ports are 4 times slower
+    frame_rate: if given, fixes the frame rate instead of using exposure and readout time
+    ext_trigger_rate: rate (Hz) of the simulated external trigger for 'Edge Trigger' and 'Trigger First';
+        None: frames are only triggered by calls to ext_trigger()
+    max_rois: ROIs acquired in one exposure; with several ROIs poll_frame returns a list of arrays
+        and only the sensor rows covered by the ROIs are read out
+    """
+
+    def __init__(self, name='PVCamSim', sensor_size=(3200, 2200), bit_depth=12, line_time_us=15.0,
+                 frame_rate=None, ext_trigger_rate=None, serial_no='SIM0001', seed=0, max_rois=15):
+        self.name = name
+        self.serial_no = serial_no
+        self.sensor_size = tuple(sensor_size)
+        self.bit_depth = bit_depth
+        self.line_time_us = line_time_us
+        self.frame_rate = frame_rate
+        self.ext_trigger_rate = ext_trigger_rate
+        self.max_rois = max_rois
+        self._rng = np.random.default_rng(seed)
+
+        self.is_open = False
+        self.metadata_enabled = False
+        self.exp_res = EXP_RES_ONE_MILLISEC
+        self.exp_time = 20 # in units of exp_res
+        self.readout_port = 0
+        self.speed = 0
+        self.speed_table_index = 0
+        self.gain = 1
+        self.temp_setpoint = -20.0
+        self._exp_mode = 'Internal Trigger'
+        self._binning = (1, 1)
+        self._rois = []
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._buffer = None
+        self._written = 0 # frames stored in the buffer since the acquisition started
+        self._read = 0 # frames polled or lost
+        self._triggers = 0 # pending software/external triggers
+        self.lost_frames = 0 # frames overwritten before being polled
+        self._last_poll = None
+
+    @classmethod
+    def detect_camera(cls, **options):
+        yield cls(**options)
+
+    def open(self):
+        if not _initialized:
+            raise RuntimeError('PVCAM library not initialized (init_pvcam).')
+        self.is_open = True
+
+    def close(self):
+        self.finish()
+        self.is_open = False
+
+    # settings
+
+    @property
+    def binning(self):
+        return self._binning
+
+    @binning.setter
+    def binning(self, value):
+        if isinstance(value, tuple):
+            self._binning = (int(value[0]), int(value[1]))
+        else:
+            self._binning = (int(value), int(value))
+
+    @property
+    def exp_mode(self):
+        return self._exp_mode
+
+    @exp_mode.setter
+    def exp_mode(self, mode):
+        if mode not in EXP_MODES:
+            raise ValueError(f'Invalid exposure mode {mode}, choose among {EXP_MODES}.')
+        self._exp_mode = mode
+
+    @property
+    def temp(self):
+        return round(self.temp_setpoint + self._rng.normal(0, 0.05), 2)
+
+    def reset_rois(self):
+        self._rois = []
+
+    def set_roi(self, s1, p1, width, height):
+        if s1 < 0 or p1 < 0 or s1 + width > self.sensor_size[0] or p1 + height > self.sensor_size[1]:
+            raise ValueError(f'ROI ({s1}, {p1}, {width}, {height}) is outside the sensor.')
+        if len(self._rois) >= self.max_rois:
+            raise ValueError(f'At most {self.max_rois} ROIs can be set.')
+        self._rois.append((s1, p1, width, height))
+
+    def _roi_list(self):
+        return list(self._rois) or [(0, 0) + self.sensor_size]
+
+    def shape(self, roi_index=0):
+        # (width, height) of the binned frames of a ROI, as in pyvcam
+        s1, p1, width, height = self._roi_list()[roi_index]
+        return (width // self._binning[0], height // self._binning[1])
+
+    @property
+    def readout_time(self):
+        # microseconds: the sensor rows covered by at least one ROI are read out
+        covered = np.zeros(self.sensor_size[1], dtype=bool)
+        for s1, p1, width, height in self._roi_list():
+            covered[p1:p1 + height] = True
+        rows = int(np.count_nonzero(covered)) // self._binning[1]
+        return int(rows * self.line_time_us * (1 if self.readout_port == 0 else 4))
+
+    @property
+    def exp_resolutions(self):
+        return {'One Millisecond': EXP_RES_ONE_MILLISEC, 'One Microsecond': EXP_RES_ONE_MICROSEC}
+
+    def exposure_ms(self):
+        return self.exp_time * EXP_RES_UNIT_MS[self.exp_res]
+
+    def frame_period(self):
+        # seconds between two frames in free-running mode
+        if self.frame_rate:
+            return 1.0 / self.frame_rate
+        return self.exposure_ms() * 1e-3 + self.readout_time * 1e-6
+
+    @property
+    def port_speed_gain_table(self):
+        # same layout as pyvcam: {port name: {'port_value', 'Speed_<i>': {'speed_index', 'pixel_time', <gain name>: {...}}}}
+        table = {}
+        for port, (port_name, pixel_times, gains, _) in enumerate(SIM_PORTS):
+            table[port_name] = {'port_value': port}
+            for speed, pixel_time in enumerate(pixel_times):
+                entry = {'speed_index': speed, 'pixel_time': pixel_time, 'gain_range': [gain for gain, _, _ in gains]}
+                for gain, gain_name, bit_depth in gains:
+                    entry[gain_name] = {'gain_index': gain, 'bit_depth': bit_depth}
+                table[port_name][f'Speed_{speed}'] = entry
+        return table
+
+    def get_param(self, param_id, param_attr=0):
+        if param_id == PARAM_EXPOSURE_TIME and param_attr == ATTR_MIN:
+            return 0
+        if param_id == PARAM_EXPOSURE_TIME and param_attr == ATTR_MAX:
+            return int(SIM_PORTS[self.readout_port][3] / EXP_RES_UNIT_MS[self.exp_res])
+        if param_id == PARAM_ROI_COUNT and param_attr == ATTR_MAX:
+            return self.max_rois
+        raise AttributeError(f'Parameter {param_id} is not available in the simulated camera.')
+
+    def read_enum(self, param_id):
+        # {name: value} of an enumerated parameter, as in pyvcam
+        if param_id in (PARAM_BINNING_SER, PARAM_BINNING_PAR):
+            return {str(value): value for value in SIM_BINNINGS}
+        raise AttributeError(f'Parameter {param_id} is not available in the simulated camera.')
+
+    # acquisition
+
+    def start_live(self, exp_time=None, buffer_frame_count=16, stream_to_disk_path=None):
+        self._start(exp_time, buffer_frame_count, None)
+
+    def start_seq(self, exp_time=None, num_frames=1):
+        self._start(exp_time, num_frames, num_frames)
+
+    def _start(self, exp_time, buffer_frames, num_frames):
+        if self._running:
+            raise RuntimeError('Acquisition already in progress.')
+        if exp_time is not None:
+            self.exp_time = exp_time
+        # each slot holds the pixels of all the ROIs one after the other, as the PVCAM buffer
+        self._shapes = [self.shape(index)[::-1] for index in range(len(self._roi_list()))]
+        self._buffer = np.empty((buffer_frames, sum(rows * cols for rows, cols in self._shapes)), dtype=np.uint16)
+        self._buffer.fill(0) # pages mapped now, as PVCAM does with its buffer, not while the frames arrive
+        self._frame_nr = np.zeros(buffer_frames, dtype=np.int64) # per-slot frame number and timestamps
+        self._t_begin = np.zeros(buffer_frames)
+        self._t_end = np.zeros(buffer_frames)
+        self._bank = self._make_banks()
+        self._written = self._read = self._triggers = 0
+        self.lost_frames = 0
+        self._last_poll = None
+        self._running = True
+        self._thread = threading.Thread(target=self._acquire, args=(num_frames,), name='sim_camera', daemon=True)
+        self._thread.start()
+
+    def _make_banks(self):
+        # frames cycled by _fill_slot, with the pixels of all the ROIs one after the other
+        return np.concatenate([self._make_bank(roi, rows, cols).reshape(4, -1)
+                               for roi, (rows, cols) in zip(self._roi_list(), self._shapes)], axis=1)
+
+    def _make_bank(self, roi, height, width, count=4):
+        # a few noisy frames of a ROI generated once and cycled: producing new noise for every frame
+        # would limit the simulated frame rate far below the one of the real sensor
+        s1, p1, roi_w, roi_h = roi
+        bx, by = self._binning
+        y = (p1 + (np.arange(height) + 0.5) * by)[:, None] / self.sensor_size[1]
+        x = (s1 + (np.arange(width) + 0.5) * bx)[None, :] / self.sensor_size[0]
+        full_scale = 2 ** self.bit_depth - 1
+        signal = 0.1 + 0.5 * np.exp(-((x - 0.5) ** 2 + (y - 0.5) ** 2) / 0.05)
+        bank = np.empty((count, height, width), dtype=np.uint16)
+        for index in range(count):
+            noisy = signal * full_scale * bx * by * 0.25 + self._rng.normal(0, 0.01 * full_scale, (height, width))
+            np.clip(noisy, 0, full_scale, out=noisy)
+            bank[index] = noisy
+        return bank
+
+    def _acquire(self, num_frames):
+        triggered_mode = self._exp_mode != 'Internal Trigger'
+        first_only = self._exp_mode in ('Trigger First', 'Software Trigger First')
+        period = self.frame_period()
+        start = time.perf_counter()
+        next_time = start + period
+        while True:
+            if triggered_mode and not (first_only and self._written > 0):
+                with self._cond:
+                    if not self._cond.wait_for(lambda: self._triggers > 0 or not self._running,
+                                               self._trigger_timeout()):
+                        self._triggers += 1 # simulated external trigger pulse
+                    if not self._running:
+                        return
+                    self._triggers -= 1
+                next_time = time.perf_counter() + period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            with self._cond:
+                if not self._running:
+                    return
+                self._store_frame(next_time - period, next_time)
+                self._cond.notify_all()
+                if num_frames is not None and self._written >= num_frames:
+                    return
+            next_time += period
+
+    def _trigger_timeout(self):
+        if self._exp_mode in ('Edge Trigger', 'Trigger First') and self.ext_trigger_rate:
+            return 1.0 / self.ext_trigger_rate
+        return None
+
+    def _store_frame(self, t_begin, t_end):
+        depth = len(self._buffer)
+        if self._written - self._read >= depth:
+            # circular buffer full: the oldest frame is overwritten
+            self._read += 1
+            self.lost_frames += 1
+        slot = self._written % depth
+        self._fill_slot(self._buffer[slot], self._written)
+        self._written += 1
+        self._frame_nr[slot] = self._written # PVCAM frame numbers start from 1
+        self._t_begin[slot] = t_begin
+        self._t_end[slot] = t_end
+
+    def _fill_slot(self, slot, index):
+        # pixels of the frame number index (from 0) of the acquisition
+        np.copyto(slot, self._bank[index % len(self._bank)])
+
+    def sw_trigger(self):
+        with self._cond:
+            self._triggers += 1
+            self._cond.notify_all()
+
+    def ext_trigger(self):
+        # simulated external trigger pulse
+        self.sw_trigger()
+
+    def poll_frame(self, timeout_ms=WAIT_FOREVER, oldestFrame=True, copyData=True):
+        timeout = None if timeout_ms is None or timeout_ms < 0 else timeout_ms * 1e-3
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._written > self._read or not self._running, timeout) \
+                    or self._written == self._read:
+                raise RuntimeError('Frame timeout. Verify the timeout exceeds the exposure time. '
+                                   'If applicable, verify external trigger conditions.')
+            if not oldestFrame:
+                self._read = self._written - 1
+            slot = self._read % len(self._buffer)
+            self._read += 1
+            self._cond.notify_all()
+            frame_nr, t_begin, t_end = int(self._frame_nr[slot]), self._t_begin[slot], self._t_end[slot]
+            data = self._buffer[slot].copy() if copyData else self._buffer[slot]
+        # one array per ROI (a single array with one ROI), as pyvcam
+        offsets = np.cumsum([0] + [rows * cols for rows, cols in self._shapes])
+        data = [data[start:end].reshape(shape) for start, end, shape in zip(offsets, offsets[1:], self._shapes)]
+        if len(data) == 1:
+            data = data[0]
+        now = time.perf_counter()
+        fps = 0.0 if self._last_poll is None or now == self._last_poll else 1.0 / (now - self._last_poll)
+        self._last_poll = now
+        frame = {'pixel_data': data}
+        if self.metadata_enabled:
+            frame['meta_data'] = {'frame_header': {'frameNr': frame_nr,
+                                                   'timestampBOF': int(t_begin * 1e9),
+                                                   'timestampEOF': int(t_end * 1e9),
+                                                   'timestampResNs': 1,
+                                                   'exposureTime': int(self.exposure_ms() * 1e6),
+                                                   'exposureTimeResNs': 1,
+                                                   'roiCount': len(self._shapes),
+                                                   'bitDepth': self.bit_depth},
+                                  'roi_headers': [{'roiNr': index + 1} for index in range(len(self._shapes))]}
+        return frame, fps, frame_nr
+
+    def finish(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
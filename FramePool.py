@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:27:51 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Leases on frames that point into the PVCAM buffer (poll_frame with copyData=False)
+and a preallocated pool where a leased frame is copied when it must outlive the buffer.
+"""
+
+import threading
+import time
+import numpy as np
+
+
+def stack_frames(frames):
+    """
+    (n, rows, columns) array of the frames (2D arrays of the same shape and dtype).
+    Frames leased from one PVCAM sequence buffer lie at a constant stride (frame plus metadata
+    header): they are returned as a strided view of the buffer, without copies, valid while the
+    buffer is (until acq_stop). Frames at other addresses are stacked into a new array.
+    """
+    first = frames[0]
+    if len(frames) > 1:
+        stride = frames[1].ctypes.data - first.ctypes.data
+        if stride >= first.nbytes and all(frame.ctypes.data == first.ctypes.data + index * stride
+                                          and frame.shape == first.shape and frame.strides == first.strides
+                                          for index, frame in enumerate(frames)):
+            return np.lib.stride_tricks.as_strided(first, (len(frames),) + first.shape, (stride,) + first.strides,
+                                                   writeable=False)
+    return np.stack(frames)
+
+
+class FramePool(object):
+    """
+    Preallocated set of frames of the same shape and dtype.
+    acquire() hands out a free slot as a PooledFrame, PooledFrame.release() returns it.
+    """
+
+    def __init__(self, shape, dtype=np.uint16, size=8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frames = np.empty((size,) + self.shape, dtype=self.dtype)
+        self.frames.fill(0)  # touch the pages now, not during the acquisition
+        self._free = list(range(size))
+        self._cond = threading.Condition()
+
+    @property
+    def size(self):
+        return len(self.frames)
+
+    def available(self):
+        with self._cond:
+            return len(self._free)
+
+    def acquire(self, timeout=0):
+        """
+        Returns a free PooledFrame. Waits up to timeout seconds (None: forever)
+        and raises RuntimeError if no frame is released in time.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._free, timeout):
+                raise RuntimeError(f'FramePool exhausted: all {self.size} frames are in use.')
+            index = self._free.pop()
+        return PooledFrame(self, index)
+
+    def _release(self, index):
+        with self._cond:
+            self._free.append(index)
+            self._cond.notify()
+
+
+class PooledFrame(object):
+    """
+    Frame owned by a FramePool until release() is called.
+    """
+
+    def __init__(self, pool, index):
+        self._pool = pool
+        self._index = index
+        self.data = pool.frames[index]
+
+    def release(self):
+        if self.data is not None:
+            self.data = None
+            self._pool._release(self._index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class FrameLease(object):
+    """
+    Frame returned by PVcamDevice.lease_frame.
+    In zero-copy mode data is a view of the PVCAM buffer: it is only valid until
+    release() is called, and release() must be called before the next frame is leased.
+    In live mode the camera overwrites the frame when its circular buffer wraps around,
+    even if the lease is held: deadline is an estimate of the time.perf_counter() time after which this
+    may happen (None: never, e.g. sequence mode), and release() sets overwritten (and calls
+    on_overwritten(lease)) if it was passed, i.e. data (and any copy made by keep) may mix two frames.
+    keep() copies the frame once into a FramePool for consumers that need it longer.
+    meta is the frame metadata tuple (see PVcamDevice.frame_metadata), fps the rate reported by PVCAM.
+    """
+
+    def __init__(self, data, frame_count, zero_copy, meta=None, fps=0.0, deadline=None, on_overwritten=None):
+        self._data = data
+        self.frame_count = frame_count
+        self.zero_copy = zero_copy
+        self.meta = meta
+        self.fps = fps
+        self.deadline = deadline
+        self.overwritten = False
+        self._on_overwritten = on_overwritten
+
+    @property
+    def released(self):
+        return self._data is None
+
+    @property
+    def data(self):
+        if self._data is None:
+            raise RuntimeError(f'Frame {self.frame_count} has already been released.')
+        return self._data
+
+    def keep(self, pool):
+        """
+        Copies the frame into a frame of pool and returns it as a PooledFrame.
+        The lease itself still has to be released.
+        """
+        kept = pool.acquire()
+        np.copyto(kept.data, self.data)
+        return kept
+
+    def release(self):
+        if self._data is not None and self.deadline is not None and time.perf_counter() > self.deadline:
+            self.overwritten = True
+            if self._on_overwritten is not None:
+                self._on_overwritten(self)
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:14:05 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Reduction of the frame stream before saving: software binning with any factor
+and accumulation of consecutive frames (sum, average, rolling mean or max).
+All the operations are vectorized and run in place on preallocated buffers.
+"""
+
+import numpy as np
+
+REDUCTION_MODES = ['none', 'sum', 'average', 'rolling_mean', 'rolling_max']
+
+
+class FrameReducer(object):
+    """
+    Reduces frames of shape frame_shape (rows, columns):
+    bin_x, bin_y: software binning factors (pixels are summed, partial bins at the edges are dropped)
+    mode: 'none' one output per frame,
+          'sum'/'average' one output every `frames` frames,
+          'rolling_mean'/'rolling_max' projection of the last `frames` frames, one output every `stride` frames.
+    Sums are accumulated in uint32 (uint64 when they could overflow), means in float32.
+    """
+
+    def __init__(self, frame_shape, dtype=np.uint16, mode='none', frames=1, stride=1, bin_x=1, bin_y=1):
+        if mode not in REDUCTION_MODES:
+            raise ValueError(f'Unknown reduction mode {mode}, choose among {REDUCTION_MODES}.')
+        if frames < 1 or stride < 1 or bin_x < 1 or bin_y < 1:
+            raise ValueError('frames, stride and binning factors must be positive.')
+        self.mode = mode
+        self.frames = frames if mode != 'none' else 1
+        self.stride = stride
+        self.bin_x = bin_x
+        self.bin_y = bin_y
+        self.input_shape = tuple(frame_shape)
+        self.input_dtype = np.dtype(dtype)
+        self.shape = (frame_shape[0] // bin_y, frame_shape[1] // bin_x)
+        if min(self.shape) < 1:
+            raise ValueError(f'Binning {bin_x}x{bin_y} is larger than the frame {frame_shape}.')
+
+        # dtype of the binned frames and of the output frames
+        binned_max = int(np.iinfo(self.input_dtype).max) * bin_x * bin_y if self.input_dtype.kind in 'ui' else None
+        if binned_max is None:
+            self.binned_dtype = np.dtype(np.float64)
+        elif bin_x * bin_y == 1:
+            self.binned_dtype = self.input_dtype
+        else:
+            self.binned_dtype = np.dtype(np.uint32 if binned_max < 2 ** 32 else np.uint64)
+        if mode in ('average', 'rolling_mean'):
+            self.dtype = np.dtype(np.float32)
+        elif mode == 'sum':
+            total_max = None if binned_max is None else binned_max * self.frames
+            self.dtype = np.dtype(np.float64 if total_max is None else
+                                  np.uint32 if total_max < 2 ** 32 else np.uint64)
+        else:
+            self.dtype = self.binned_dtype
+
+        self._binned = np.empty(self.shape, self.binned_dtype) if bin_x * bin_y > 1 else None
+        self._acc = None
+        self._window = None
+        if mode in ('sum', 'average', 'rolling_mean'):
+            # running sum of the current group (sum, average) or of the window (rolling_mean)
+            self._acc = np.zeros(self.shape, np.float64 if binned_max is None else
+                                 self.dtype if mode == 'sum' else np.int64)
+        if mode in ('rolling_mean', 'rolling_max'):
+            self._window = np.empty((self.frames,) + self.shape, self.binned_dtype)
+        self._out = np.empty((0,) + self.shape, self.dtype)
+        self.reset()
+
+    def reset(self):
+        self.count = 0 # frames processed
+        self.outputs = 0 # frames produced
+        if self._acc is not None:
+            self._acc.fill(0)
+
+    def output_length(self, input_frames):
+        # number of output frames produced by input_frames frames
+        if self.mode in ('sum', 'average'):
+            return input_frames // self.frames
+        if self.mode in ('rolling_mean', 'rolling_max'):
+            return max(0, (input_frames - self.frames) // self.stride + 1)
+        return input_frames
+
+    @property
+    def reduction(self):
+        # ratio between input and output data size (for long recordings)
+        ratio = self.bin_x * self.bin_y * self.input_dtype.itemsize / self.dtype.itemsize
+        if self.mode in ('sum', 'average'):
+            ratio *= self.frames
+        elif self.mode in ('rolling_mean', 'rolling_max'):
+            ratio *= self.stride
+        return ratio
+
+    def _bin(self, frame):
+        if self._binned is None:
+            return frame
+        rows, cols = self.shape
+        blocks = frame[:rows * self.bin_y, :cols * self.bin_x].reshape(rows, self.bin_y, cols, self.bin_x)
+        np.sum(blocks, axis=(1, 3), dtype=self.binned_dtype, out=self._binned)
+        return self._binned
+
+    def process(self, frames):
+        """
+        Adds frames (shape (n, rows, columns)) and returns (outputs, indices):
+        outputs are the output frames completed by them, a view of a preallocated block
+        valid until the next call; indices are the positions in frames of the last frame
+        of each output (e.g. to select its metadata).
+        """
+        if len(self._out) < len(frames):
+            self._out = np.empty((len(frames),) + self.shape, self.dtype)
+        count = 0
+        indices = []
+        for index, frame in enumerate(frames):
+            binned = self._bin(frame)
+            position = self.count
+            self.count += 1
+            if self.mode == 'none':
+                out = self._out[count]
+                np.copyto(out, binned)
+            elif self.mode in ('sum', 'average'):
+                if position % self.frames == 0:
+                    np.copyto(self._acc, binned, casting='unsafe')
+                else:
+                    np.add(self._acc, binned, out=self._acc, casting='unsafe')
+                if self.count % self.frames:
+                    continue
+                out = self._out[count]
+                if self.mode == 'average':
+                    np.multiply(self._acc, 1.0 / self.frames, out=out, casting='unsafe')
+                else:
+                    np.copyto(out, self._acc)
+            else:
+                slot = position % self.frames
+                if self.mode == 'rolling_mean':
+                    if position >= self.frames:
+                        np.subtract(self._acc, self._window[slot], out=self._acc, casting='unsafe')
+                    np.add(self._acc, binned, out=self._acc, casting='unsafe')
+                self._window[slot] = binned
+                if position < self.frames - 1 or (position - self.frames + 1) % self.stride:
+                    continue
+                out = self._out[count]
+                if self.mode == 'rolling_mean':
+                    np.multiply(self._acc, 1.0 / self.frames, out=out, casting='unsafe')
+                else:
+                    np.max(self._window, axis=0, out=out)
+            indices.append(index)
+            count += 1
+        self.outputs += count
+        return self._out[:count], indices
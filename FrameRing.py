@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:12:05 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Preallocated ring of numpy frames placed between the PVCAM polling loop
+(producer) and the threads that save, display and analyse the frames (consumers).
+"""
+
+import threading
+import queue
+import numpy as np
+
+# per-frame metadata stored next to each ring slot (timestamps and exposure time in ns)
+META_DTYPE = np.dtype([('frame_number', np.int64),
+                       ('timestamp_bof', np.int64),
+                       ('timestamp_eof', np.int64),
+                       ('exposure_time', np.int64),
+                       ('host_time', np.float64)]) # time.time() when the frame was polled
+
+
+class FrameRing(object):
+    """
+    Fixed-size ring of frames. The producer never blocks: when the slowest
+    lossless reader has not released the oldest slot yet, the new frame is
+    discarded and counted as an overrun, so PVCAM keeps being drained.
+
+    Lossless readers (e.g. the h5 saver) see every stored frame in order.
+    Latest-frame readers (e.g. display) only copy the newest frame when they need it.
+    """
+
+    def __init__(self, shape, dtype=np.uint16, depth=32):
+        if depth < 2:
+            raise ValueError('FrameRing depth must be at least 2.')
+        self.depth = int(depth)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frames = np.empty((self.depth,) + self.shape, dtype=self.dtype)
+        self.frames.fill(0)  # touch the pages now, not during the acquisition
+        self.seq = np.full(self.depth, -1, dtype=np.int64)  # sequence number stored in each slot
+        self.meta = np.zeros(self.depth, dtype=META_DTYPE)
+
+        self._cond = threading.Condition()
+        self._readers = {}  # lossless reader name -> sequence number of the next frame to read
+        self.write_count = 0  # number of frames stored so far
+        self.high_water = 0
+        self.overruns = 0
+        self.closed = False
+
+    @property
+    def frame_nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def _tail(self):
+        # oldest frame still needed by a lossless reader
+        if self._readers:
+            return min(self._readers.values())
+        return self.write_count
+
+    def occupancy(self):
+        with self._cond:
+            return self.write_count - self._tail()
+
+    def stats(self):
+        with self._cond:
+            return {'occupancy': self.write_count - self._tail(),
+                    'high_water': self.high_water,
+                    'overruns': self.overruns,
+                    'frames': self.write_count}
+
+    # producer side
+
+    def push(self, frame, meta=None):
+        """
+        Copies frame (and its metadata, a META_DTYPE record or tuple) into the next free slot.
+        Returns the sequence number of the stored frame, or -1 if the ring was full.
+        """
+        with self._cond:
+            if self.write_count - self._tail() >= self.depth:
+                self.overruns += 1
+                return -1
+            seq = self.write_count
+        slot = seq % self.depth
+        # the copy runs without the lock: no reader can access a slot that has not been committed
+        self.frames[slot] = frame
+        if meta is not None:
+            self.meta[slot] = meta
+        with self._cond:
+            self.seq[slot] = seq
+            self.write_count = seq + 1
+            occupancy = self.write_count - self._tail()
+            if occupancy > self.high_water:
+                self.high_water = occupancy
+            self._cond.notify_all()
+        return seq
+
+    def reset(self):
+        # empties the ring to reuse its buffer for a new acquisition
+        with self._cond:
+            self._readers.clear()
+            self.seq.fill(-1)
+            self.write_count = 0
+            self.high_water = 0
+            self.overruns = 0
+            self.closed = False
+
+    def close(self):
+        # readers drain the remaining frames and then receive (None, None)
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    # lossless readers
+
+    def add_reader(self, name):
+        with self._cond:
+            self._readers[name] = self.write_count
+
+    def remove_reader(self, name):
+        with self._cond:
+            self._readers.pop(name, None)
+            self._cond.notify_all()
+
+    def read(self, name, max_count=1, timeout=None):
+        """
+        Waits for frames not yet read by reader name.
+        Returns (first_seq, frames), where frames is a view of up to max_count
+        contiguous slots with shape (n, height, width). The slots stay reserved
+        until release(name, n) is called.
+        Returns (None, None) on timeout or when the ring is closed and drained.
+        """
+        with self._cond:
+            cursor = self._readers[name]
+            if not self._cond.wait_for(lambda: self.write_count > cursor or self.closed, timeout):
+                return None, None
+            available = self.write_count - cursor
+            if available == 0:
+                return None, None
+            slot = cursor % self.depth
+            count = min(available, max_count, self.depth - slot)  # do not wrap around
+        return cursor, self.frames[slot:slot + count]
+
+    def metadata(self, seq, count=1):
+        # metadata of the frames returned by read(): only valid until they are released
+        slot = seq % self.depth
+        return self.meta[slot:slot + count]
+
+    def release(self, name, count=1):
+        with self._cond:
+            self._readers[name] += count
+
+    # latest-frame readers
+
+    def copy_latest(self, out, last_seq=-1):
+        """
+        Copies the newest frame into out if it is newer than last_seq.
+        Returns the sequence number of the copied frame, or last_seq if nothing new arrived.
+        """
+        with self._cond:
+            seq = self.write_count - 1
+            if seq <= last_seq:
+                return last_seq
+            # holding the lock keeps the producer from committing past this slot while copying
+            np.copyto(out, self.frames[seq % self.depth])
+        return seq
+
+
+class FrameConsumer(threading.Thread):
+    """
+    Thread calling func(first_seq, frames) for the frames taken from a FrameRing.
+
+    lossless=True: every frame is processed, in batches of up to max_count frames.
+    lossless=False: every period seconds, the newest frame (if any) is copied
+    into a private buffer and passed to func with shape (1, height, width).
+    Two buffers are used alternately, so func may keep a reference to the
+    frames it received until the following call.
+    """
+
+    def __init__(self, ring, func, name, lossless=True, max_count=1, period=0.05):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.ring = ring
+        self.func = func
+        self.lossless = lossless
+        self.max_count = max_count
+        self.period = period
+        self.error = None
+        self._stop_event = threading.Event()
+        if lossless:
+            ring.add_reader(name)
+        else:
+            self._buffers = np.zeros((2, 1) + ring.shape, dtype=ring.dtype)
+            self._last_seq = -1
+
+    def run(self):
+        try:
+            if self.lossless:
+                self._run_lossless()
+            else:
+                self._run_latest()
+        except Exception as err:
+            self.error = err
+        finally:
+            if self.lossless:
+                self.ring.remove_reader(self.name)
+
+    def _run_lossless(self):
+        while True:
+            seq, frames = self.ring.read(self.name, self.max_count, timeout=0.1)
+            if frames is None:
+                if self.ring.closed:
+                    break
+                continue
+            self.func(seq, frames)
+            self.ring.release(self.name, len(frames))
+
+    def _run_latest(self):
+        index = 0
+        while not self._stop_event.wait(self.period):
+            buffer = self._buffers[index]
+            seq = self.ring.copy_latest(buffer[0], self._last_seq)
+            if seq != self._last_seq:
+                self._last_seq = seq
+                self.func(seq, buffer)
+                index = 1 - index
+            if self.ring.closed:
+                break
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self.join(timeout)
+
+
+class BlockWorker(threading.Thread):
+    """
+    Thread calling func(frames, meta) on the blocks passed to put(), in order, so that the
+    thread putting them (e.g. the acquisition loop) does not wait for the processing.
+    wait() returns when all the blocks put so far are processed, and raises the first error of func.
+    """
+
+    def __init__(self, func, name='block_worker'):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.func = func
+        self.error = None
+        self._queue = queue.Queue()
+        self.start()
+
+    def put(self, frames, meta):
+        if self.error is not None:
+            raise self.error
+        self._queue.put((frames, meta))
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.func(*item)
+            except Exception as err:
+                self.error = err
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        self._queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
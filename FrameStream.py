@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 04:48:30 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Frame iterator of PVcamDevice (PVcamDevice.stream): starts a live or sequence
+acquisition on enter, yields single frames or stacked batches, and stops the
+acquisition on exit. Also usable with `async with` / `async for`.
+"""
+
+import asyncio
+import numpy as np
+from FrameRing import META_DTYPE
+
+
+class FrameStream(object):
+    """
+        with camera.stream(frames=100, batch=8, timeout=1.0) as stream:
+            for frames, meta in stream:
+                ... # frames (n <= 8, rows, columns), meta: META_DTYPE array of n records
+
+    frames: number of frames to acquire; None: until stop() or the end of the with block.
+    mode: 'sequence' (non-circular buffer, frames required) or 'live' (circular buffer).
+    batch: None yields single frames (rows, columns) with a META_DTYPE record; K yields up to
+        K frames stacked in a 3D array, polled without copies out of the PVCAM buffer and copied
+        once into the batch (the last batch may be shorter).
+    timeout: seconds to wait for each frame (None: forever). On timeout, on_timeout='raise'
+        raises TimeoutError, 'stop' ends the stream after yielding the frames already polled.
+    reuse_buffer: yield the same batch array each time (valid until the next iteration),
+        instead of a new one.
+    """
+
+    def __init__(self, device, frames=None, mode=None, batch=None, timeout=None, on_timeout='raise',
+                 reuse_buffer=False):
+        if mode is None:
+            mode = 'live' if frames is None else 'sequence'
+        if mode not in ('live', 'sequence'):
+            raise ValueError(f"Unknown mode {mode}, choose 'live' or 'sequence'.")
+        if mode == 'sequence' and not frames:
+            raise ValueError('A sequence stream needs the number of frames.')
+        if on_timeout not in ('raise', 'stop'):
+            raise ValueError(f"on_timeout must be 'raise' or 'stop', not {on_timeout}.")
+        self.device = device
+        self.frames = frames
+        self.mode = mode
+        self.batch = batch
+        self.timeout_ms = -1 if timeout is None else max(1, int(timeout * 1e3))
+        self.on_timeout = on_timeout
+        self.reuse_buffer = reuse_buffer
+        self.count = 0 # frames yielded
+        self.running = False
+        self._buffer = None
+        self._timed_out = False
+
+    def start(self):
+        # starting a stream that is already running does nothing (e.g. start() followed by `with`)
+        if self.running:
+            return self
+        if self.mode == 'sequence':
+            self.device.acq_start_seq(self.frames)
+        else:
+            self.device.acq_start()
+        self.running = True
+        self.count = 0
+        self._timed_out = False
+        return self
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.device.acq_stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _poll(self, zero_copy):
+        # FrameLease of the next frame, or None when the stream has ended
+        if not self.running or self._timed_out or (self.frames is not None and self.count >= self.frames):
+            return None
+        try:
+            lease = self.device.lease_frame(zero_copy=zero_copy, timeout_ms=self.timeout_ms)
+        except RuntimeError as err:
+            if 'timeout' not in str(err).lower():
+                raise
+            if self.on_timeout == 'raise':
+                raise TimeoutError(f'No frame within {self.timeout_ms} ms after frame {self.count}.') from err
+            self._timed_out = True
+            return None
+        self.count += 1
+        return lease
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.read()
+        if item is None:
+            raise StopIteration
+        return item
+
+    def read(self):
+        # next (frames, meta), or None when the stream has ended
+        if self.batch is None:
+            lease = self._poll(zero_copy=False)
+            if lease is None:
+                return None
+            with lease: # a copy of the frame, it stays valid after the release
+                return lease.data, np.array(lease.meta, dtype=META_DTYPE)
+        size = self.batch
+        if self.frames is not None:
+            size = min(size, self.frames - self.count)
+        meta = np.zeros(size, META_DTYPE)
+        n = 0
+        while n < size:
+            lease = self._poll(zero_copy=True)
+            if lease is None:
+                break
+            with lease:
+                if self._buffer is None:
+                    self._buffer = np.empty((self.batch,) + lease.data.shape, lease.data.dtype)
+                self._buffer[n] = lease.data
+                meta[n] = lease.meta
+            n += 1
+        if n == 0:
+            return None
+        frames = self._buffer[:n]
+        if not self.reuse_buffer:
+            self._buffer = None
+        return frames, meta[:n]
+
+    # asyncio: the frames are polled in a worker thread, the event loop is never blocked
+
+    async def __aenter__(self):
+        return await asyncio.to_thread(self.start)
+
+    async def __aexit__(self, *exc):
+        await asyncio.to_thread(self.stop)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await asyncio.to_thread(self.read)
+        if item is None:
+            raise StopAsyncIteration
+        return item
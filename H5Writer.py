@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:05:12 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Background HDF5 writer for image stacks: frames are batched in blocks,
+written (and compressed) by a dedicated thread into datasets that grow with
+each block, and checkpointed (flushed) on a time/size budget.
+"""
+
+import threading
+import queue
+import time
+import importlib.util
+import numpy as np
+
+COMPRESSIONS = ['none', 'lzf', 'gzip1', 'blosc_lz4']
+# HDF5 chunks cannot exceed 4 GB; smaller chunks also keep the chunk cache and the
+# compression of a chunk cheap, so chunk_frames is reduced to stay below this size
+MAX_CHUNK_BYTES = 32e6
+
+
+def available_compressions():
+    # hdf5plugin (which registers the Blosc filter in h5py) is only imported when used
+    if importlib.util.find_spec('hdf5plugin') is None:
+        return [c for c in COMPRESSIONS if c != 'blosc_lz4']
+    return list(COMPRESSIONS)
+
+
+def compression_options(compression):
+    # keyword arguments for h5py create_dataset
+    if compression == 'none':
+        return {}
+    if compression == 'lzf':
+        return {'compression': 'lzf'}
+    if compression == 'gzip1':
+        return {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}
+    if compression == 'blosc_lz4':
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ValueError('blosc_lz4 compression requires the hdf5plugin package.')
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError(f'Unknown compression {compression}, choose among {COMPRESSIONS}.')
+
+
+class H5FrameWriter(object):
+    """
+    Writes frames into the resizable dataset h5group[name] with shape (n, height, width):
+    the dataset starts empty and is extended with each block written, so it never holds
+    frames that were not acquired (length is the expected number of frames, it only
+    bounds the chunk size).
+    append() only copies the frames into a preallocated block: the dataset
+    writes, the compression and the file flushes run in the writer thread.
+    Checkpoints (file flushes) happen every flush_interval seconds or flush_size bytes:
+    the file on disk then holds a consistent recording of all the frames written so far.
+    With meta_dtype (a numpy structured dtype), the per-frame metadata passed to
+    append() is written in one 1D dataset per field, next to the image dataset.
+    For HDF5 SWMR (single writer, multiple readers) the file must be opened with
+    libver='latest'; call start_swmr() once all the groups and attributes are created.
+    probes: optional TimingProbes.ProbeSet, receives the 'h5_write' and 'h5_flush' durations.
+    chunk_frames is reduced so that a chunk stays below MAX_CHUNK_BYTES (at least one frame per
+    chunk): self.chunk_frames is the value used, self.chunk_clamped is True if it was reduced.
+    """
+
+    def __init__(self, h5group, name, length, frame_shape, dtype=np.uint16,
+                 chunk_frames=1, batch_frames=16, compression='none',
+                 flush_interval=2.0, flush_size=512e6, queue_blocks=3, meta_dtype=None, probes=None):
+        frame_shape = tuple(frame_shape)
+        frame_nbytes = int(np.prod(frame_shape)) * np.dtype(dtype).itemsize
+        if frame_nbytes >= 2 ** 32:
+            raise ValueError(f'Frames of {frame_nbytes / 1e9:.1f} GB exceed the 4 GB limit of an HDF5 chunk.')
+        max_chunk_frames = max(1, int(MAX_CHUNK_BYTES // frame_nbytes))
+        self.chunk_clamped = chunk_frames > max_chunk_frames and length > max_chunk_frames
+        chunk_frames = max(1, min(chunk_frames, length, max_chunk_frames))
+        self.chunk_frames = chunk_frames
+        # blocks made of whole chunks are written without going through the chunk cache
+        batch_frames = max(chunk_frames, -(-batch_frames // chunk_frames) * chunk_frames)
+
+        self.h5file = h5group.file
+        self.dataset = h5group.create_dataset(name=name, shape=(0,) + frame_shape, maxshape=(None,) + frame_shape,
+                                              dtype=dtype, chunks=(chunk_frames,) + frame_shape,
+                                              **compression_options(compression))
+        self.meta_datasets = {}
+        if meta_dtype is not None:
+            parent = name.rsplit('/', 1)[0] + '/' if '/' in name else ''
+            for field in meta_dtype.names:
+                self.meta_datasets[field] = h5group.create_dataset(name=parent + field, shape=(0,), maxshape=(None,),
+                                                                   dtype=meta_dtype[field],
+                                                                   chunks=(max(1, min(length, 4096)),))
+        self.compression = compression
+        self.batch_frames = batch_frames
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.probes = probes
+
+        self._free_blocks = queue.Queue()
+        for _ in range(queue_blocks):
+            meta_block = np.zeros(batch_frames, dtype=meta_dtype) if meta_dtype is not None else None
+            self._free_blocks.put((np.empty((batch_frames,) + frame_shape, dtype=dtype), meta_block))
+        self._pending = queue.Queue()
+        self._block = None
+        self._meta_block = None
+        self._fill = 0 # frames in the current block
+        self._index = 0 # dataset index of the first frame of the current block
+
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.write_time = 0.0 # time spent by the writer thread in dataset writes and flushes
+        self.checkpoints = 0
+        self.swmr = False
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name='h5_writer', daemon=True)
+        self._thread.start()
+
+    def start_swmr(self):
+        # readers can open the file with h5py.File(fname, 'r', libver='latest', swmr=True) and
+        # follow the recording with dataset.refresh(); no group or attribute can be added from now on
+        self.h5file.swmr_mode = True
+        self.swmr = True
+
+    def append(self, frames, meta=None):
+        """
+        Copies frames (shape (n, height, width)) and their metadata (n records)
+        at the end of the recording.
+        Blocks only if all the blocks are waiting to be written.
+        """
+        if self.error is not None:
+            raise self.error
+        done = 0
+        while done < len(frames):
+            if self._block is None:
+                self._block, self._meta_block = self._free_blocks.get()
+            count = min(len(frames) - done, self.batch_frames - self._fill)
+            self._block[self._fill:self._fill + count] = frames[done:done + count]
+            if meta is not None and self._meta_block is not None:
+                self._meta_block[self._fill:self._fill + count] = meta[done:done + count]
+            self._fill += count
+            done += count
+            if self._fill == self.batch_frames:
+                self._submit()
+
+    def _submit(self):
+        if self._fill:
+            self._pending.put((self._index, self._block, self._meta_block, self._fill))
+            self._index += self._fill
+        else:
+            self._free_blocks.put((self._block, self._meta_block))
+        self._block = self._meta_block = None
+        self._fill = 0
+
+    def _run(self):
+        last_flush = time.perf_counter()
+        unflushed = 0
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            index, block, meta_block, count = item
+            if self.error is None:
+                try:
+                    t0 = time.perf_counter()
+                    self.dataset.resize(index + count, axis=0)
+                    self.dataset[index:index + count] = block[:count]
+                    for field, dataset in self.meta_datasets.items():
+                        dataset.resize(index + count, axis=0)
+                        dataset[index:index + count] = meta_block[field][:count]
+                    unflushed += block[:count].nbytes
+                    t1 = time.perf_counter()
+                    if self.probes is not None:
+                        self.probes['h5_write'].add(t1 - t0, block[:count].nbytes)
+                    if t0 - last_flush > self.flush_interval or unflushed > self.flush_size:
+                        # checkpoint: data and extents of the datasets reach the disk together
+                        self.h5file.flush()
+                        last_flush = time.perf_counter()
+                        unflushed = 0
+                        self.checkpoints += 1
+                        if self.probes is not None:
+                            self.probes['h5_flush'].add(last_flush - t1)
+                    self.write_time += time.perf_counter() - t0
+                    self.frames_written += count
+                    self.bytes_written += block[:count].nbytes
+                except Exception as err:
+                    self.error = err
+            self._free_blocks.put((block, meta_block))
+
+    def close(self):
+        """
+        Writes the remaining frames, flushes the file and returns the writer statistics.
+        The h5 file itself is not closed.
+        """
+        if self._block is not None:
+            self._submit()
+        self._pending.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        t0 = time.perf_counter()
+        self.h5file.flush()
+        self.write_time += time.perf_counter() - t0
+        return self.stats()
+
+    def stats(self):
+        storage = self.dataset.id.get_storage_size()
+        return {'frames': self.frames_written,
+                'MB': self.bytes_written / 1e6,
+                'MBps': self.bytes_written / 1e6 / self.write_time if self.write_time else 0.0,
+                'compression_ratio': self.bytes_written / storage if storage else 1.0,
+                'checkpoints': self.checkpoints}
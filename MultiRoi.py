@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 06:25:37 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Multiple ROIs acquired in one exposure: PVCAM returns one array per ROI, which are
+packed side by side in a single tiled frame, so that ring buffers, display and
+analysis handle them as any other frame; the recording splits the tiled frames
+again and saves one dataset (or file) per ROI.
+"""
+
+import numpy as np
+
+
+def parse_rois(text):
+    # 'h0,v0,width,height; h0,v0,width,height' -> [(h0, v0, width, height)]
+    rois = []
+    for item in text.replace('\n', ';').split(';'):
+        if not item.strip():
+            continue
+        values = [value for value in item.replace(' ', ',').split(',') if value]
+        if len(values) != 4:
+            raise ValueError(f'Invalid ROI "{item.strip()}": use h0,v0,width,height.')
+        rois.append(tuple(int(value) for value in values))
+    return rois
+
+
+def format_rois(rois):
+    return '; '.join(','.join(str(value) for value in roi) for roi in rois)
+
+
+def check_overlaps(rois):
+    # PVCAM does not accept overlapping ROIs
+    for index, (h0, v0, width, height) in enumerate(rois):
+        for other in rois[index + 1:]:
+            if h0 < other[0] + other[2] and other[0] < h0 + width and v0 < other[1] + other[3] and other[1] < v0 + height:
+                raise ValueError(f'ROIs {(h0, v0, width, height)} and {other} overlap.')
+
+
+def snap_roi(roi, binning):
+    # largest ROI inside roi aligned to the (square) binning: start and size multiples of binning;
+    # non-overlapping ROIs stay non-overlapping
+    h0, v0, width, height = roi
+    h1, v1 = h0 + width, v0 + height
+    h0, v0 = h0 - h0 % binning, v0 - v0 % binning
+    width, height = max(binning, h1 - h0 - (h1 - h0) % binning), max(binning, v1 - v0 - (v1 - v0) % binning)
+    return (h0, v0, width, height)
+
+
+class RoiLayout(object):
+    """
+    Tiled frame of the ROIs (h0, v0, width, height) in sensor pixels acquired with binning (x, y):
+    the binned ROIs are placed left to right, top aligned, in a frame of shape
+    (tallest ROI, sum of the widths); the pixels below the shorter ROIs are 0.
+    shapes: (rows, columns) of each binned ROI, offsets: first column of each ROI in the tiled frame.
+    """
+
+    def __init__(self, rois, binning=(1, 1), shapes=None):
+        self.rois = [tuple(int(value) for value in roi) for roi in rois]
+        self.binning = tuple(binning)
+        bin_x, bin_y = self.binning
+        self.shapes = shapes or [(height // bin_y, width // bin_x) for _, _, width, height in self.rois]
+        self.offsets = [int(offset) for offset in np.cumsum([0] + [cols for _, cols in self.shapes])[:-1]]
+        self.shape = (max(rows for rows, _ in self.shapes), sum(cols for _, cols in self.shapes))
+
+    def __len__(self):
+        return len(self.rois)
+
+    def bounding_box(self):
+        # (h0, v0, width, height) of the smallest single ROI including all the ROIs
+        h0 = min(roi[0] for roi in self.rois)
+        v0 = min(roi[1] for roi in self.rois)
+        return (h0, v0, max(roi[0] + roi[2] for roi in self.rois) - h0, max(roi[1] + roi[3] for roi in self.rois) - v0)
+
+    def pixels(self):
+        # pixels of the ROIs read out for each frame, without the padding of the tiled frame
+        return sum(rows * cols for rows, cols in self.shapes)
+
+    def pixel_fraction(self):
+        # pixels read out with the ROIs over those of the bounding box
+        _, _, width, height = self.bounding_box()
+        return sum(roi[2] * roi[3] for roi in self.rois) / (width * height)
+
+    def empty(self, dtype=np.uint16):
+        return np.zeros(self.shape, dtype)
+
+    def pack(self, arrays, out=None):
+        """
+        Copies the arrays of the ROIs (as returned by poll_frame, one per ROI, 1D or 2D)
+        into out (default: a new tiled frame) and returns it.
+        """
+        if isinstance(arrays, np.ndarray):
+            arrays = [arrays]
+        if len(arrays) != len(self.shapes):
+            raise ValueError(f'Got {len(arrays)} ROIs from the camera, {len(self.shapes)} expected.')
+        if out is None:
+            out = self.empty(arrays[0].dtype)
+        for data, (rows, cols), offset in zip(arrays, self.shapes, self.offsets):
+            out[:rows, offset:offset + cols] = data.reshape(rows, cols)
+        return out
+
+    def split(self, frames):
+        # views of each ROI in tiled frames (..., rows, columns)
+        return [frames[..., :rows, offset:offset + cols] for (rows, cols), offset in zip(self.shapes, self.offsets)]
+
+    def reduced(self, bin_x, bin_y):
+        """
+        Layout of the tiled frames after a software binning (FrameReducer) of bin_x, bin_y.
+        Raises ValueError if the binning would mix the pixels of neighbouring ROIs.
+        """
+        if bin_x == bin_y == 1:
+            return self
+        if any(cols % bin_x for _, cols in self.shapes):
+            raise ValueError(f'The width of each ROI must be a multiple of the software binning {bin_x}.')
+        shapes = [(rows // bin_y, cols // bin_x) for rows, cols in self.shapes]
+        if min(min(shape) for shape in shapes) < 1:
+            raise ValueError(f'Software binning {bin_x}x{bin_y} is larger than a ROI.')
+        return RoiLayout(self.rois, (self.binning[0] * bin_x, self.binning[1] * bin_y), shapes)
+
+
+class MultiRoiWriter(object):
+    """
+    Splits the tiled frames of layout between one writer per ROI (writers, in the order of
+    the ROIs); same interface as H5Writer.H5FrameWriter. The metadata is passed to every writer.
+    """
+
+    def __init__(self, layout, writers):
+        self.layout = layout
+        self.writers = list(writers)
+        self.swmr = False
+
+    @property
+    def dataset(self):
+        return self.writers[0].dataset
+
+    @property
+    def datasets(self):
+        return [writer.dataset for writer in self.writers]
+
+    @property
+    def meta_datasets(self):
+        return self.writers[0].meta_datasets
+
+    def start_swmr(self):
+        # the HDF5 writers of the ROIs share the same file
+        self.writers[0].start_swmr()
+        for writer in self.writers:
+            writer.swmr = True
+        self.swmr = True
+
+    def append(self, frames, meta=None):
+        for writer, roi_frames in zip(self.writers, self.layout.split(frames)):
+            writer.append(roi_frames, meta)
+
+    def close(self):
+        # closes all the writers (the first error is raised after) and returns the combined statistics
+        stats, error = [], None
+        for writer in self.writers:
+            try:
+                stats.append(writer.close())
+            except Exception as err:
+                error = error or err
+        if error is not None:
+            raise error
+        return self.combine(stats)
+
+    def stats(self):
+        return self.combine([writer.stats() for writer in self.writers])
+
+    @staticmethod
+    def combine(stats):
+        # the writers run in parallel: their rates add up
+        total = sum(item['MB'] for item in stats)
+        stored = sum(item['MB'] / item['compression_ratio'] for item in stats if item['compression_ratio'])
+        combined = {'frames': stats[0]['frames'],
+                    'MB': total,
+                    'MBps': sum(item['MBps'] for item in stats),
+                    'compression_ratio': total / stored if stored else 1.0,
+                    'rois': len(stats)}
+        if 'files' in stats[0]:
+            combined['files'] = [fname for item in stats for fname in item['files']]
+        return combined
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:02:33 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Live-view preview: decimation of the frames to the size of the display widget
+and display levels estimated on a pixel subsample, computed outside the GUI thread.
+"""
+
+import threading
+import numpy as np
+
+
+def decimation_step(frame_shape, target_shape):
+    # integer step such that the decimated frame is not larger than target_shape
+    if not target_shape or min(target_shape) <= 0:
+        return 1
+    return max(1, -(-frame_shape[0] // target_shape[0]), -(-frame_shape[1] // target_shape[1]))
+
+
+def estimate_levels(frame, percentiles=(0.5, 99.5), max_samples=65536):
+    # display levels from the percentiles of a strided subsample of the frame
+    step = max(1, int(np.sqrt(frame.size / max_samples)))
+    sample = frame[::step, ::step]
+    low, high = np.percentile(sample, percentiles)
+    if high <= low:
+        high = low + 1
+    return float(low), float(high)
+
+
+class PreviewStage(object):
+    """
+    process(seq, frames) (a FrameConsumer function) stores a decimated copy of the
+    frame and its display levels; latest() returns them to the GUI thread together with
+    the frame sequence number, so that the GUI only uploads frames it has not shown yet.
+    method: 'stride' keeps one pixel every step, 'mean' averages step x step blocks.
+    The preview returned by latest() belongs to the GUI (pyqtgraph keeps it and paints it
+    later) until latest() returns a newer one: of the three preview buffers, process()
+    only writes the one that is neither handed to the GUI nor waiting to be taken.
+    """
+
+    def __init__(self, method='stride', percentiles=(0.5, 99.5)):
+        self.method = method
+        self.percentiles = percentiles
+        self.target_shape = None # (rows, columns) of the display widget, set by the GUI thread
+        self._lock = threading.Lock()
+        self._latest = None
+        self._buffers = [None, None, None] # preview frames, see the class description
+        self._published = None # buffer of the latest preview, not yet taken by the GUI
+        self._shown = None # buffer handed to the GUI by latest()
+
+    def process(self, seq, frames):
+        frame = frames[0]
+        step = decimation_step(frame.shape, self.target_shape)
+        if self.method == 'mean' and step > 1:
+            rows, cols = frame.shape[0] // step, frame.shape[1] // step
+            blocks = frame[:rows * step, :cols * step].reshape(rows, step, cols, step)
+            preview = blocks.mean(axis=(1, 3), dtype=np.float32)
+            index = None # a new array at each call
+        else:
+            decimated = frame[::step, ::step]
+            with self._lock:
+                index = next(index for index in range(len(self._buffers)) if index not in (self._published, self._shown))
+            preview = self._buffers[index]
+            if preview is None or preview.shape != decimated.shape or preview.dtype != decimated.dtype:
+                preview = self._buffers[index] = np.empty_like(decimated)
+            np.copyto(preview, decimated)
+        levels = estimate_levels(preview, self.percentiles)
+        with self._lock:
+            self._latest = (seq, preview, step, levels)
+            self._published = index
+
+    def latest(self):
+        # (seq, preview, step, levels) of the newest processed frame, or None; called by the GUI
+        # thread, the preview is not overwritten until a newer one is returned
+        with self._lock:
+            self._shown = self._published
+            return self._latest
+
+    def reset(self):
+        with self._lock:
+            self._latest = None
+            self._published = self._shown = None
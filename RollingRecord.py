@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 05:40:16 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Pre-trigger recording: the last frames of a continuous acquisition are kept in a
+preallocated circular history; when an event is triggered, the frames from
+pre_time before the event to post_time after it are saved by a background thread
+while the acquisition and the history go on.
+"""
+
+import threading
+import time
+import numpy as np
+from FrameRing import META_DTYPE
+
+
+class RollingRecorder(object):
+    """
+    History of the last `depth` frames of shape `shape`, filled by push().
+    trigger() starts saving an event; the frames not yet saved are never overwritten:
+    if the history is full of them, the new frames are left out of the history (counted
+    in dropped) until the saving thread catches up.
+    """
+
+    def __init__(self, shape, dtype=np.uint16, depth=100):
+        if depth < 1:
+            raise ValueError('RollingRecorder depth must be at least 1.')
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.depth = int(depth)
+        self.frames = np.empty((self.depth,) + self.shape, dtype=self.dtype)
+        self.frames.fill(0) # touch the pages now, not during the acquisition
+        self.meta = np.zeros(self.depth, dtype=META_DTYPE)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._cursor = None # next frame to save, None if no event is being saved
+        self._writing = 0 # slots after write_count being overwritten by push (outside the lock)
+        self.reset()
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    def reset(self):
+        with self._cond:
+            self.write_count = 0
+            self.dropped = 0
+            self.closed = False
+
+    def busy(self):
+        # True while an event is being saved
+        with self._cond:
+            return self._cursor is not None
+
+    def push(self, frames, meta):
+        # adds frames (n, rows, columns) and their META_DTYPE records; never blocks
+        done = 0
+        while done < len(frames):
+            with self._cond:
+                seq = self.write_count
+                free = self.depth if self._cursor is None else self.depth - (seq - self._cursor)
+                slot = seq % self.depth
+                count = min(len(frames) - done, free, self.depth - slot)
+                if count <= 0:
+                    self.dropped += len(frames) - done
+                    return
+                self._writing = count # reserved: trigger() does not start an event in these slots
+            # the slots between write_count and the oldest frame to save are not read by anybody
+            self.frames[slot:slot + count] = frames[done:done + count]
+            self.meta[slot:slot + count] = meta[done:done + count]
+            with self._cond:
+                self.write_count = seq + count
+                self._writing = 0
+                self._cond.notify_all()
+            done += count
+
+    def trigger(self, pre_time, post_time, open_writer, max_frames, on_done, event_time=None):
+        """
+        Saves the frames acquired from pre_time seconds before event_time (default: now)
+        to post_time seconds after it, at most max_frames, in a background thread:
+        open_writer(max_frames) returns the writer (append/close interface of H5FrameWriter),
+        on_done(stats, error) is called at the end with the writer statistics or the exception.
+        Returns False (and does nothing) if the previous event is still being saved.
+        """
+        event_time = time.time() if event_time is None else event_time
+        with self._cond:
+            if self._cursor is not None:
+                return False
+            # the oldest frames of the history may be the ones push() is overwriting
+            oldest = max(0, self.write_count + self._writing - self.depth)
+            seqs = np.arange(oldest, self.write_count)
+            times = self.meta['host_time'][seqs % self.depth]
+            after = np.flatnonzero(times >= event_time - pre_time)
+            self._cursor = int(seqs[after[0]]) if len(after) else self.write_count
+        self._thread = threading.Thread(target=self._save, name='rolling_record',
+                                        args=(event_time + post_time, open_writer, max_frames, on_done), daemon=True)
+        self._thread.start()
+        return True
+
+    def _save(self, end_time, open_writer, max_frames, on_done):
+        stats = error = None
+        try:
+            writer = open_writer(max_frames)
+            try:
+                remaining = max_frames
+                while remaining > 0:
+                    with self._cond:
+                        self._cond.wait_for(lambda: self.write_count > self._cursor or self.closed, 0.1)
+                        cursor = self._cursor
+                        slot = cursor % self.depth
+                        count = min(self.write_count - cursor, self.depth - slot, remaining)
+                    if count <= 0:
+                        if self.closed:
+                            break
+                        if time.time() > end_time + 1.0:
+                            break # no more frames (e.g. the acquisition stopped)
+                        continue
+                    # only the frames acquired until end_time belong to the event
+                    late = np.flatnonzero(self.meta['host_time'][slot:slot + count] > end_time)
+                    if len(late):
+                        count = int(late[0])
+                    if count:
+                        writer.append(self.frames[slot:slot + count], self.meta[slot:slot + count])
+                        remaining -= count
+                        with self._cond:
+                            self._cursor += count
+                    if len(late):
+                        break
+            except Exception as err:
+                error = err
+            try:
+                stats = writer.close()
+            except Exception as err:
+                error = error or err # the error of the appends comes first
+        except Exception as err:
+            error = err # open_writer failed
+        finally:
+            with self._cond:
+                self._cursor = None
+        on_done(stats, error)
+
+    def close(self, timeout=None):
+        # no more frames will be pushed: the event being saved is completed with the frames available
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
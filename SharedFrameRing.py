@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 03:20:41 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Frame broadcast to other processes through a named shared-memory ring:
+SharedFrameRing (in the acquisition process) publishes the frames, each with a slot
+header (sequence and frame number, timestamps, shape); SharedFrameReader (in any
+Python process) attaches to the ring by name and reads the frames as numpy views,
+without copies or pickling.
+
+Layout of the shared memory: ring header, reader table, slot headers, frames.
+A slot is only rewritten after every attached reader has released it, so the views
+returned by read() stay valid until release(). A reader that does not poll the ring
+for reader_timeout seconds is detached by the publisher.
+"""
+
+import atexit
+import os
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+MAGIC = b'PVCRING1'
+POLICIES = ['drop', 'block'] # full ring: discard the new frame, or wait (up to block_timeout) for the readers
+
+HEADER_DTYPE = np.dtype([('magic', 'S8'),
+                         ('depth', np.int64),
+                         ('height', np.int64),
+                         ('width', np.int64),
+                         ('dtype', 'S8'),
+                         ('max_readers', np.int64),
+                         ('write_count', np.int64), # frames published so far
+                         ('closed', np.int64)])
+READER_DTYPE = np.dtype([('pid', np.int64), # 0: free entry
+                         ('cursor', np.int64), # sequence number of the next frame to read
+                         ('heartbeat', np.float64), # time.time() of the last poll
+                         ('lost', np.int64)]) # frames missed because the reader was detached
+SLOT_DTYPE = np.dtype([('seq', np.int64),
+                       ('frame_number', np.int64),
+                       ('timestamp_bof', np.int64),
+                       ('timestamp_eof', np.int64),
+                       ('exposure_time', np.int64),
+                       ('host_time', np.float64),
+                       ('height', np.int64),
+                       ('width', np.int64)])
+
+
+def _layout(depth, shape, dtype, max_readers):
+    # offsets of the reader table, slot headers and frames, and total size in bytes
+    readers = HEADER_DTYPE.itemsize
+    slots = readers + max_readers * READER_DTYPE.itemsize
+    frames = -(-(slots + depth * SLOT_DTYPE.itemsize) // 64) * 64 # frames aligned to 64 bytes
+    size = frames + depth * int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return readers, slots, frames, size
+
+
+def _views(buf, depth, shape, dtype, max_readers):
+    readers, slots, frames, _ = _layout(depth, shape, dtype, max_readers)
+    return (np.ndarray((), HEADER_DTYPE, buf, 0),
+            np.ndarray((max_readers,), READER_DTYPE, buf, readers),
+            np.ndarray((depth,), SLOT_DTYPE, buf, slots),
+            np.ndarray((depth,) + tuple(shape), dtype, buf, frames))
+
+
+def _close(shm):
+    try:
+        shm.close()
+    except BufferError:
+        pass # frames returned by read() are still referenced: the mapping is released with them
+
+
+class SharedFrameRing(object):
+    """
+    Publisher side, created by the acquisition process with the name readers attach to.
+    shape, dtype: frame geometry, fixed for the life of the ring.
+    policy: 'drop' discards a new frame when the slowest reader has not released the
+        oldest slot, 'block' waits up to block_timeout seconds before discarding it.
+    """
+
+    def __init__(self, name, shape, dtype=np.uint16, depth=16, policy='drop', block_timeout=1.0,
+                 reader_timeout=2.0, max_readers=8):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown policy {policy}, choose among {POLICIES}.')
+        if depth < 2:
+            raise ValueError('SharedFrameRing depth must be at least 2.')
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.depth = int(depth)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.reader_timeout = reader_timeout
+        size = _layout(self.depth, self.shape, self.dtype, max_readers)[3]
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # left over by a process that died without closing its ring
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.header, self.readers, self.slots, self.frames = _views(self._shm.buf, self.depth, self.shape,
+                                                                    self.dtype, max_readers)
+        self.readers.fill(0)
+        self.slots['seq'] = -1
+        self.header['depth'] = self.depth
+        self.header['height'], self.header['width'] = self.shape
+        self.header['dtype'] = self.dtype.str.encode()
+        self.header['max_readers'] = max_readers
+        self.header['write_count'] = 0
+        self.header['closed'] = 0
+        self.header['magic'] = MAGIC # written last: readers only attach to a complete header
+        self.published = 0
+        self.drops = 0 # frames not published because the ring was full
+        self.detached = 0 # readers detached for not polling
+        atexit.register(self.close)
+
+    @property
+    def frame_nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def _tail(self):
+        # oldest sequence number still needed by an attached reader; stale readers are detached
+        tail = int(self.header['write_count'])
+        pids, cursors, heartbeats = self.readers['pid'], self.readers['cursor'], self.readers['heartbeat']
+        now = time.time()
+        for index in np.flatnonzero(pids):
+            if now - heartbeats[index] > self.reader_timeout:
+                pids[index] = 0
+                self.detached += 1
+            else:
+                tail = min(tail, int(cursors[index]))
+        return tail
+
+    def reader_count(self):
+        if self.readers is None:
+            return 0
+        return int(np.count_nonzero(self.readers['pid']))
+
+    def publish(self, frames, meta=None):
+        """
+        Copies frames (shape (n, height, width)) and their metadata (META_DTYPE records of
+        FrameRing) into the ring. Returns the number of frames published.
+        """
+        published = 0
+        for index, frame in enumerate(frames):
+            write_count = int(self.header['write_count'])
+            if write_count - self._tail() >= self.depth:
+                deadline = time.perf_counter() + (self.block_timeout if self.policy == 'block' else 0)
+                while write_count - self._tail() >= self.depth and time.perf_counter() < deadline:
+                    time.sleep(0.0005)
+                if write_count - self._tail() >= self.depth:
+                    self.drops += 1
+                    continue
+            slot = write_count % self.depth
+            self.frames[slot] = frame
+            header = self.slots[slot]
+            if meta is not None:
+                for field in ('frame_number', 'timestamp_bof', 'timestamp_eof', 'exposure_time', 'host_time'):
+                    header[field] = meta[index][field]
+            header['height'], header['width'] = self.shape
+            # commit: slot sequence number first, then the counter the readers poll
+            header['seq'] = write_count
+            self.header['write_count'] = write_count + 1
+            published += 1
+        self.published += published
+        return published
+
+    def stats(self):
+        return {'published': self.published, 'drops': self.drops, 'readers': self.reader_count(),
+                'detached': self.detached}
+
+    def close(self):
+        # readers drain the remaining frames and then read (None, None, None)
+        if self._shm is None:
+            return
+        atexit.unregister(self.close)
+        self.header['closed'] = 1
+        self.header = self.readers = self.slots = self.frames = None
+        self._shm.unlink() # the memory is freed when the last reader closes it
+        _close(self._shm)
+        self._shm = None
+
+
+class SharedFrameReader(object):
+    """
+    Reader side, in any process:
+        with SharedFrameReader('pvcam_frames') as reader:
+            while True:
+                seq, frames, meta = reader.read(max_count=4, timeout=1.0)
+                if frames is None:
+                    if reader.closed:
+                        break
+                    continue
+                ... # frames (n, height, width) and meta (SLOT_DTYPE) are views of the shared memory
+                reader.release(len(frames))
+    The reader starts from the next published frame. Call read() (or poll()) at least once
+    every reader_timeout seconds of the publisher, or the reader is detached and its
+    missed frames are counted in lost.
+    """
+
+    def __init__(self, name, poll_interval=0.0005):
+        self.name = name
+        self.poll_interval = poll_interval
+        try:
+            self._shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Python < 3.13: keep the resource tracker of this process from unlinking the publisher's memory
+            # (child processes of multiprocessing share the tracker of their parent instead)
+            import multiprocessing
+            from multiprocessing import resource_tracker
+            self._shm = shared_memory.SharedMemory(name)
+            if multiprocessing.parent_process() is None:
+                resource_tracker.unregister(self._shm._name, 'shared_memory')
+        header = np.ndarray((), HEADER_DTYPE, self._shm.buf, 0)
+        if header['magic'] != MAGIC:
+            del header
+            self._shm.close()
+            raise ValueError(f'{name} is not a frame ring.')
+        self.depth = int(header['depth'])
+        self.shape = (int(header['height']), int(header['width']))
+        self.dtype = np.dtype(header['dtype'].item().decode())
+        max_readers = int(header['max_readers'])
+        del header
+        self.header, self.readers, self.slots, self.frames = _views(self._shm.buf, self.depth, self.shape,
+                                                                    self.dtype, max_readers)
+        self.pid = os.getpid()
+        self._index = None
+        self._lost = 0
+        self._attach()
+
+    def _attach(self):
+        # claims a free entry of the reader table, starting from the next frame
+        # (readers attaching at the same instant from different processes are not arbitrated)
+        for index in np.flatnonzero(self.readers['pid'] == 0):
+            self.readers['heartbeat'][index] = time.time()
+            self.readers['cursor'][index] = self.header['write_count']
+            self.readers['lost'][index] = 0
+            self.readers['pid'][index] = self.pid
+            self._index = index
+            return
+        raise RuntimeError(f'Too many readers attached to {self.name}.')
+
+    @property
+    def closed(self):
+        return bool(self.header['closed'])
+
+    @property
+    def lost(self):
+        # frames missed because the reader was detached by the publisher
+        return self._lost
+
+    def poll(self):
+        """
+        Keeps the reader attached and returns the number of frames ready to be read.
+        If the publisher detached it, the reader attaches again from the newest frame.
+        """
+        if self.readers['pid'][self._index] != self.pid:
+            cursor = int(self.readers['cursor'][self._index])
+            self._attach()
+            lost = int(self.readers['cursor'][self._index]) - cursor
+            self._lost += lost
+            self.readers['lost'][self._index] = self._lost
+        self.readers['heartbeat'][self._index] = time.time()
+        return int(self.header['write_count'] - self.readers['cursor'][self._index])
+
+    def read(self, max_count=1, timeout=None):
+        """
+        Waits for frames and returns (first_seq, frames, meta): up to max_count contiguous
+        frames (n, height, width) and their slot headers, as views valid until release().
+        Returns (None, None, None) on timeout or when the ring is closed and drained.
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            available = self.poll()
+            if available > 0:
+                break
+            if self.closed or (deadline is not None and time.perf_counter() >= deadline):
+                return None, None, None
+            time.sleep(self.poll_interval)
+        cursor = int(self.readers['cursor'][self._index])
+        slot = cursor % self.depth
+        count = min(available, max_count, self.depth - slot) # do not wrap around
+        return cursor, self.frames[slot:slot + count], self.slots[slot:slot + count]
+
+    def release(self, count=1):
+        self.readers['cursor'][self._index] += count
+
+    def __iter__(self):
+        # frames one at a time (seq, frame, meta), until the ring is closed
+        while True:
+            seq, frames, meta = self.read(timeout=0.1)
+            if frames is None:
+                if self.closed:
+                    return
+                continue
+            try:
+                yield seq, frames[0], meta[0]
+            finally:
+                self.release(1)
+
+    def close(self):
+        if self._shm is None:
+            return
+        if self.readers['pid'][self._index] == self.pid:
+            self.readers['pid'][self._index] = 0
+        self.header = self.readers = self.slots = self.frames = None
+        _close(self._shm)
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
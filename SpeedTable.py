@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 02:35:10 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Readout port / speed / gain table of a camera, enumerated once from the driver
+(pyvcam port_speed_gain_table, which switches through every port and speed) and
+cached as <directory>/<serial number>.json (default: a per-user cache directory,
+see default_table_dir), so that the next starts reuse it.
+"""
+
+import json
+import os
+import time
+
+TABLE_VERSION = 1
+
+
+class SpeedTable(object):
+    """
+    table = {'serial_no': str, 'name': str, 'sensor_size': [width, height],
+             'ports': [{'port': value, 'name': str, 'exposure_range': [min, max] (ms) or None,
+                        'speeds': [{'speed': index, 'pixel_time': ns,
+                                    'gains': [{'gain': index, 'name': str, 'bit_depth': bits}]}]}]}
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self._ports = {port['port']: port for port in table['ports']}
+
+    @classmethod
+    def discover(cls, cam, exposure_range=None):
+        """
+        Enumerates the table of the pyvcam Camera cam (this changes its readout port).
+        exposure_range: optional function (cam) -> (min, max) exposure in ms for the current port.
+        """
+        ports = []
+        for port_name, port_entry in cam.port_speed_gain_table.items():
+            speeds = []
+            for speed_entry in port_entry.values():
+                if not isinstance(speed_entry, dict) or 'speed_index' not in speed_entry:
+                    continue
+                gains = [{'gain': gain_entry['gain_index'], 'name': str(gain_name),
+                          'bit_depth': gain_entry.get('bit_depth')}
+                         for gain_name, gain_entry in speed_entry.items()
+                         if isinstance(gain_entry, dict) and 'gain_index' in gain_entry]
+                speeds.append({'speed': speed_entry['speed_index'], 'pixel_time': speed_entry.get('pixel_time'),
+                               'gains': sorted(gains, key=lambda gain: gain['gain'])})
+            port = {'port': port_entry['port_value'], 'name': str(port_name), 'exposure_range': None,
+                    'speeds': sorted(speeds, key=lambda speed: speed['speed'])}
+            if exposure_range is not None:
+                try:
+                    cam.readout_port = port['port']
+                    port['exposure_range'] = list(exposure_range(cam))
+                except Exception:
+                    pass # the exposure limits stay those of the settings
+            ports.append(port)
+        return cls({'version': TABLE_VERSION, 'serial_no': str(cam.serial_no), 'name': str(cam.name),
+                    'sensor_size': list(cam.sensor_size), 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'ports': sorted(ports, key=lambda port: port['port'])})
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            table = json.load(file)
+        if table.get('version') != TABLE_VERSION:
+            raise ValueError(f'{path}: unsupported speed table version {table.get("version")}.')
+        return cls(table)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.table, file, indent=1)
+
+    @property
+    def sensor_size(self):
+        return tuple(self.table['sensor_size'])
+
+    def ports(self):
+        # [(name, value)] of the readout ports, e.g. for the choices of a setting
+        return [(port['name'], port['port']) for port in self.table['ports']]
+
+    def port(self, port):
+        if port not in self._ports:
+            raise ValueError(f'Invalid readout port {port}, choose among {sorted(self._ports)}.')
+        return self._ports[port]
+
+    def speeds(self, port):
+        return [speed['speed'] for speed in self.port(port)['speeds']]
+
+    def _speed(self, port, speed):
+        for entry in self.port(port)['speeds']:
+            if entry['speed'] == speed:
+                return entry
+        raise ValueError(f'Invalid speed {speed} for readout port {port}, choose among {self.speeds(port)}.')
+
+    def gains(self, port, speed):
+        # [(name, value)] of the gains of a port and speed
+        return [(gain['name'], gain['gain']) for gain in self._speed(port, speed)['gains']]
+
+    def fastest_speed(self, port):
+        # speed index with the shortest pixel time (the first one if the pixel times are unknown)
+        speeds = self.port(port)['speeds']
+        return min(speeds, key=lambda speed: speed['pixel_time'] or float('inf'))['speed']
+
+    def exposure_range(self, port):
+        # (min, max) exposure time in ms, or None if unknown
+        exposure_range = self.port(port)['exposure_range']
+        return tuple(exposure_range) if exposure_range else None
+
+    def readout_config(self, port, speed=None, gain=None):
+        """
+        Valid readout_port/speed/gain for port: speed None is the fastest speed of the port,
+        gain is kept if the speed has it, otherwise the first gain is used.
+        """
+        if speed is None:
+            speed = self.fastest_speed(port)
+        gains = [value for _, value in self.gains(port, speed)]
+        if gain not in gains:
+            gain = gains[0]
+        return {'readout_port': port, 'speed': speed, 'gain': gain}
+
+
+def default_table_dir():
+    # per-user cache directory of the tables, outside the source tree
+    try:
+        import platformdirs
+        return platformdirs.user_cache_dir('pvcam_tables', appauthor=False)
+    except ImportError:
+        return os.path.join(os.path.expanduser('~'), '.cache', 'pvcam_tables')
+
+
+def load_or_discover(cam, directory, exposure_range=None, refresh=False):
+    """
+    Returns (SpeedTable, source): the table cached in directory for the serial number of cam
+    ('cache'), or the one enumerated from cam and saved there ('camera').
+    With directory None the table is enumerated and not saved.
+    """
+    if directory is None:
+        return SpeedTable.discover(cam, exposure_range), 'camera'
+    path = os.path.join(directory, f'{cam.serial_no}.json')
+    if not refresh and os.path.isfile(path):
+        try:
+            table = SpeedTable.load(path)
+            if table.sensor_size == tuple(cam.sensor_size):
+                return table, 'cache'
+        except (ValueError, KeyError, OSError):
+            pass # unreadable or outdated cache: enumerate the table again
+    table = SpeedTable.discover(cam, exposure_range)
+    try:
+        table.save(path)
+    except OSError:
+        pass # read-only directory: the table is enumerated at each start
+    return table, 'camera'
@@ -5,7 +5,6 @@ import time
 import numpy as np
 import matplotlib.pyplot as plt 
 import warnings
-import tifffile as tiff 
 import os
 
 
@@ -17,16 +16,15 @@ def add_path(path):
     sys.path.append(os.path.abspath(os.path.join(dirname(dirname(__file__)),path)))
 
 
-def collect_frames(cam, num_frames):
+def collect_frames(stream, writer=None):
+    # reads the batches of a started camera stream and appends them to writer (pages are written as they arrive)
     frames_received = 0
-    while frames_received < num_frames:
-        try:
-            frame, fps, frame_count = cam.poll_frame()
-            print(f"Count: {frame_count:2}  FPS: {fps:5.1f}"
-                  f"  First five pixels: {frame['pixel_data'][0, 0:5]}")
-            frames_received += 1
-        except ValueError as e:
-            print(str(e))
+    for frames, meta in stream:
+        print(f"Frames {meta['frame_number'][0]}-{meta['frame_number'][-1]}"
+              f"  First five pixels: {frames[-1, 0, 0:5]}")
+        if writer is not None:
+            writer.append(frames)
+        frames_received += len(frames)
 
     return frames_received
 
@@ -39,6 +37,7 @@ motor = PI_VC_Device('0185500006', '1')
 
 #Connect camera
 from CameraDevice import PVcamDevice
+from TiffWriter import TiffFrameWriter
 camera = PVcamDevice()
 
 
@@ -87,13 +86,10 @@ print('Initial position for trigger:', motor.get_position())
 motor.trigger(0.025, 2.3, 2.4, 1, 4)
 
 frame_num = 5
-# Start acquisition: 2 possible commands
-# camera.acq_start() # live acquisition
-camera.acq_start_seq(frame_num) #sequential acquisition of a fixed number of frames
-
-motor.move_absolute(4.5)
-motor.wait_on_target()
-print('Final position after trigger:', motor.get_position())
+# Start acquisition: sequential acquisition of a fixed number of frames (mode='live' for a circular buffer),
+# read in batches of up to 4 frames; the stream starts the acquisition when it is entered
+# (before the motor moves, so that no trigger is missed) and stops it when it is closed
+stream = camera.stream(frame_num, batch=4, timeout=10.0)
 
 
 # #Retrieve and plot images
@@ -114,25 +110,23 @@ print('Final position after trigger:', motor.get_position())
 
 
 
-received_frames = collect_frames(camera.cam, frame_num)
-print(f'Received live frames: {received_frames}\n')
-image = np.zeros((frame_num, int(camera.get_height()/camera.get_binning()), int(camera.get_width()/camera.get_binning())), dtype=np.uint16)
-
 timestamp = time.strftime("%y%m%d_%H%M%S", time.localtime())
 saving_dir = r"C:\Temp"
 sample_name = f"retiga_ext_trigger_{frame_num}frames_{timestamp}"
-fname = os.path.join(saving_dir, sample_name + '.tiff')
-
-for i in range(frame_num):
-    frame, fps, frame_count = camera.cam.poll_frame()
-
-    image[i, :, : ] = frame["pixel_data"]  # 2D numpy array
-
-#Saving as a multipage tiff
-tiff.imwrite(fname, image, photometric="minisblack", bigtiff=True)
-
+fname = os.path.join(saving_dir, sample_name + '.ome.tif')
+
+#Saving as a multipage OME-TIFF, streamed while the frames arrive
+writer = TiffFrameWriter(fname, frame_num, camera.get_frame_shape(), np.uint16, sampling_um=(1.0, 1.0, 1.0))
+try:
+    with stream:
+        motor.move_absolute(4.5)
+        motor.wait_on_target()
+        print('Final position after trigger:', motor.get_position())
+        received_frames = collect_frames(stream, writer)
+finally:
+    print('Saved:', writer.close()['files'])
+print(f'Received live frames: {received_frames}\n')
 
-camera.acq_stop()
 
 camera.set_trigger_mode('Internal Trigger')
 
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 07:02:48 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Preflight of a recording: the data rate of the camera is compared with the measured
+write speed of the saving directory and with the free memory, to warn before a run
+that is bound to drop frames.
+"""
+
+import os
+import time
+import numpy as np
+
+
+def measure_disk_rate(directory, size_MB=128, block_MB=8):
+    # sequential write speed (MB/s) of directory, including the flush to the disk, with a temporary file
+    block = np.random.default_rng(0).integers(0, 4096, int(block_MB * 1e6) // 2, dtype=np.uint16)
+    path = os.path.join(directory, f'.disk_rate_{os.getpid()}.tmp')
+    blocks = max(1, int(size_MB // block_MB))
+    try:
+        t0 = time.perf_counter()
+        with open(path, 'wb', buffering=0) as file:
+            for _ in range(blocks):
+                file.write(block)
+            os.fsync(file.fileno())
+        elapsed = time.perf_counter() - t0
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return blocks * block.nbytes / 1e6 / elapsed
+
+
+def available_memory_MB():
+    # physical memory available to new allocations, None if it cannot be read
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1e6
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (ValueError, OSError, AttributeError):
+        return None # e.g. Windows without psutil
+
+
+def preflight(frames, frame_rate, saved_rate, disk_rate, buffer_MB, memory_MB, available_MB):
+    """
+    Warnings (list of str, empty if the run should not drop frames) for a recording of
+    `frames` frames at frame_rate (Hz):
+    saved_rate: MB/s written to the file (after correction and reduction)
+    disk_rate: measured write speed (MB/s), None if unknown
+    buffer_MB: memory that absorbs the frames waiting to be written (ring, writer blocks, sequence buffer)
+    memory_MB: memory the run allocates, available_MB: free memory (None if unknown)
+    """
+    warnings = []
+    duration = frames / frame_rate if frame_rate else 0.0
+    if disk_rate and saved_rate > disk_rate:
+        # the frames waiting to be written grow by the difference of the rates
+        fill_time = buffer_MB / (saved_rate - disk_rate)
+        if fill_time < duration:
+            warnings.append(f'saving {saved_rate:.0f} MB/s exceeds the disk speed {disk_rate:.0f} MB/s: '
+                            f'the {buffer_MB:.0f} MB of buffers fill after {fill_time:.1f} s of the '
+                            f'{duration:.1f} s run, then frames are dropped')
+    if available_MB is not None and memory_MB > available_MB:
+        warnings.append(f'the run needs {memory_MB:.0f} MB of memory, only {available_MB:.0f} MB are available')
+    return warnings
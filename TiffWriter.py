@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 00:31:18 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Streaming BigTIFF/OME-TIFF writer: frames are appended as pages while they arrive,
+through a bounded write-behind queue, so that the memory used does not depend on
+the length of the acquisition. Same interface as H5Writer.H5FrameWriter.
+"""
+
+import os
+import threading
+import queue
+import time
+import numpy as np
+
+tifffile = None
+
+
+def import_tifffile():
+    # tifffile is only imported when the TIFF output is used
+    global tifffile
+    if tifffile is None:
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError('The TIFF output requires the tifffile package.')
+    return tifffile
+
+
+class TiffFrameWriter(object):
+    """
+    Writes frames of shape frame_shape as pages of BigTIFF files with OME-XML metadata.
+    fname: path of the first file (e.g. 'stack.ome.tif'); with max_file_size (bytes) the
+        recording rolls over to 'stack_1.ome.tif', 'stack_2.ome.tif', ... each a complete OME-TIFF.
+    length: expected number of frames, written in the OME-XML of each file from the first page,
+        so that the pages already written can be read if the acquisition dies;
+        the OME-XML is updated with the actual number of frames by close().
+    sampling_um: (z, y, x) pixel size; frames are stacked along axis ('Z' or 'T').
+    Memory use is bounded by queue_blocks * batch_frames frames.
+    """
+
+    def __init__(self, fname, length, frame_shape, dtype=np.uint16, sampling_um=(1.0, 1.0, 1.0), axis='Z',
+                 batch_frames=4, queue_blocks=3, max_file_size=None, name=None):
+        import_tifffile()
+        if axis not in ('Z', 'T'):
+            raise ValueError(f'Frames can be stacked along Z or T, not {axis}.')
+        self.fname = fname
+        self.length = length
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.sampling_um = sampling_um
+        self.axis = axis
+        self.name = name or os.path.basename(fname).split('.')[0]
+        self.batch_frames = batch_frames
+        frame_nbytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self.frames_per_file = max(1, int(max_file_size // frame_nbytes)) if max_file_size else None
+        self.files = []
+
+        self._free_blocks = queue.Queue()
+        for _ in range(queue_blocks):
+            self._free_blocks.put(np.empty((batch_frames,) + self.frame_shape, dtype=self.dtype))
+        self._pending = queue.Queue()
+        self._block = None
+        self._fill = 0
+
+        self._tif = None
+        self._file_frames = 0 # frames in the current file
+        self._planned = 0 # frames declared in the OME-XML of the current file
+        self._pages = 0 # pages written in all the files
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.write_time = 0.0
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name='tiff_writer', daemon=True)
+        self._thread.start()
+
+    def append(self, frames, meta=None):
+        """
+        Copies frames (shape (n, height, width)) at the end of the recording.
+        Blocks only if all the blocks are waiting to be written. meta is not stored.
+        """
+        if self.error is not None:
+            raise self.error
+        done = 0
+        while done < len(frames):
+            if self._block is None:
+                self._block = self._free_blocks.get()
+            count = min(len(frames) - done, self.batch_frames - self._fill)
+            self._block[self._fill:self._fill + count] = frames[done:done + count]
+            self._fill += count
+            done += count
+            if self._fill == self.batch_frames:
+                self._submit()
+
+    def _submit(self):
+        if self._fill:
+            self._pending.put((self._block, self._fill))
+        else:
+            self._free_blocks.put(self._block)
+        self._block = None
+        self._fill = 0
+
+    def _file_name(self, index):
+        if index == 0:
+            return self.fname
+        base, ext = self.fname, ''
+        for suffix in ('.ome.tiff', '.ome.tif', '.tiff', '.tif'):
+            if self.fname.endswith(suffix):
+                base, ext = self.fname[:-len(suffix)], suffix
+                break
+        return f'{base}_{index}{ext}'
+
+    def _description(self, frames):
+        omexml = tifffile.OmeXml()
+        z, y, x = self.sampling_um
+        sizes = {'PhysicalSizeX': x, 'PhysicalSizeY': y} # OME default unit: micrometer
+        if self.axis == 'Z':
+            sizes['PhysicalSizeZ'] = z
+        omexml.addimage(self.dtype, (frames,) + self.frame_shape, (frames, 1, 1) + self.frame_shape + (1,),
+                        axes=self.axis + 'YX', Name=self.name, **sizes)
+        return omexml.tostring(declaration=True)
+
+    def _planned_frames(self):
+        # frames expected in the file being opened
+        remaining = max(1, (self.length or 1) - self._pages)
+        return min(remaining, self.frames_per_file) if self.frames_per_file else remaining
+
+    def _write_page(self, frame):
+        if self._tif is not None and self.frames_per_file and self._file_frames == self.frames_per_file:
+            self._close_file()
+        description = None
+        if self._tif is None:
+            fname = self._file_name(len(self.files))
+            self._tif = tifffile.TiffWriter(fname, bigtiff=True, ome=False)
+            self.files.append(fname)
+            self._file_frames = 0
+            self._planned = self._planned_frames()
+            description = self._description(self._planned)
+        # one IFD per page, written at once: the file is readable up to the last page
+        self._tif.write(frame, photometric='minisblack', description=description, metadata=None)
+        self._file_frames += 1
+        self._pages += 1
+
+    def _close_file(self):
+        if self._file_frames != self._planned:
+            self._tif.overwrite_description(self._description(self._file_frames))
+        self._tif.close()
+        self._tif = None
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            block, count = item
+            if self.error is None:
+                try:
+                    t0 = time.perf_counter()
+                    for frame in block[:count]:
+                        self._write_page(frame)
+                    self.write_time += time.perf_counter() - t0
+                    self.frames_written += count
+                    self.bytes_written += block[:count].nbytes
+                except Exception as err:
+                    self.error = err
+            self._free_blocks.put(block)
+
+    def close(self):
+        """
+        Writes the remaining frames, completes the OME-XML of the last file, closes it
+        and returns the writer statistics.
+        """
+        if self._block is not None:
+            self._submit()
+        self._pending.put(None)
+        self._thread.join()
+        if self._tif is not None:
+            self._close_file()
+        if self.error is not None:
+            raise self.error
+        return self.stats()
+
+    def stats(self):
+        return {'frames': self.frames_written,
+                'MB': self.bytes_written / 1e6,
+                'MBps': self.bytes_written / 1e6 / self.write_time if self.write_time else 0.0,
+                'compression_ratio': 1.0,
+                'files': list(self.files)}
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 01:48:06 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Lightweight timing probes for the acquisition pipeline: each probe counts events,
+bytes and durations in a histogram with power-of-two microsecond bins, so that adding
+a sample costs a couple of perf_counter calls and a list increment.
+"""
+
+import math
+import threading
+import time
+
+HISTOGRAM_BINS = 28 # bin k counts durations in [2**(k-1), 2**k) us, the last one everything longer
+
+
+class TimingProbe(object):
+    """
+    Usage in the hot path:
+        t0 = time.perf_counter()
+        ...
+        probe.add(time.perf_counter() - t0, nbytes)
+    add() is meant to be called by one thread per probe.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.histogram = [0] * HISTOGRAM_BINS
+        self.count = 0
+        self.total = 0.0 # seconds
+        self.max = 0.0
+        self.nbytes = 0
+        self.t_first = None
+        self.t_last = None
+
+    def add(self, seconds, nbytes=0):
+        us = seconds * 1e6
+        index = math.frexp(us)[1] if us >= 1 else 0
+        self.histogram[min(max(index, 0), HISTOGRAM_BINS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.nbytes += nbytes
+        if seconds > self.max:
+            self.max = seconds
+        now = time.perf_counter()
+        if self.t_first is None:
+            self.t_first = now - seconds
+        self.t_last = now
+
+    def percentile(self, q):
+        # upper edge (seconds) of the histogram bin holding the q-th percentile
+        if not self.count:
+            return 0.0
+        target = self.count * q / 100
+        cumulative = 0
+        for index, counts in enumerate(self.histogram):
+            cumulative += counts
+            if cumulative >= target:
+                return min(2 ** index * 1e-6, self.max)
+        return self.max
+
+    def summary(self):
+        elapsed = (self.t_last - self.t_first) if self.count > 1 else 0.0
+        return {'count': self.count,
+                'mean_ms': self.total * 1e3 / self.count if self.count else 0.0,
+                'p50_ms': self.percentile(50) * 1e3,
+                'p99_ms': self.percentile(99) * 1e3,
+                'max_ms': self.max * 1e3,
+                'busy_s': self.total,
+                'rate_hz': (self.count - 1) / elapsed if elapsed else 0.0,
+                'MBps': self.nbytes / 1e6 / elapsed if elapsed else 0.0}
+
+
+class ProbeSet(object):
+    """
+    Named TimingProbes, created on first use: probes['poll'].add(...).
+    """
+
+    def __init__(self):
+        self._probes = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        probe = self._probes.get(name)
+        if probe is None:
+            with self._lock:
+                probe = self._probes.setdefault(name, TimingProbe(name))
+        return probe
+
+    def reset(self):
+        with self._lock:
+            self._probes.clear()
+
+    def summary(self):
+        return {name: probe.summary() for name, probe in list(self._probes.items()) if probe.count}
+
+    def report(self):
+        # one text line per probe
+        lines = []
+        for name, s in self.summary().items():
+            line = (f"{name:16} n={s['count']:<7} mean {s['mean_ms']:8.3f} ms  p50 <{s['p50_ms']:8.3f} ms  "
+                    f"p99 <{s['p99_ms']:8.3f} ms  max {s['max_ms']:8.3f} ms  {s['rate_hz']:7.1f} Hz")
+            if s['MBps']:
+                line += f"  {s['MBps']:7.1f} MB/s"
+            lines.append(line)
+        return lines
+
+    def save_attrs(self, attrs):
+        # writes the summary and histograms in h5 attributes (attrs of a group) as <probe>_<key>
+        for name, probe in list(self._probes.items()):
+            if not probe.count:
+                continue
+            for key, value in probe.summary().items():
+                attrs[f'{name}_{key}'] = value
+            attrs[f'{name}_histogram_us'] = probe.histogram
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 01:12:44 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+OME-Zarr (v0.4, zarr v2 directory store) writer: frames are grouped into chunks
+that are compressed and written in parallel by a thread or process pool, together
+with an optional multiscale pyramid built chunk by chunk as the data arrives.
+Same interface as H5Writer.H5FrameWriter.
+"""
+
+import os
+import threading
+import queue
+import time
+import numpy as np
+
+zarr = Blosc = None
+
+ZARR_COMPRESSIONS = ['none', 'lz4', 'zstd']
+
+
+def import_zarr():
+    # zarr and numcodecs are only imported when the OME-Zarr output is used
+    global zarr, Blosc
+    if zarr is None:
+        try:
+            import zarr
+            from numcodecs import Blosc
+        except ImportError:
+            raise ImportError('The OME-Zarr output requires the zarr (v2) and numcodecs packages.')
+    return zarr
+
+
+def zarr_compressor(compression):
+    import_zarr()
+    if compression == 'none':
+        return None
+    if compression in ('lz4', 'zstd'):
+        return Blosc(cname=compression, clevel=5 if compression == 'lz4' else 3, shuffle=Blosc.BITSHUFFLE)
+    raise ValueError(f'Unknown compression {compression}, choose among {ZARR_COMPRESSIONS}.')
+
+
+def downsample(block):
+    # 2x2 mean in y and x of a block of frames (n, rows, columns), same dtype
+    n, rows, cols = block.shape
+    rows, cols = rows // 2, cols // 2
+    binned = block[:, :rows * 2, :cols * 2].reshape(n, rows, 2, cols, 2).mean(axis=(2, 4))
+    if block.dtype.kind in 'ui':
+        np.rint(binned, out=binned)
+    return binned.astype(block.dtype)
+
+
+def write_block(store_path, levels, index, block):
+    """
+    Writes block (frames index...index+n) in the arrays '0'...'levels-1' of the store,
+    each level downsampled 2x2 from the previous one. Chunk-aligned blocks never share
+    a chunk, so that blocks can be written concurrently (also from other processes).
+    """
+    root = import_zarr().open_group(store_path, mode='r+')
+    for level in range(levels):
+        if level:
+            block = downsample(block)
+        root[str(level)][index:index + len(block)] = block
+
+
+class ZarrFrameWriter(object):
+    """
+    Writes frames of shape frame_shape into the OME-Zarr store path (a directory).
+    chunk_frames frames form one chunk; each full chunk is a task of the pool of `workers`
+    threads (executor='thread', Blosc releases the GIL) or processes (executor='process').
+    At most queue_blocks chunks are in memory (being filled, compressed or written);
+    append() blocks when they are all in use.
+    pyramid_levels: number of 2x2 downsampled levels added to the full resolution one.
+    With meta_dtype, the per-frame metadata is saved in frame_metadata/<field> by close().
+    """
+
+    def __init__(self, path, length, frame_shape, dtype=np.uint16, chunk_frames=8, compression='lz4',
+                 workers=4, executor='thread', queue_blocks=None, pyramid_levels=0,
+                 sampling_um=(1.0, 1.0, 1.0), axis='z', name=None, meta_dtype=None):
+        import_zarr()
+        frame_shape = tuple(frame_shape)
+        self.path = path
+        self.length = length
+        self.dtype = np.dtype(dtype)
+        self.chunk_frames = max(1, min(chunk_frames, length))
+        self.levels = 1 + max(0, min(pyramid_levels, int(np.log2(min(frame_shape)))))
+
+        self.root = zarr.open_group(zarr.DirectoryStore(path), mode='w')
+        compressor = zarr_compressor(compression)
+        shape = frame_shape
+        datasets = []
+        z, y, x = sampling_um
+        for level in range(self.levels):
+            self.root.create_dataset(str(level), shape=(length,) + shape, chunks=(self.chunk_frames,) + shape,
+                                     dtype=self.dtype, compressor=compressor, fill_value=0)
+            scale = [z, y * 2 ** level, x * 2 ** level]
+            datasets.append({'path': str(level), 'coordinateTransformations': [{'type': 'scale', 'scale': scale}]})
+            shape = (shape[0] // 2, shape[1] // 2)
+        axis_type = 'space' if axis == 'z' else 'time'
+        axis_unit = 'micrometer' if axis == 'z' else 'second'
+        self.root.attrs['multiscales'] = [{
+            'version': '0.4',
+            'name': name or os.path.basename(path).split('.')[0],
+            'axes': [{'name': axis, 'type': axis_type, 'unit': axis_unit},
+                     {'name': 'y', 'type': 'space', 'unit': 'micrometer'},
+                     {'name': 'x', 'type': 'space', 'unit': 'micrometer'}],
+            'datasets': datasets,
+            'type': 'mean'}]
+        self.meta = np.zeros(length, dtype=meta_dtype) if meta_dtype is not None else None
+
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        pool = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        self._pool = pool(max_workers=workers)
+        self._free_blocks = queue.Queue()
+        for _ in range(queue_blocks or 2 * workers + 1):
+            self._free_blocks.put(np.empty((self.chunk_frames,) + frame_shape, dtype=self.dtype))
+        self._lock = threading.Lock()
+        self._futures = set()
+        self._block = None
+        self._fill = 0
+        self._index = 0 # index of the first frame of the current block
+
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.t_start = None
+        self.t_end = None
+        self.error = None
+
+    def append(self, frames, meta=None):
+        """
+        Copies frames (shape (n, height, width)) and their metadata at the end of the recording.
+        Blocks only if all the chunks in memory are waiting to be compressed.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.t_start is None:
+            self.t_start = time.perf_counter()
+        done = 0
+        while done < len(frames):
+            if self._block is None:
+                self._block = self._free_blocks.get()
+            count = min(len(frames) - done, self.chunk_frames - self._fill)
+            self._block[self._fill:self._fill + count] = frames[done:done + count]
+            if meta is not None and self.meta is not None:
+                start = self._index + self._fill
+                self.meta[start:start + count] = meta[done:done + count]
+            self._fill += count
+            done += count
+            if self._fill == self.chunk_frames:
+                self._submit()
+
+    def _submit(self):
+        block, count, index = self._block, self._fill, self._index
+        self._block = None
+        self._fill = 0
+        if not count:
+            self._free_blocks.put(block)
+            return
+        self._index += count
+        future = self._pool.submit(write_block, self.path, self.levels, index, block[:count])
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(lambda f: self._done(f, block, count))
+
+    def _done(self, future, block, count):
+        with self._lock:
+            self._futures.discard(future)
+            if future.exception() is not None:
+                self.error = self.error or future.exception()
+            else:
+                self.frames_written += count
+                self.bytes_written += block[:count].nbytes
+        self._free_blocks.put(block)
+
+    def close(self):
+        """
+        Writes the remaining frames, waits for all the chunks, trims the arrays to the frames
+        written, saves the metadata and returns the writer statistics.
+        """
+        if self._block is not None:
+            self._submit()
+        self._pool.shutdown(wait=True)
+        self.t_end = time.perf_counter()
+        if self.error is not None:
+            raise self.error
+        if self._index < self.length:
+            for level in range(self.levels):
+                array = self.root[str(level)]
+                array.resize((self._index,) + array.shape[1:])
+        if self.meta is not None:
+            group = self.root.require_group('frame_metadata')
+            for field in self.meta.dtype.names:
+                group.array(field, self.meta[field][:self._index], chunks=(4096,), overwrite=True)
+        return self.stats()
+
+    def stats(self):
+        elapsed = (self.t_end or time.perf_counter()) - self.t_start if self.t_start else 0.0
+        stored = self.root['0'].nbytes_stored
+        return {'frames': self.frames_written,
+                'MB': self.bytes_written / 1e6,
+                'MBps': self.bytes_written / 1e6 / elapsed if elapsed else 0.0,
+                'compression_ratio': self.bytes_written / stored if stored else 1.0}
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:02:51 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Fixtures of the tests: frames acquired from the simulated camera (CameraSim).
+"""
+
+import numpy as np
+import pytest
+from CameraDevice import PVcamDevice
+
+SIM_SENSOR = (64, 48) # (width, height) of the simulated sensor: frames of 48 rows, 64 columns
+
+
+def acquire_frames(count, **options):
+    # count frames (count, rows, columns) and their META_DTYPE records from a simulated sequence
+    camera = PVcamDevice(backend='simulated', sensor_size=SIM_SENSOR, frame_rate=500, **options)
+    try:
+        with camera.stream(count, batch=count, timeout=2.0) as stream:
+            batches = [(frames.copy(), meta.copy()) for frames, meta in stream]
+    finally:
+        camera.close()
+    return np.concatenate([frames for frames, _ in batches]), np.concatenate([meta for _, meta in batches])
+
+
+@pytest.fixture(scope='session')
+def sim_frames():
+    return acquire_frames(40)
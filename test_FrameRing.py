@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:14:26 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+FrameRing, FrameConsumer and BlockWorker with frames of the simulated camera
+(python -m pytest test_FrameRing.py).
+"""
+
+import time
+import numpy as np
+import pytest
+from FrameRing import FrameRing, FrameConsumer, BlockWorker
+
+
+def test_lossless_consumers_keep_order(sim_frames):
+    frames, meta = sim_frames
+    ring = FrameRing(frames.shape[1:], frames.dtype, depth=8)
+    index = {int(number): i for i, number in enumerate(meta['frame_number'])}
+    seen = {'saver': [], 'analysis': []}
+    errors = []
+
+    def collector(name, delay):
+        def func(seq, block):
+            numbers = ring.metadata(seq, len(block))['frame_number']
+            # the slots are reserved until released: the pixels match the frames pushed
+            if not all(np.array_equal(frame, frames[index[number]]) for frame, number in zip(block, numbers)):
+                errors.append((name, seq))
+            seen[name].extend(numbers.tolist())
+            time.sleep(delay)
+        return func
+
+    consumers = [FrameConsumer(ring, collector('saver', 0.001), 'saver', max_count=3),
+                 FrameConsumer(ring, collector('analysis', 0.002), 'analysis')]
+    for consumer in consumers:
+        consumer.start()
+    stored = []
+    for frame, record in zip(frames, meta):
+        if ring.push(frame, record) >= 0:
+            stored.append(int(record['frame_number']))
+        time.sleep(0.001)
+    ring.close()
+    for consumer in consumers:
+        consumer.join(5.0)
+        assert consumer.error is None
+    assert not errors
+    assert seen['saver'] == stored
+    assert seen['analysis'] == stored
+    assert len(stored) + ring.overruns == len(frames)
+
+
+def test_overruns_are_counted(sim_frames):
+    frames, meta = sim_frames
+    ring = FrameRing(frames.shape[1:], frames.dtype, depth=4)
+    ring.add_reader('slow')
+    results = [ring.push(frame, record) for frame, record in zip(frames[:10], meta[:10])]
+    assert results == [0, 1, 2, 3] + [-1] * 6
+    assert ring.overruns == 6
+    assert ring.high_water == 4
+    # the frames that did not fit are lost, the stored ones are intact
+    seq, block = ring.read('slow', max_count=2)
+    assert seq == 0 and np.array_equal(block, frames[:2])
+    ring.release('slow', 2)
+    assert ring.push(frames[10], meta[10]) == 4
+    assert ring.metadata(4)['frame_number'][0] == meta[10]['frame_number']
+    assert ring.stats() == {'occupancy': 3, 'high_water': 4, 'overruns': 6, 'frames': 5}
+
+
+def test_close_drains_the_remaining_frames(sim_frames):
+    frames, meta = sim_frames
+    ring = FrameRing(frames.shape[1:], frames.dtype, depth=8)
+    ring.add_reader('saver')
+    for frame, record in zip(frames[:6], meta[:6]):
+        ring.push(frame, record)
+    ring.close()
+    drained = []
+    while True:
+        seq, block = ring.read('saver', max_count=4, timeout=1.0)
+        if block is None:
+            break
+        drained.append(block.copy())
+        ring.release('saver', len(block))
+    assert np.array_equal(np.concatenate(drained), frames[:6])
+    assert ring.read('saver', timeout=0.1) == (None, None)
+
+
+def test_block_worker_order_and_errors(sim_frames):
+    frames, meta = sim_frames
+    received = []
+    worker = BlockWorker(lambda block, records: received.append(records['frame_number'].tolist()))
+    for start in range(0, 12, 4):
+        worker.put(frames[start:start + 4], meta[start:start + 4])
+    worker.wait()
+    worker.stop()
+    assert sum(received, []) == meta['frame_number'][:12].tolist()
+
+    def fail(block, records):
+        raise IOError('disk full')
+
+    worker = BlockWorker(fail)
+    worker.put(frames[:4], meta[:4])
+    with pytest.raises(IOError):
+        worker.wait()
+    with pytest.raises(IOError):
+        worker.put(frames[4:8], meta[4:8])
+    worker.stop()
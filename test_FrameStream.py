@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 09:12:40 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+FrameStream against the simulated backend (python -m pytest test_FrameStream.py).
+"""
+
+from CameraDevice import PVcamDevice
+
+
+def test_stream_entered_twice():
+    camera = PVcamDevice(backend='simulated', sensor_size=(320, 220), frame_rate=200)
+    try:
+        stream = camera.stream(6, batch=4, timeout=2.0)
+        stream.start()
+        with stream: # already started: the sequence is not started again
+            counts = [len(frames) for frames, meta in stream]
+        assert counts == [4, 2]
+        assert not stream.running
+    finally:
+        camera.close()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:05:14 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+RoiLayout and multiple ROIs of the simulated camera (python -m pytest test_MultiRoi.py).
+"""
+
+import numpy as np
+import pytest
+from CameraDevice import PVcamDevice
+from MultiRoi import RoiLayout, parse_rois, format_rois, check_overlaps, snap_roi
+
+ROIS = [(0, 0, 16, 12), (20, 4, 8, 20), (40, 30, 24, 8)]
+
+
+def roi_arrays(layout, start=1):
+    # distinct values for each ROI, 1D as PVCAM returns them
+    arrays, value = [], start
+    for rows, cols in layout.shapes:
+        arrays.append(np.arange(value, value + rows * cols, dtype=np.uint16))
+        value += rows * cols
+    return arrays
+
+
+def test_pack_and_split():
+    layout = RoiLayout(ROIS, (2, 2))
+    assert layout.shapes == [(6, 8), (10, 4), (4, 12)]
+    assert layout.offsets == [0, 8, 12]
+    assert layout.shape == (10, 24)
+    assert layout.pixels() == 6 * 8 + 10 * 4 + 4 * 12
+    arrays = roi_arrays(layout)
+    tiled = layout.pack(arrays)
+    for roi, array, (rows, cols) in zip(layout.split(tiled), arrays, layout.shapes):
+        assert np.array_equal(roi, array.reshape(rows, cols))
+    # the pixels below the shorter ROIs are 0
+    assert tiled.sum() == sum(int(array.sum()) for array in arrays)
+    # split of a stack of tiled frames, as written by MultiRoiWriter
+    stack = np.stack([tiled, tiled + 1])
+    assert [part.shape for part in layout.split(stack)] == [(2, 6, 8), (2, 10, 4), (2, 4, 12)]
+    with pytest.raises(ValueError):
+        layout.pack(arrays[:2])
+
+
+def test_reduced():
+    layout = RoiLayout(ROIS, (2, 2))
+    assert layout.reduced(1, 1) is layout
+    reduced = layout.reduced(2, 2)
+    assert reduced.binning == (4, 4)
+    assert reduced.shapes == [(3, 4), (5, 2), (2, 6)]
+    assert reduced.shape == (5, 12)
+    assert reduced.rois == layout.rois
+    with pytest.raises(ValueError):
+        layout.reduced(3, 1) # the ROI widths are not multiples of 3
+    with pytest.raises(ValueError):
+        layout.reduced(1, 8) # taller than the third ROI
+
+
+def test_text_and_snapping():
+    assert parse_rois(format_rois(ROIS)) == ROIS
+    assert parse_rois('0,0,16,12\n20 4 8 20;') == ROIS[:2]
+    with pytest.raises(ValueError):
+        parse_rois('0,0,16')
+    with pytest.raises(ValueError):
+        check_overlaps([(0, 0, 16, 12), (8, 8, 16, 12)])
+    assert snap_roi((3, 5, 101, 97), 4) == (0, 4, 104, 96)
+    snapped = [snap_roi(roi, 8) for roi in [(3, 5, 50, 40), (53, 9, 30, 30)]]
+    check_overlaps(snapped)
+
+
+def test_simulated_rois():
+    camera = PVcamDevice(backend='simulated', sensor_size=(64, 48), frame_rate=500)
+    try:
+        shape = camera.set_rois(ROIS, 2)
+        layout = camera.roi_layout
+        assert shape == layout.shape == (10, 24)
+        assert camera.get_frame_pixels() == layout.pixels()
+        with camera.stream(4, batch=4, timeout=2.0) as stream:
+            frames, meta = next(iter(stream))
+        assert frames.shape == (4,) + layout.shape
+        assert [part.shape[1:] for part in layout.split(frames)] == layout.shapes
+        # padding of the tiled frames
+        assert not frames[:, 6:, :8].any() and not frames[:, 4:, 12:].any()
+    finally:
+        camera.close()
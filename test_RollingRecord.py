@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:31:09 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+RollingRecorder with frames of the simulated camera (python -m pytest test_RollingRecord.py).
+"""
+
+import threading
+import numpy as np
+from RollingRecord import RollingRecorder
+
+PERIOD = 0.01 # s between the host times given to the frames, so that the event windows are exact
+
+
+class ListWriter(object):
+    # writer keeping copies of the frames; with a gate, append waits for it before copying
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.frames = []
+        self.meta = []
+
+    def append(self, frames, meta=None):
+        if self.gate is not None:
+            self.gate.wait(5.0)
+        self.frames.append(np.array(frames))
+        self.meta.append(np.array(meta))
+
+    def close(self):
+        return {'frames': sum(len(frames) for frames in self.frames)}
+
+
+def paced(meta):
+    meta = meta.copy()
+    meta['host_time'] = 1000.0 + PERIOD * np.arange(len(meta))
+    return meta
+
+
+def record_event(recorder, writer, **trigger):
+    done = threading.Event()
+    result = {}
+
+    def on_done(stats, error):
+        result.update(stats=stats, error=error)
+        done.set()
+
+    assert recorder.trigger(open_writer=lambda max_frames: writer, on_done=on_done, **trigger)
+    return done, result
+
+
+def test_event_window(sim_frames):
+    frames, meta = sim_frames
+    meta = paced(meta)
+    recorder = RollingRecorder(frames.shape[1:], frames.dtype, depth=64)
+    recorder.push(frames, meta)
+    writer = ListWriter()
+    # frames 10 to 30 (pre_time and post_time halfway between two frames)
+    done, result = record_event(recorder, writer, pre_time=10.5 * PERIOD, post_time=10.5 * PERIOD,
+                                max_frames=100, event_time=meta['host_time'][20])
+    assert done.wait(5.0)
+    assert result['error'] is None and result['stats'] == {'frames': 21}
+    assert np.array_equal(np.concatenate(writer.frames), frames[10:31])
+    assert np.array_equal(np.concatenate(writer.meta)['frame_number'], meta['frame_number'][10:31])
+    assert not recorder.busy()
+
+
+def test_event_limited_to_max_frames(sim_frames):
+    frames, meta = sim_frames
+    meta = paced(meta)
+    recorder = RollingRecorder(frames.shape[1:], frames.dtype, depth=64)
+    recorder.push(frames, meta)
+    writer = ListWriter()
+    done, result = record_event(recorder, writer, pre_time=5.5 * PERIOD, post_time=1.0,
+                                max_frames=8, event_time=meta['host_time'][20])
+    assert done.wait(5.0)
+    assert np.array_equal(np.concatenate(writer.frames), frames[15:23])
+
+
+def test_unsaved_frames_are_never_overwritten(sim_frames):
+    frames, meta = sim_frames
+    meta = paced(meta)
+    recorder = RollingRecorder(frames.shape[1:], frames.dtype, depth=8)
+    recorder.push(frames[:4], meta[:4])
+    gate = threading.Event()
+    writer = ListWriter(gate)
+    done, result = record_event(recorder, writer, pre_time=0.0, post_time=1.0,
+                                max_frames=100, event_time=meta['host_time'][0])
+    assert not recorder.trigger(0.0, 1.0, lambda max_frames: ListWriter(), lambda stats, error: None, 100)
+    # the saving thread is held: 4 more frames fill the history, the others are left out
+    recorder.push(frames[4:20], meta[4:20])
+    assert recorder.dropped == 12
+    gate.set()
+    recorder.close()
+    assert done.wait(5.0)
+    assert result['error'] is None
+    assert np.array_equal(np.concatenate(writer.frames), frames[:8])
+    assert np.array_equal(np.concatenate(writer.meta)['frame_number'], meta['frame_number'][:8])
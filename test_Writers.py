@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:48:37 2026
+
+@authors: Martina Riva. Politecnico di Milano
+
+Round trip of the H5, TIFF and Zarr writers with frames of the simulated camera
+(python -m pytest test_Writers.py).
+"""
+
+import os
+import numpy as np
+import pytest
+from FrameRing import META_DTYPE
+
+
+def append_in_parts(writer, frames, meta, parts=(3, 7, 1)):
+    # uneven appends, so that the blocks of the writers are filled across several calls
+    start = 0
+    for count in parts + (len(frames),):
+        writer.append(frames[start:start + count], meta[start:start + count])
+        start += count
+        if start >= len(frames):
+            break
+    return writer.close()
+
+
+def test_h5_round_trip(sim_frames, tmp_path):
+    h5py = pytest.importorskip('h5py')
+    from H5Writer import H5FrameWriter
+    frames, meta = sim_frames
+    with h5py.File(tmp_path / 'record.h5', 'w') as h5file:
+        group = h5file.create_group('t0/c0')
+        writer = H5FrameWriter(group, 'image', len(frames), frames.shape[1:], frames.dtype,
+                               chunk_frames=4, batch_frames=4, meta_dtype=META_DTYPE)
+        stats = append_in_parts(writer, frames, meta)
+    assert stats['frames'] == len(frames)
+    with h5py.File(tmp_path / 'record.h5', 'r') as h5file:
+        group = h5file['t0/c0']
+        assert group['image'].chunks == (4,) + frames.shape[1:]
+        assert np.array_equal(group['image'][:], frames)
+        for field in META_DTYPE.names:
+            assert np.array_equal(group[field][:], meta[field])
+
+
+def test_h5_stops_at_the_frames_written(sim_frames, tmp_path):
+    h5py = pytest.importorskip('h5py')
+    from H5Writer import H5FrameWriter
+    frames, meta = sim_frames
+    with h5py.File(tmp_path / 'record.h5', 'w') as h5file:
+        # fewer frames than expected (e.g. an interrupted acquisition)
+        writer = H5FrameWriter(h5file, 'image', 100, frames.shape[1:], frames.dtype,
+                               chunk_frames=8, meta_dtype=META_DTYPE)
+        append_in_parts(writer, frames[:13], meta[:13])
+        assert h5file['image'].shape == (13,) + frames.shape[1:]
+        assert np.array_equal(h5file['frame_number'][:], meta['frame_number'][:13])
+
+
+def test_tiff_round_trip(sim_frames, tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+    from TiffWriter import TiffFrameWriter
+    frames, meta = sim_frames
+    fname = str(tmp_path / 'record.ome.tif')
+    # expected length larger than the frames written: close() corrects the OME-XML
+    writer = TiffFrameWriter(fname, len(frames) + 10, frames.shape[1:], frames.dtype, batch_frames=4)
+    stats = append_in_parts(writer, frames, meta)
+    assert stats['frames'] == len(frames) and stats['files'] == [fname]
+    with tifffile.TiffFile(fname) as tif:
+        assert tif.is_ome
+        assert np.array_equal(tif.asarray(), frames)
+        assert f'SizeZ="{len(frames)}"' in tif.ome_metadata
+
+
+def test_tiff_rolls_over_files(sim_frames, tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+    from TiffWriter import TiffFrameWriter
+    frames, meta = sim_frames
+    fname = str(tmp_path / 'record.ome.tif')
+    writer = TiffFrameWriter(fname, len(frames), frames.shape[1:], frames.dtype, batch_frames=4,
+                             max_file_size=16 * frames[0].nbytes)
+    stats = append_in_parts(writer, frames, meta)
+    assert [os.path.basename(name) for name in stats['files']] == ['record.ome.tif', 'record_1.ome.tif',
+                                                                   'record_2.ome.tif']
+    stored = np.concatenate([tifffile.imread(name).reshape((-1,) + frames.shape[1:]) for name in stats['files']])
+    assert np.array_equal(stored, frames)
+
+
+@pytest.mark.parametrize('compression', ['none', 'lz4'])
+def test_zarr_round_trip(sim_frames, tmp_path, compression):
+    zarr = pytest.importorskip('zarr')
+    from ZarrWriter import ZarrFrameWriter
+    frames, meta = sim_frames
+    path = str(tmp_path / 'record.ome.zarr')
+    # expected length larger than the frames written: close() trims the arrays
+    writer = ZarrFrameWriter(path, len(frames) + 5, frames.shape[1:], frames.dtype, chunk_frames=8,
+                             compression=compression, workers=2, pyramid_levels=1, meta_dtype=META_DTYPE)
+    stats = append_in_parts(writer, frames, meta)
+    assert stats['frames'] == len(frames)
+    root = zarr.open_group(path, mode='r')
+    assert np.array_equal(root['0'][:], frames)
+    rows, cols = frames.shape[1:]
+    assert root['1'].shape == (len(frames), rows // 2, cols // 2)
+    for field in META_DTYPE.names:
+        assert np.array_equal(root['frame_metadata'][field][:], meta[field])
+    assert [dataset['path'] for dataset in root.attrs['multiscales'][0]['datasets']] == ['0', '1']